@@ -1,7 +1,7 @@
 from logging.config import fileConfig
+import os
 
-# init logger from config file
-fileConfig('logging_config.ini')
-
-__all__ = ["color_filter", "img_modifier"]
+# init logger from config file, it lives next to the package so the CLI works from any directory
+fileConfig(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'logging_config.ini'))
 
+__all__ = ["color_filter", "img_modifier", "cache", "lut", "pipeline", "planner", "batch", "ima", "loader", "disk_cache", "folder_index", "color_pop", "regions", "history", "tiles"]
@@ -0,0 +1,82 @@
+"""
+Command line entry point
+
+usage: python -m img_modifier apply recipe.json photos/ "more/*.jpg" -o out/
+       python -m img_modifier encrypt photos/ -o vault/
+       python -m img_modifier decrypt vault/ -o photos/
+"""
+
+import argparse
+import getpass
+import logging
+import sys
+
+from img_modifier import batch
+from img_modifier import ima
+from img_modifier import img_helper
+from img_modifier import pipeline
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m img_modifier", description="Image-ica batch processing")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show debug logs")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    apply_cmd = commands.add_parser("apply", help="apply an edit recipe to images")
+    apply_cmd.add_argument("recipe", help="JSON recipe, see pipeline.Recipe")
+    apply_cmd.add_argument("inputs", nargs="+", help="image files, directories or glob patterns")
+    apply_cmd.add_argument("-o", "--output", required=True, help="output directory")
+    apply_cmd.add_argument("-j", "--jobs", type=int, default=None, help="worker processes, one per core by default")
+    apply_cmd.add_argument("-t", "--threads", type=int, default=None,
+                           help="threads rendering the tiles of large images in each process, the cores left by the "
+                                "processes by default")
+    apply_cmd.add_argument("-f", "--format", default=None, help="output extension, the input one by default")
+    apply_cmd.add_argument("--exact", action="store_true",
+                           help="run the stages in their naive order instead of the faster planned one")
+
+    for job, help_text in (("encrypt", "encrypt images to .ima files"), ("decrypt", "decrypt .ima files")):
+        crypto_cmd = commands.add_parser(job, help=help_text)
+        crypto_cmd.add_argument("inputs", nargs="+", help="files, directories or glob patterns")
+        crypto_cmd.add_argument("-o", "--output", required=True, help="output directory")
+        crypto_cmd.add_argument("-j", "--jobs", type=int, default=None,
+                                help="worker processes, one per core by default")
+        crypto_cmd.add_argument("--force", action="store_true", help="rewrite outputs which are up to date")
+
+    args = parser.parse_args(argv)
+    logging.getLogger().setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+
+    if args.command in batch.CRYPTO_JOBS:
+        extensions = img_helper.IMAGE_EXTENSIONS if args.command == "encrypt" else (ima.EXTENSION,)
+        paths = batch.collect_inputs(args.inputs, extensions)
+        if not paths:
+            parser.error("no files found")
+
+        password = getpass.getpass()
+        try:
+            failures = batch.run_crypto(args.command, paths, args.output, password, args.jobs, args.force)
+        except ValueError as e:
+            parser.error(str(e))
+        return 1 if failures else 0
+
+    with open(args.recipe) as f:
+        try:
+            recipe = pipeline.Recipe.from_json(f.read())
+        except ValueError as e:
+            parser.error(f"invalid recipe {args.recipe}: {e}")
+
+    paths = batch.collect_inputs(args.inputs)
+    if not paths:
+        parser.error("no images found")
+
+    if args.threads is not None and args.threads < 1:
+        parser.error("--threads should be at least 1")
+
+    try:
+        failures = batch.run(paths, recipe, args.output, args.jobs, args.format, args.exact, threads=args.threads)
+    except ValueError as e:
+        parser.error(str(e))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,406 @@
+"""
+Batch processing
+"""
+
+##
+# @brief Apply the same operations to many images.
+#
+# @details This program expands files, directories and glob patterns into a list of images and processes them in
+# parallel with a process pool, writing the results to an output directory. Images can also be encrypted to, or
+# decrypted from, the .ima format the same way.
+#
+# The worker processes are spawned rather than forked: the GUI starts batches from a thread of a multithreaded
+# process, and a forked child could inherit locks other threads hold, like the ones of the logging handlers or of
+# the caches, and deadlock on them.
+#
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import glob
+import logging
+import multiprocessing
+import os
+import time
+
+from img_modifier import ima
+from img_modifier import img_helper
+from img_modifier import planner
+from img_modifier import tiles
+
+logger = logging.getLogger()
+
+##
+# @brief Pool of worker processes
+#
+# @param[in] workers Number of processes, one per core by default
+# @return pool ProcessPoolExecutor with spawned processes
+#
+
+def _pool(workers=None):
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+##
+# @brief Expand inputs into image paths
+#
+# @details
+# This function accepts files, directories (their images, not recursive) and glob patterns. Duplicates are
+# dropped and the order is kept.
+#
+# @param[in] inputs List of files, directories or glob patterns
+# @param[in] extensions Extensions picked up in directories
+# @return paths List of image paths
+#
+
+def collect_inputs(inputs, extensions=img_helper.IMAGE_EXTENSIONS):
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            with os.scandir(item) as entries:
+                found = sorted(e.path for e in entries
+                               if e.is_file() and os.path.splitext(e.name)[1].lower() in extensions)
+        elif glob.has_magic(item):
+            found = sorted(glob.glob(item))
+        else:
+            found = [item]
+        paths.extend(found)
+
+    return list(dict.fromkeys(paths))
+
+##
+# @brief Process one image
+#
+# @details
+# This function runs in a worker process: it opens the image, applies the recipe and saves the result in the
+# output directory under the same name, or with the extension of fmt when given. Large images are rendered tile by
+# tile in the naive order, see tiles.apply, the others have their stages reordered and fused by the planner unless
+# exact is set.
+#
+# @param[in] path Image path
+# @param[in] recipe Recipe to apply
+# @param[in] out_dir Output directory
+# @param[in] fmt Optional output extension, e.g. "png"
+# @param[in] exact Run the stages in their naive order
+# @param[in] threads Threads rendering the tiles of a large image, see tiles.map_tiles
+# @return result Tuple of input path, output path, seconds and megapixels processed
+#
+
+def process_file(path, recipe, out_dir, fmt=None, exact=False, threads=None):
+    start = time.perf_counter()
+
+    img = img_helper.get_img(path)
+    megapixels = img.width * img.height / 1e6
+    if tiles.should_tile(img):
+        img = tiles.apply(img, recipe, workers=threads)
+    elif exact:
+        img = recipe.apply(img)
+    else:
+        img = planner.apply(img, recipe)
+
+    out_path = _out_path(path, out_dir, fmt)
+    if os.path.splitext(out_path)[1].lower() in (".jpg", ".jpeg") and img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    img_helper.save(img, out_path)
+
+    return path, out_path, time.perf_counter() - start, megapixels
+
+##
+# @brief Output path of an image
+#
+# @param[in] path Image path
+# @param[in] out_dir Output directory
+# @param[in] fmt Optional output extension
+# @return out_path Path in out_dir with the name of the image, and the extension of fmt when given
+#
+
+def _out_path(path, out_dir, fmt=None):
+    name = os.path.basename(path)
+    if fmt:
+        name = os.path.splitext(name)[0] + "." + fmt.lstrip(".")
+    return os.path.join(out_dir, name)
+
+##
+# @brief Process images in parallel
+#
+# @details
+# This function processes the images with a pool of worker processes and reports every file as soon as it is
+# done, followed by the total throughput. The cores the processes leave, e.g. when there are fewer images than
+# cores, go to the threads rendering the tiles of large images. Inputs which would write the same output, e.g.
+# images of the same name in different folders, raise ValueError before any is processed.
+#
+# @param[in] paths List of image paths
+# @param[in] recipe Recipe to apply
+# @param[in] out_dir Output directory, created if needed
+# @param[in] workers Number of processes, one per core by default
+# @param[in] fmt Optional output extension
+# @param[in] exact Run the stages in their naive order, see process_file
+# @param[in] report Function called with every line of the report
+# @param[in] threads Tile threads per process, the cores left by the processes by default
+# @return failures List of (path, error) for the images that could not be processed
+#
+
+def run(paths, recipe, out_dir, workers=None, fmt=None, exact=False, report=print, threads=None):
+    _check_outputs([_out_path(path, out_dir, fmt) for path in paths], paths)
+    os.makedirs(out_dir, exist_ok=True)
+    cores = os.cpu_count() or 1
+    if threads is None:
+        threads = max(1, cores // max(1, min(len(paths), workers or cores)))
+
+    failures = []
+    done = 0
+    megapixels = 0
+    start = time.perf_counter()
+
+    with _pool(workers) as pool:
+        futures = {pool.submit(process_file, path, recipe, out_dir, fmt, exact, threads): path for path in paths}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                _, out_path, seconds, mp = future.result()
+            except Exception as e:
+                logger.error(f"can't process {path}: {e}")
+                failures.append((path, e))
+                report(f"FAILED {path}: {e}")
+                continue
+
+            done += 1
+            megapixels += mp
+            report(f"{seconds:8.3f}s  {mp:6.1f} MP  {path} -> {out_path}")
+
+    total = time.perf_counter() - start
+    report(f"{done} images in {total:.2f}s: {done / total:.1f} images/s, {megapixels / total:.1f} MP/s, "
+           f"{len(failures)} failed")
+    return failures
+
+##
+# @brief Refuse inputs which share an output
+#
+# @details
+# This function raises ValueError listing the inputs whose output path, compared without case, is the output of
+# another input, since their jobs would overwrite each other, or is one of the inputs, e.g. when the output
+# directory is the input one, since the job would overwrite the original.
+#
+# @param[in] out_paths Output path of every input
+# @param[in] paths Input paths
+#
+
+def _check_outputs(out_paths, paths):
+    originals = {_path_key(path) for path in paths}
+    overwritten = [path for path in out_paths if _path_key(path) in originals]
+    if overwritten:
+        logger.error(f"outputs would overwrite inputs: {', '.join(overwritten)}")
+        raise ValueError(f"outputs would overwrite inputs: {', '.join(overwritten)}")
+
+    inputs = {}
+    for path, out_path in zip(paths, out_paths):
+        inputs.setdefault(_path_key(out_path), []).append(path)
+    clashes = [group for group in inputs.values() if len(group) > 1]
+    if clashes:
+        listed = "; ".join(", ".join(group) for group in clashes)
+        logger.error(f"inputs would write the same output: {listed}")
+        raise ValueError(f"inputs would write the same output: {listed}")
+
+def _path_key(path):
+    return os.path.normcase(os.path.abspath(path)).lower()
+
+##
+# @brief Check if an output is up to date
+#
+# @param[in] path Input path
+# @param[in] out_path Output path
+# @return up_to_date True if the output exists and is not older than the input
+#
+
+def _up_to_date(path, out_path):
+    return os.path.exists(out_path) and os.path.getmtime(out_path) >= os.path.getmtime(path)
+
+##
+# @brief Encrypt one file
+#
+# @details
+# This function runs in a worker process and writes out_dir/name.ext.ima, unless it is up to date. The original
+# extension stays in the name, so images which only differ by their extension get their own outputs.
+#
+# @param[in] path Image path
+# @param[in] out_dir Output directory
+# @param[in] key ima.Key shared by the batch
+# @param[in] force Write the output even if it is up to date
+# @return result Tuple of input path, output path, seconds, bytes processed, 0 for a skipped file
+#
+
+def encrypt_file(path, out_dir, key, force=False):
+    start = time.perf_counter()
+    out_path = _crypto_out_path("encrypt", path, out_dir)
+    if not force and _up_to_date(path, out_path):
+        return path, out_path, 0, 0
+
+    ima.encrypt_file(path, out_path, key)
+    return path, out_path, time.perf_counter() - start, os.path.getsize(path)
+
+##
+# @brief Decrypt one file
+#
+# @details
+# This function runs in a worker process and writes the original file in out_dir. Version 2 outputs which are up
+# to date are skipped, version 1 files are always decrypted since their extension is only known after.
+#
+# @param[in] path Path of the .ima file
+# @param[in] out_dir Output directory
+# @param[in] key ima.Key or password
+# @param[in] force Write the output even if it is up to date
+# @return result Tuple of input path, output path, seconds, bytes processed, 0 for a skipped file
+#
+
+def decrypt_file(path, out_dir, key, force=False):
+    start = time.perf_counter()
+    out_base = _decrypt_base(path, out_dir)
+    with open(path, "rb") as src:
+        header = ima.read_header(src)
+    if header is not None:
+        out_base = _decrypt_base(path, out_dir, header.ext)
+        if not force and _up_to_date(path, f"{out_base}.{header.ext}"):
+            return path, f"{out_base}.{header.ext}", 0, 0
+
+    out_path = ima.decrypt_file(path, out_base, key)
+    return path, out_path, time.perf_counter() - start, os.path.getsize(path)
+
+##
+# @brief Output path of a decryption without its extension
+#
+# @details
+# name.jpg.ima gives name, like name.ima, when the file holds a jpg.
+#
+# @param[in] path Path of the .ima file
+# @param[in] out_dir Output directory
+# @param[in] ext Original extension read from the header, None if unknown
+# @return out_base Output path without extension
+#
+
+def _decrypt_base(path, out_dir, ext=None):
+    base = os.path.splitext(os.path.basename(path))[0]
+    if ext and base.lower().endswith("." + ext.lower()):
+        base = base[:-len(ext) - 1]
+    return os.path.join(out_dir, base)
+
+##
+# @brief Output path of a crypto job
+#
+# @param[in] job "encrypt" or "decrypt"
+# @param[in] path Input path
+# @param[in] out_dir Output directory
+# @return out_path Output path, without extension for the version 1 files decrypt_file only learns it from
+#
+
+def _crypto_out_path(job, path, out_dir):
+    if job == "encrypt":
+        return os.path.join(out_dir, os.path.basename(path) + ima.EXTENSION)
+
+    try:
+        with open(path, "rb") as src:
+            header = ima.read_header(src)
+    except (OSError, ValueError):
+        header = None
+    if header is None or not header.ext:
+        return _decrypt_base(path, out_dir)
+    return f"{_decrypt_base(path, out_dir, header.ext)}.{header.ext}"
+
+##
+# @brief Derive the keys of a decryption batch
+#
+# @details
+# Files encrypted together share a salt, so the key is derived once for each distinct salt instead of once per
+# file.
+#
+# @param[in] paths List of .ima paths
+# @param[in] password Password
+# @return keys Dictionary of ima.Key, or the password for version 1 files, by path
+#
+
+def _decrypt_keys(paths, password):
+    keys = {}
+    by_salt = {}
+    for path in paths:
+        try:
+            with open(path, "rb") as src:
+                header = ima.read_header(src)
+        except (OSError, ValueError):
+            header = None
+        if header is None:
+            # version 1 or unreadable, decrypt_file reports the error
+            keys[path] = password
+            continue
+        params = (header.salt, header.params)
+        if params not in by_salt:
+            by_salt[params] = ima.Key(password, header.salt, header.params)
+        keys[path] = by_salt[params]
+    return keys
+
+##
+# @var CRYPTO_JOBS
+# Functions of the encryption and decryption batches
+# @hideinitializer
+#
+
+CRYPTO_JOBS = {"encrypt": encrypt_file, "decrypt": decrypt_file}
+
+##
+# @brief Encrypt or decrypt files in parallel
+#
+# @details
+# This function derives the key once for the batch, so encrypted files share a salt and only differ by their
+# nonce, then runs the files on a pool of worker processes. Outputs are written atomically and the ones which are
+# up to date are skipped. Inputs which would write the same output, e.g. files with the same name from two
+# folders, are refused before anything is written.
+#
+# @param[in] job "encrypt" or "decrypt"
+# @param[in] paths List of input paths
+# @param[in] out_dir Output directory, created if needed
+# @param[in] password Password
+# @param[in] workers Number of processes, one per core by default
+# @param[in] force Write outputs even if they are up to date
+# @param[in] report Function called with every line of the report
+# @param[in] progress Optional function called with the number of files done and the number of files
+# @return failures List of (path, error) for the files that could not be processed
+#
+
+def run_crypto(job, paths, out_dir, password, workers=None, force=False, report=print, progress=None):
+    if job not in CRYPTO_JOBS:
+        logger.error(f"unknown job {job}")
+        raise ValueError(f"unknown job {job}")
+    _check_outputs([_crypto_out_path(job, path, out_dir) for path in paths], paths)
+    os.makedirs(out_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    if job == "encrypt":
+        keys = dict.fromkeys(paths, ima.Key(password))
+    else:
+        keys = _decrypt_keys(paths, password)
+
+    failures = []
+    done = skipped = 0
+    nbytes = 0
+
+    with _pool(workers) as pool:
+        futures = {pool.submit(CRYPTO_JOBS[job], path, out_dir, keys[path], force): path for path in paths}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                _, out_path, seconds, size = future.result()
+            except Exception as e:
+                logger.error(f"can't {job} {path}: {e}")
+                failures.append((path, e))
+                report(f"FAILED {path}: {e}")
+            else:
+                done += 1
+                if size:
+                    nbytes += size
+                    report(f"{seconds:8.3f}s  {size / 2 ** 20:8.1f} MB  {path} -> {out_path}")
+                else:
+                    skipped += 1
+                    report(f"up to date  {out_path}")
+
+            if progress:
+                progress(done + len(failures), len(paths))
+
+    total = time.perf_counter() - start
+    report(f"{done} files in {total:.2f}s: {(done - skipped) / total:.1f} files/s, "
+           f"{nbytes / 2 ** 20 / total:.1f} MB/s, {skipped} up to date, {len(failures)} failed")
+    return failures
@@ -0,0 +1,158 @@
+"""
+Memory bounded image cache
+"""
+
+##
+# @brief Cache images and intermediate results
+#
+# @details This program provides a least recently used cache for PIL images and NumPy arrays, bounded by the
+# number of bytes the cached values take.
+#
+
+from collections import OrderedDict
+import logging
+import threading
+
+logger = logging.getLogger()
+
+##
+# @var DEFAULT_BUDGET
+# Default cache budget in bytes
+# @hideinitializer
+#
+
+DEFAULT_BUDGET = 256 * 2 ** 20
+
+##
+# @brief Size of a cached value
+#
+# @details
+# This function estimates the memory taken by a PIL image, a NumPy array or a bytes-like value.
+#
+# @param[in] value Cached value
+# @return nbytes Size in bytes
+#
+
+def size_of(value):
+    if hasattr(value, "nbytes"):
+        return value.nbytes
+    if hasattr(value, "getbands"):
+        return value.width * value.height * len(value.getbands())
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, tuple):
+        return sum(size_of(v) for v in value)
+    return 0
+
+##
+# @brief LRU cache with a memory budget
+#
+# @details
+# This class keeps values by key in least recently used order and evicts the oldest ones once the total size goes
+# over the budget. A value bigger than the whole budget is not cached. Hits and misses are counted for tuning.
+# All methods are thread safe.
+#
+
+class ImageCache:
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    ##
+    # @brief Retrieve a value
+    #
+    # @param[in] key Cache key
+    # @param[in] default Value returned on a miss
+    # @return value Cached value or default
+    #
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    ##
+    # @brief Store a value
+    #
+    # @param[in] key Cache key
+    # @param[in] value Value to cache
+    # @param[in] nbytes Size of the value, estimated by size_of when not given
+    # @param[in] keep Extra objects kept alive as long as the entry, not counted in the budget
+    #
+
+    def put(self, key, value, nbytes=None, keep=None):
+        if nbytes is None:
+            nbytes = size_of(value)
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+            if nbytes > self.budget:
+                return
+
+            self._entries[key] = (value, nbytes, keep)
+            self.size += nbytes
+            self._evict()
+
+    ##
+    # @brief Drop a value
+    #
+    # @param[in] key Cache key
+    #
+
+    def pop(self, key):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+                return old[0]
+
+    ##
+    # @brief Change the budget
+    #
+    # @param[in] budget New budget in bytes
+    #
+
+    def set_budget(self, budget):
+        with self._lock:
+            self.budget = budget
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    ##
+    # @brief Cache statistics
+    #
+    # @return stats Dictionary with entries, size, budget, hits and misses
+    #
+
+    def stats(self):
+        return {"entries": len(self._entries), "size": self.size, "budget": self.budget,
+                "hits": self.hits, "misses": self.misses}
+
+    def _evict(self):
+        while self.size > self.budget and self._entries:
+            key, (_, nbytes, _) = self._entries.popitem(last=False)
+            self.size -= nbytes
+            logger.debug(f"cache evict {key!r:.80}")
@@ -64,6 +64,97 @@ class ColorFilters:
     
     GRAY = "gray"
 
+    ##
+    # @var matrices
+    # Color matrix of every filter, one row per output channel as (r, g, b) or (r, g, b, offset)
+    # @hideinitializer
+    #
+
+    matrices = {
+        SEPIA: ((0.393, 0.769, 0.189),
+                (0.349, 0.686, 0.168),
+                (0.272, 0.534, 0.131)),
+        NEGATIVE: ((-1, 0, 0, 255),
+                   (0, -1, 0, 255),
+                   (0, 0, -1, 255)),
+        BLACK_WHITE: ((0.3, 0.59, 0.11),) * 3,
+        GRAY: ((0.3, 0.59, 0.11),) * 3,
+    }
+
+    ##
+    # @var thresholds
+    # Filters whose output is binarised, values above the threshold become 255 and the rest 0
+    # @hideinitializer
+    #
+
+    thresholds = {BLACK_WHITE: 127}
+
+##
+# @brief Apply a color matrix
+#
+# @details
+# This function computes every output channel as a weighted sum of the R, G and B input channels in a single pass
+# with float32 accumulators, instead of building a float64 copy of the whole image. Results are clamped to
+# [0, 255] and truncated, or binarised when a threshold is given. The alpha channel is copied through unchanged.
+#
+# @param[in] img Image file
+# @param[in] matrix Three rows of (r, g, b) or (r, g, b, offset) coefficients
+# @param[in] threshold Optional binarisation threshold
+# @param[in] out Optional uint8 array with the shape of the image to write the result into
+# @return im2 Filtered image
+#
+
+def apply_matrix(img, matrix, threshold=None, out=None):
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGB")
+
+    im = np.asarray(img)
+    if out is None:
+        out = np.empty(im.shape, dtype=np.uint8)
+    elif out.shape != im.shape or out.dtype != np.uint8:
+        logger.error(f"out buffer must be uint8 with shape {im.shape}")
+        raise ValueError(f"out buffer must be uint8 with shape {im.shape}")
+
+    acc = np.empty(im.shape[:2], dtype=np.float32)
+    tmp = np.empty_like(acc)
+
+    for c, row in enumerate(matrix):
+        if c > 0 and row == matrix[c - 1]:
+            out[:, :, c] = out[:, :, c - 1]
+            continue
+
+        np.multiply(im[:, :, 0], np.float32(row[0]), out=acc)
+        for k in (1, 2):
+            if row[k]:
+                np.multiply(im[:, :, k], np.float32(row[k]), out=tmp)
+                acc += tmp
+        if len(row) > 3 and row[3]:
+            acc += np.float32(row[3])
+
+        if threshold is not None:
+            np.greater(acc, threshold, out=out[:, :, c], casting="unsafe")
+            out[:, :, c] *= 255
+        else:
+            np.clip(acc, 0, 255, out=acc)
+            out[:, :, c] = acc
+
+    if im.shape[2] > 3:
+        out[:, :, 3:] = im[:, :, 3:]
+
+    return Image.fromarray(out)
+
+##
+# @brief Apply a filter by name
+#
+# @param[in] img Image file
+# @param[in] filter_name Name of filter
+# @param[in] out Optional uint8 output buffer, see apply_matrix
+# @return im2 Filtered image
+#
+
+def _apply_filter(img, filter_name, out=None):
+    return apply_matrix(img, ColorFilters.matrices[filter_name], ColorFilters.thresholds.get(filter_name), out)
+
 ##
 # @brief Apply Sepia filter
 #
@@ -75,16 +166,7 @@ class ColorFilters:
 #
 
 def sepia(img):
-    im = np.array(img)
-    im2 = np.zeros(im.shape)
-    im2[:, :, 0] = 0.393 * im[:, :, 0] + 0.769 * im[:, :, 1] + 0.189 * im[:, :, 2]
-    im2[:, :, 1] = 0.349 * im[:, :, 0] + 0.686 * im[:, :, 1] + 0.168 * im[:, :, 2]
-    im2[:, :, 2] = 0.272 * im[:, :, 0] + 0.534 * im[:, :, 1] + 0.131 * im[:, :, 2]
-    im2 = np.where(im2 > 255, 255, im2).astype(np.uint8)
-    if im.shape[2] > 3:
-        im2[:,:,3:] = im[:,:,3:]
-    im2 = Image.fromarray(im2)
-    return im2
+    return _apply_filter(img, ColorFilters.SEPIA)
 
 ##
 # @brief Apply Black and White filter
@@ -97,15 +179,7 @@ def sepia(img):
 #
 
 def black_white(img):
-    im = np.array(img)
-    im2 = np.zeros(im.shape)
-    im2[:, :, 0] = 0.3 * im[:, :, 0] + 0.59 * im[:, :, 1] + 0.11 * im[:, :, 2]
-    im2[:, :, 0] = np.where(im2[:, :, 0] <= 127, 0, 255)
-    im2[:, :, 1] = im2[:, :, 2] = im2[:, :, 0]
-    if im.shape[2] > 3:
-        im2[:, :, 3:] = im[:, :, 3:]
-    im2 = Image.fromarray(im2.astype(np.uint8))
-    return im2
+    return _apply_filter(img, ColorFilters.BLACK_WHITE)
 
 ##
 # @brief Apply Negative filter
@@ -118,13 +192,7 @@ def black_white(img):
 #
 
 def negative(img):
-    im = np.array(img)
-    im2 = 255 - im
-    if im.shape[2] > 3:
-        im2[:,:,3:] = im[:,:,3:]
-    im2 = im2.astype(np.uint8)
-    im2 = Image.fromarray(im2)
-    return im2
+    return _apply_filter(img, ColorFilters.NEGATIVE)
 
 ##
 # @brief Apply Greyscale filter
@@ -137,15 +205,7 @@ def negative(img):
 #
 
 def gray(img):
-    im = np.array(img)
-    im2 = np.zeros(im.shape)
-    im2[:, :, 0] = 0.3 * im[:, :, 0] + 0.59 * im[:, :, 1] + 0.11 * im[:, :, 2]
-    im2[:, :, 1] = im2[:, :, 2] = im2[:, :, 0]
-    if im.shape[2] > 3:
-        im2[:, :, 3:] = im[:, :, 3:]
-    im2 = im2.astype(np.uint8)
-    im2 = Image.fromarray(im2)
-    return im2
+    return _apply_filter(img, ColorFilters.GRAY)
 
 ##
 # @brief Apply a filter
@@ -155,21 +215,13 @@ def gray(img):
 #
 # @param[in] img Image file
 # @param[in] filter_name Name of filter
+# @param[in] out Optional uint8 output buffer, see apply_matrix
 # @return img_copy Copy of the image with the applied filter
 #
 
-def color_filter(img, filter_name):
-    img_copy = img.copy()
-    if filter_name == ColorFilters.SEPIA:
-        img_copy = sepia(img_copy)
-    elif filter_name == ColorFilters.NEGATIVE:
-        img_copy = negative(img_copy)
-    elif filter_name == ColorFilters.BLACK_WHITE:
-        img_copy = black_white(img_copy)
-    elif filter_name == ColorFilters.GRAY:
-        img_copy = gray(img_copy)
-    else:
+def color_filter(img, filter_name, out=None):
+    if filter_name not in ColorFilters.matrices:
         logger.error(f"can't find filter {filter_name}")
         raise ValueError(f"can't find filter {filter_name}")
 
-    return img_copy
+    return _apply_filter(img, filter_name, out)
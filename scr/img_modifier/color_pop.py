@@ -0,0 +1,236 @@
+"""
+Color pop
+"""
+
+##
+# @brief Keep one color and turn the rest of the image gray.
+#
+# @details This program builds a selection mask of the pixels close to a color and blends the image over its gray
+# version through it. Colors are compared in CIELAB, where the Euclidean distance (delta E) follows the perceived
+# difference, so one tolerance works for dark and bright colors alike. Pixels within the tolerance are kept, the
+# ones within tolerance + feather fade into gray, which avoids the speckled edges of an exact match. Given a seed
+# point, only the region of the mask connected to it is kept, see regions.connected_region.
+#
+# The Lab conversion and the gray version of an image are kept in a small cache, so picking another color or
+# changing the tolerance on the same image only recomputes the distances. Large images are processed in bands of
+# rows to bound the temporaries.
+#
+
+from PIL import Image
+
+import logging
+
+import numpy as np
+
+from img_modifier import cache
+from img_modifier import color_filter as cf
+from img_modifier import regions
+
+logger = logging.getLogger()
+
+##
+# @var DEFAULT_TOLERANCE
+# Default delta E under which a color is kept
+# @hideinitializer
+#
+
+DEFAULT_TOLERANCE = 20
+
+##
+# @var DEFAULT_FEATHER
+# Default width in delta E of the fade from the kept color to gray
+# @hideinitializer
+#
+
+DEFAULT_FEATHER = 10
+
+##
+# @var CACHE_BUDGET
+# Budget of the cache of Lab conversions and gray versions in bytes
+# @hideinitializer
+#
+
+CACHE_BUDGET = 128 * 2 ** 20
+
+##
+# @var BAND_PIXELS
+# Pixels converted at once when the Lab conversion is not cached
+# @hideinitializer
+#
+
+BAND_PIXELS = 2 ** 20
+
+# sRGB to XYZ (D65) divided by the white point, so the white maps to (1, 1, 1)
+_RGB_TO_XYZ = (np.array([[0.4124564, 0.3575761, 0.1804375],
+                         [0.2126729, 0.7151522, 0.0721750],
+                         [0.0193339, 0.1191920, 0.9503041]])
+               / np.array([[0.95047], [1.0], [1.08883]])).astype(np.float32)
+
+# linear value of every 8-bit sRGB level
+_levels = np.arange(256) / 255
+_LINEAR = np.where(_levels <= 0.04045, _levels / 12.92, ((_levels + 0.055) / 1.055) ** 2.4).astype(np.float32)
+
+_EPSILON = 216 / 24389
+_KAPPA = 24389 / 27
+
+_cache = cache.ImageCache(CACHE_BUDGET)
+
+##
+# @brief Convert sRGB to CIELAB
+#
+# @details
+# The channels are kept in separate planes, which NumPy processes much faster than interleaved pixels.
+#
+# @param[in] rgb uint8 array of shape (..., 3)
+# @return lab float32 array of shape (3, ...), the L, a and b planes
+#
+
+def rgb_to_lab(rgb):
+    linear = [_LINEAR[rgb[..., c]] for c in range(3)]
+
+    f = np.empty((3,) + rgb.shape[:-1], dtype=np.float32)
+    tmp = np.empty(rgb.shape[:-1], dtype=np.float32)
+    for i, row in enumerate(_RGB_TO_XYZ):
+        np.multiply(linear[0], row[0], out=f[i])
+        for c in (1, 2):
+            np.multiply(linear[c], row[c], out=tmp)
+            f[i] += tmp
+
+    small = f <= _EPSILON
+    low = (_KAPPA * f[small] + 16) / 116
+    np.cbrt(f, out=f)
+    f[small] = low
+
+    lab = np.empty_like(f)
+    np.multiply(f[1], 116, out=lab[0])
+    lab[0] -= 16
+    np.subtract(f[0], f[1], out=lab[1])
+    lab[1] *= 500
+    np.subtract(f[1], f[2], out=lab[2])
+    lab[2] *= 200
+    return lab
+
+def _rgb(img):
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGB")
+    return img
+
+##
+# @brief Lab conversion of an image
+#
+# @param[in] img RGB or RGBA image
+# @return lab float32 array, None when it would not fit in the cache
+#
+
+def _lab(img):
+    key = ("lab", id(img))
+    lab = _cache.get(key)
+    if lab is None and img.width * img.height * 12 <= _cache.budget // 2:
+        lab = rgb_to_lab(np.asarray(img)[:, :, :3])
+        _cache.put(key, lab, keep=img)
+    return lab
+
+##
+# @brief Gray version of an image
+#
+# @param[in] img RGB or RGBA image
+# @return gray Image with the mode of img
+#
+
+def gray_base(img):
+    key = ("gray", id(img))
+    gray = _cache.get(key)
+    if gray is None:
+        gray = cf.gray(img)
+        _cache.put(key, gray, keep=img)
+    return gray
+
+##
+# @brief Pick a color
+#
+# @details
+# This function averages a small square around the point, so the noise of a single pixel doesn't set the color.
+#
+# @param[in] img PIL image
+# @param[in] x Column
+# @param[in] y Row
+# @param[in] radius Half size of the square
+# @return color (r, g, b) tuple of ints
+#
+
+def pick(img, x, y, radius=2):
+    img = _rgb(img)
+    box = (max(0, x - radius), max(0, y - radius), min(img.width, x + radius + 1), min(img.height, y + radius + 1))
+    if box[0] >= box[2] or box[1] >= box[3]:
+        logger.error(f"point ({x}, {y}) is outside of the image")
+        raise ValueError(f"point ({x}, {y}) is outside of the image")
+
+    area = np.asarray(img.crop(box))[:, :, :3].reshape(-1, 3)
+    return tuple(int(v) for v in area.mean(axis=0).round())
+
+##
+# @brief Selection mask of a color
+#
+# @details
+# The mask can drive other edits too, e.g. as the mask of Image.composite.
+#
+# @param[in] img PIL image
+# @param[in] color (r, g, b) color to keep
+# @param[in] tolerance Delta E under which pixels are fully selected
+# @param[in] feather Width in delta E of the fade to unselected
+# @param[in] seed Optional (x, y) point as fractions of the width and height, only the selected region connected
+# to it is kept
+# @return mask "L" image, 255 for selected pixels
+#
+
+def color_mask(img, color, tolerance=DEFAULT_TOLERANCE, feather=DEFAULT_FEATHER, seed=None):
+    img = _rgb(img)
+    target = rgb_to_lab(np.array([color[:3]], dtype=np.uint8))[:, 0]
+    lab = _lab(img)
+    rgb = np.asarray(img)
+
+    mask = np.empty(rgb.shape[:2], dtype=np.uint8)
+    rows = max(1, BAND_PIXELS // max(1, img.width))
+    for top in range(0, img.height, rows):
+        band = lab[:, top:top + rows] if lab is not None else rgb_to_lab(rgb[top:top + rows, :, :3])
+
+        distance = np.subtract(band[0], target[0])
+        np.square(distance, out=distance)
+        tmp = np.empty_like(distance)
+        for c in (1, 2):
+            np.subtract(band[c], target[c], out=tmp)
+            np.square(tmp, out=tmp)
+            distance += tmp
+        np.sqrt(distance, out=distance)
+
+        # 255 up to the tolerance, down to 0 at tolerance + feather
+        if feather > 0:
+            np.subtract(tolerance + feather, distance, out=distance)
+            distance *= np.float32(255 / feather)
+            np.clip(distance, 0, 255, out=distance)
+            mask[top:top + rows] = distance
+        else:
+            np.less_equal(distance, tolerance, out=mask[top:top + rows], casting="unsafe")
+            mask[top:top + rows] *= 255
+
+    if seed is not None:
+        x = min(int(seed[0] * img.width), img.width - 1)
+        y = min(int(seed[1] * img.height), img.height - 1)
+        mask *= regions.connected_region(mask > 0, x, y)
+
+    return Image.fromarray(mask)
+
+##
+# @brief Apply color pop
+#
+# @param[in] img PIL image
+# @param[in] color (r, g, b) color to keep
+# @param[in] tolerance Delta E under which the color is kept
+# @param[in] feather Width in delta E of the fade to gray
+# @param[in] seed Optional (x, y) point as fractions of the width and height, see color_mask
+# @return img New image, gray where the color differs
+#
+
+def color_pop(img, color, tolerance=DEFAULT_TOLERANCE, feather=DEFAULT_FEATHER, seed=None):
+    img = _rgb(img)
+    return Image.composite(img, gray_base(img), color_mask(img, color, tolerance, feather, seed))
@@ -0,0 +1,323 @@
+"""
+Disk cache of previews and thumbnails
+"""
+
+##
+# @brief Keep small renders of images on disk between sessions.
+#
+# @details This program stores preview proxies and filter thumbnails in a cache directory, so reopening a folder
+# shows its images without decoding the originals again. An entry is addressed by a hash of the image path, its
+# modification time and size, and the recipe which made it, so an image changed on disk is never served stale.
+# Entries of JPEG images are stored as JPEG, so they stay small and only lose what a second compression at
+# JPEG_QUALITY loses. Entries of the other images, which are lossless, are stored as PNG and come back exactly as
+# they were made. Both are behind a short header holding metadata like the full size of the image. The directory
+# is kept under a size cap by evicting the least recently used entries.
+#
+
+from PIL import Image
+
+import hashlib
+import io
+import json
+import logging
+import os
+import struct
+import threading
+
+logger = logging.getLogger()
+
+##
+# @var DEFAULT_BUDGET
+# Default size cap of the cache directory in bytes
+# @hideinitializer
+#
+
+DEFAULT_BUDGET = 256 * 2 ** 20
+
+##
+# @var MAGIC
+# First bytes of a cache entry
+# @hideinitializer
+#
+
+MAGIC = b"IMC1"
+
+##
+# @var JPEG_QUALITY
+# Quality of the entries stored as JPEG
+# @hideinitializer
+#
+
+JPEG_QUALITY = 90
+
+##
+# @var LOSSY_EXTENSIONS
+# Extensions of the images whose entries are stored as JPEG
+# @hideinitializer
+#
+
+LOSSY_EXTENSIONS = (".jpg", ".jpeg")
+
+##
+# @var ENTRY_EXT
+# Extension of the entry files
+# @hideinitializer
+#
+
+ENTRY_EXT = ".imc"
+
+# magic and length of the metadata
+_HEADER = struct.Struct("<4sI")
+
+##
+# @brief Default cache directory
+#
+# @return path imageica directory in the user cache directory of the platform
+#
+
+def default_dir():
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "imageica")
+
+##
+# @brief Encode a cache entry
+#
+# @details
+# Modes neither JPEG nor PNG can store are converted to RGB or RGBA. RGB and L images are stored as JPEG when
+# lossy is set, every other one as PNG.
+#
+# @param[in] img PIL image
+# @param[in] meta Dictionary of JSON values
+# @param[in] lossy Allow JPEG
+# @return data Entry bytes
+#
+
+def encode(img, meta, lossy=True):
+    meta = json.dumps(meta or {}).encode()
+    out = io.BytesIO()
+    out.write(_HEADER.pack(MAGIC, len(meta)))
+    out.write(meta)
+    if img.mode not in ("RGB", "L", "RGBA", "LA", "P", "1"):
+        img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+    if lossy and img.mode in ("RGB", "L"):
+        img.save(out, "JPEG", quality=JPEG_QUALITY)
+    else:
+        img.save(out, "PNG")
+    return out.getvalue()
+
+##
+# @brief Decode a cache entry
+#
+# @param[in] data Entry bytes
+# @return img, meta Loaded PIL image and its metadata
+#
+
+def decode(data):
+    magic, length = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        logger.error("not an image cache entry")
+        raise ValueError("not an image cache entry")
+
+    start = _HEADER.size + length
+    meta = json.loads(data[_HEADER.size:start])
+    img = Image.open(io.BytesIO(data[start:]))
+    img.load()
+    return img, meta
+
+##
+# @brief Disk cache
+#
+# @details
+# This class maps (image path, recipe) pairs to small images on disk. The recipe is any value with a stable repr,
+# e.g. ("preview", 1200). Reading an entry touches its file, so eviction drops the entries unused for the longest
+# time. The directory is scanned once on first use, entries written by other processes later are only counted
+# once they are read. Errors are logged and treated as misses, the cache never makes loading fail. All methods are
+# thread safe.
+#
+
+class DiskCache:
+
+    def __init__(self, root=None, budget=DEFAULT_BUDGET):
+        self.root = root or default_dir()
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+        self._entries = None
+        self.size = 0
+        self._lock = threading.Lock()
+
+    ##
+    # @brief Name of an entry
+    #
+    # @param[in] path Image path
+    # @param[in] recipe Recipe the entry was made with
+    # @return name Hexadecimal digest, None when the image does not exist
+    #
+
+    @staticmethod
+    def entry_name(path, recipe):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key = repr((os.path.abspath(path), stat.st_mtime_ns, stat.st_size, recipe))
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def _entry_path(self, name):
+        return os.path.join(self.root, name[:2], name + ENTRY_EXT)
+
+    def _scan(self):
+        # oldest first, by the time of last use kept in the modification time
+        found = []
+        if os.path.isdir(self.root):
+            for sub in os.scandir(self.root):
+                if not sub.is_dir():
+                    continue
+                for entry in os.scandir(sub.path):
+                    if entry.name.endswith(ENTRY_EXT):
+                        stat = entry.stat()
+                        found.append((stat.st_mtime_ns, entry.name[:-len(ENTRY_EXT)], stat.st_size))
+
+        self._entries = {}
+        self.size = 0
+        for _, name, nbytes in sorted(found):
+            self._entries[name] = nbytes
+            self.size += nbytes
+
+    def _index(self):
+        if self._entries is None:
+            self._scan()
+        return self._entries
+
+    ##
+    # @brief Retrieve an image
+    #
+    # @param[in] path Image path
+    # @param[in] recipe Recipe the entry was made with
+    # @return img, meta Cached image and its metadata, (None, None) on a miss
+    #
+
+    def get(self, path, recipe):
+        name = self.entry_name(path, recipe)
+        if name is None:
+            return None, None
+
+        entry_path = self._entry_path(name)
+        try:
+            with open(entry_path, "rb") as src:
+                data = src.read()
+            img, meta = decode(data)
+            os.utime(entry_path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None, None
+        except Exception as e:
+            logger.warning(f"dropping bad cache entry {entry_path}: {e}")
+            self._remove(name)
+            with self._lock:
+                self.misses += 1
+            return None, None
+
+        with self._lock:
+            self.hits += 1
+            entries = self._index()
+            self.size -= entries.pop(name, 0)
+            entries[name] = len(data)
+            self.size += len(data)
+        return img, meta
+
+    ##
+    # @brief Store an image
+    #
+    # @details
+    # The entry is lossy only for images of LOSSY_EXTENSIONS.
+    #
+    # @param[in] path Image path
+    # @param[in] recipe Recipe the image was made with
+    # @param[in] img PIL image
+    # @param[in] meta Optional dictionary of JSON values returned with the image
+    #
+
+    def put(self, path, recipe, img, meta=None):
+        name = self.entry_name(path, recipe)
+        if name is None:
+            return
+
+        entry_path = self._entry_path(name)
+        part_path = f"{entry_path}.{threading.get_ident()}.part"
+        try:
+            data = encode(img, meta, os.path.splitext(path)[1].lower() in LOSSY_EXTENSIONS)
+            os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+            with open(part_path, "wb") as dst:
+                dst.write(data)
+            os.replace(part_path, entry_path)
+        except Exception as e:
+            logger.warning(f"can't write cache entry {entry_path}: {e}")
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            return
+
+        with self._lock:
+            entries = self._index()
+            self.size -= entries.pop(name, 0)
+            entries[name] = len(data)
+            self.size += len(data)
+            self._evict()
+
+    def _remove(self, name):
+        try:
+            os.remove(self._entry_path(name))
+        except OSError:
+            pass
+        with self._lock:
+            if self._entries is not None and name in self._entries:
+                self.size -= self._entries.pop(name)
+
+    def _evict(self):
+        entries = self._entries
+        while self.size > self.budget and entries:
+            name = next(iter(entries))
+            self.size -= entries.pop(name)
+            try:
+                os.remove(self._entry_path(name))
+            except OSError:
+                pass
+            logger.debug(f"disk cache evict {name}")
+
+    ##
+    # @brief Change the size cap
+    #
+    # @param[in] budget New size cap in bytes
+    #
+
+    def set_budget(self, budget):
+        with self._lock:
+            self.budget = budget
+            self._index()
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            for name in list(self._index()):
+                try:
+                    os.remove(self._entry_path(name))
+                except OSError:
+                    pass
+            self._entries = {}
+            self.size = 0
+
+    ##
+    # @brief Cache statistics
+    #
+    # @return stats Dictionary with entries, size, budget, hits and misses
+    #
+
+    def stats(self):
+        with self._lock:
+            entries = len(self._index())
+        return {"entries": entries, "size": self.size, "budget": self.budget,
+                "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,163 @@
+"""
+Folder index
+"""
+
+##
+# @brief List the images of a folder for browsing.
+#
+# @details This program keeps the images of a folder in a sorted list with a map from name to position, so the
+# viewer can find the current image and step to its neighbours in constant time. The folder is read with
+# os.scandir, which gets the file type from the directory entry without a stat per file. Refreshing is skipped while
+# the modification time of the folder is unchanged, and otherwise only applies the names added or removed since the
+# last scan.
+#
+
+import bisect
+import logging
+import os
+import re
+
+from img_modifier import ima
+from img_modifier import img_helper
+
+logger = logging.getLogger()
+
+##
+# @var EXTENSIONS
+# Extensions of the images the viewer opens
+# @hideinitializer
+#
+
+EXTENSIONS = img_helper.IMAGE_EXTENSIONS + (ima.EXTENSION,)
+
+_DIGITS = re.compile(r"\d+")
+
+# numbers are padded so they compare by value as strings
+_NUMBER_WIDTH = 20
+
+##
+# @brief Sort key of a file name
+#
+# @details
+# Names are compared without case and with their numbers by value, so img2 comes before img10. The name itself
+# breaks ties, which keeps the order stable.
+#
+# @param[in] name File name
+# @return key Sort key, (padded name, name)
+#
+
+def sort_key(name):
+    return _DIGITS.sub(_pad, name.casefold()), name
+
+def _pad(match):
+    return match.group().rjust(_NUMBER_WIDTH, "0")
+
+##
+# @brief Folder index
+#
+# @details
+# This class is a sequence of the image paths of a folder in sort_key order. Indexing and position lookups take
+# constant time.
+#
+
+class FolderIndex:
+
+    def __init__(self, folder=None, extensions=EXTENSIONS):
+        self.folder = folder
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self._names = []
+        self._keys = []
+        self._positions = {}
+        self._mtime = None
+        if folder is not None:
+            self.refresh()
+
+    def __len__(self):
+        return len(self._names)
+
+    def __getitem__(self, index):
+        return os.path.join(self.folder, self._names[index])
+
+    def __iter__(self):
+        return (os.path.join(self.folder, name) for name in self._names)
+
+    def __contains__(self, path):
+        return self.position(path) is not None
+
+    def _scan(self):
+        try:
+            self._mtime = os.stat(self.folder).st_mtime_ns
+            with os.scandir(self.folder) as entries:
+                return {entry.name for entry in entries
+                        if entry.name.lower().endswith(self.extensions) and entry.is_file()}
+        except OSError as e:
+            logger.error(f"can't read the folder {self.folder}: {e}")
+            return set()
+
+    ##
+    # @brief Read the folder again
+    #
+    # @details
+    # Only the names added or removed since the last scan are applied. Few changes are inserted in place, many
+    # changes sort the whole list again.
+    #
+    # @param[in] force Scan even if the modification time of the folder is unchanged
+    # @return changed True if images were added or removed
+    #
+
+    def refresh(self, force=False):
+        if self.folder is None:
+            return False
+        if not force:
+            try:
+                if os.stat(self.folder).st_mtime_ns == self._mtime:
+                    return False
+            except OSError:
+                pass
+
+        found = self._scan()
+        current = set(self._names)
+        added = found - current
+        removed = current - found
+        if not added and not removed:
+            return False
+
+        if len(added) + len(removed) > len(found) // 8:
+            self._keys = sorted(map(sort_key, found))
+            self._names = [key[1] for key in self._keys]
+        else:
+            if removed:
+                kept = [i for i, name in enumerate(self._names) if name not in removed]
+                self._names = [self._names[i] for i in kept]
+                self._keys = [self._keys[i] for i in kept]
+            for name in added:
+                key = sort_key(name)
+                i = bisect.bisect(self._keys, key)
+                self._keys.insert(i, key)
+                self._names.insert(i, name)
+
+        self._positions = {name: i for i, name in enumerate(self._names)}
+        logger.debug(f"index {self.folder}: {len(added)} added, {len(removed)} removed")
+        return True
+
+    ##
+    # @brief Change the folder
+    #
+    # @param[in] folder Folder path
+    #
+
+    def open(self, folder):
+        if folder != self.folder:
+            self.folder = folder
+            self._names, self._keys, self._positions = [], [], {}
+        self.refresh(force=True)
+
+    ##
+    # @brief Position of an image
+    #
+    # @param[in] path Image path, or name, in the folder
+    # @return index Position, None if the image is not indexed
+    #
+
+    def position(self, path):
+        return self._positions.get(os.path.basename(path))
@@ -0,0 +1,432 @@
+"""
+Edit history
+"""
+
+##
+# @brief Undo and redo edits without keeping copies of the image.
+#
+# @details This program keeps the states of an edit as recipe snapshots, which take a few hundred bytes each, so
+# any state can be rebuilt by running its recipe again. To step back and forth without rendering, the rendered
+# frames are kept as patches: the image is split into square tiles and a step only stores the tiles it changed,
+# before and after. Undoing or redoing writes those tiles over the current frame and leaves the others alone.
+#
+# Patches are kept in memory under a budget. Past it, the oldest ones are written to a spill directory, and past
+# the spill budget they are dropped, the steps which lost their patch are rendered from the recipe again.
+#
+
+import itertools
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+
+logger = logging.getLogger()
+
+##
+# @var DEFAULT_BUDGET
+# Default memory budget of the patches in bytes
+# @hideinitializer
+#
+
+DEFAULT_BUDGET = 64 * 2 ** 20
+
+##
+# @var DEFAULT_SPILL_BUDGET
+# Default budget of the patches written to disk in bytes
+# @hideinitializer
+#
+
+DEFAULT_SPILL_BUDGET = 256 * 2 ** 20
+
+##
+# @var DEFAULT_LIMIT
+# Default number of steps kept
+# @hideinitializer
+#
+
+DEFAULT_LIMIT = 100
+
+##
+# @var TILE_SIZE
+# Width and height of the tiles in pixels
+# @hideinitializer
+#
+
+TILE_SIZE = 64
+
+##
+# @brief Changed tiles of two frames
+#
+# @param[in] before uint8 array of shape (height, width) or (height, width, bands)
+# @param[in] after Array of the same shape
+# @param[in] tile Tile size
+# @return tiles List of (top, left) corners of the tiles which differ
+#
+
+def changed_tiles(before, after, tile=TILE_SIZE):
+    diff = before != after
+    if diff.ndim == 3:
+        diff = diff.any(axis=2)
+
+    height, width = diff.shape
+    rows, cols = -(-height // tile), -(-width // tile)
+    padded = np.zeros((rows * tile, cols * tile), dtype=bool)
+    padded[:height, :width] = diff
+    changed = padded.reshape(rows, tile, cols, tile).any(axis=(1, 3))
+    return [(int(r) * tile, int(c) * tile) for r, c in zip(*np.nonzero(changed))]
+
+##
+# @brief Patch of a step
+#
+# @details
+# This class holds the tiles a step changed, as they were before it and after it, in memory or in a spill file,
+# and the shape of the frames it applies to.
+#
+
+class Patch:
+
+    def __init__(self, shape, corners, before, after, tile):
+        self.shape = shape
+        self.corners = corners
+        self.tile = tile
+        self.tiles = (before, after)
+        self.path = None
+        self.nbytes = sum(t.nbytes for t in before) + sum(t.nbytes for t in after)
+
+    ##
+    # @brief Make the patch between two frames
+    #
+    # @param[in] before Frame before the step
+    # @param[in] after Frame after the step
+    # @param[in] tile Tile size
+    # @return patch Patch
+    #
+
+    @classmethod
+    def between(cls, before, after, tile=TILE_SIZE):
+        corners = changed_tiles(before, after, tile)
+        cut = [(slice(top, top + tile), slice(left, left + tile)) for top, left in corners]
+        return cls(after.shape, corners, [before[s].copy() for s in cut], [after[s].copy() for s in cut], tile)
+
+    ##
+    # @brief Write the tiles to a file and free them
+    #
+    # @param[in] path File path
+    #
+
+    def spill(self, path):
+        before, after = self.tiles
+        arrays = {f"b{i}": t for i, t in enumerate(before)}
+        arrays.update({f"a{i}": t for i, t in enumerate(after)})
+        with open(path, "wb") as dst:
+            np.savez(dst, **arrays)
+        self.path = path
+        self.tiles = None
+
+    def _load(self):
+        if self.tiles is not None:
+            return self.tiles
+        with np.load(self.path) as data:
+            count = len(self.corners)
+            return [data[f"b{i}"] for i in range(count)], [data[f"a{i}"] for i in range(count)]
+
+    def drop(self):
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        self.tiles = None
+        self.path = None
+
+    ##
+    # @brief Apply the patch to a frame
+    #
+    # @param[in] frame Frame to write the tiles to, changed in place
+    # @param[in] undo Write the tiles from before the step instead of after it
+    # @return boxes List of (left, top, right, bottom) boxes written
+    #
+
+    def apply(self, frame, undo=False):
+        tiles = self._load()[0 if undo else 1]
+        boxes = []
+        for (top, left), t in zip(self.corners, tiles):
+            frame[top:top + t.shape[0], left:left + t.shape[1]] = t
+            boxes.append((left, top, left + t.shape[1], top + t.shape[0]))
+        return boxes
+
+##
+# @brief Step of the history
+#
+# @details
+# This class holds the recipe of a state and the patch from the previous state's frame, None until both frames
+# were rendered at the same size.
+#
+
+class Step:
+
+    def __init__(self, recipe):
+        self.recipe = recipe
+        self.patch = None
+
+##
+# @brief Undo and redo history
+#
+# @details
+# This class is a list of steps with a position. push adds a state after the position and drops the states which
+# could be redone, undo and redo move the position and give the recipe to restore. Frames are given to attach by
+# whoever renders the states, possibly on another thread: the history keeps the frame of the current state, and
+# when a pushed state gets its frame the tiles changed since the previous one become the patch of the step. Undo
+# and redo then return the frame of the new state too when they can patch it, None when it has to be rendered.
+# All methods are thread safe.
+#
+
+class History:
+
+    def __init__(self, budget=DEFAULT_BUDGET, spill_budget=DEFAULT_SPILL_BUDGET, limit=DEFAULT_LIMIT,
+                 spill_dir=None, tile=TILE_SIZE):
+        self.budget = budget
+        self.spill_budget = spill_budget
+        self.limit = limit
+        self.tile = tile
+        self.size = 0
+        self.spilled = 0
+        self._spill_root = spill_dir
+        self._spill_dir = None
+        self._spill_names = itertools.count()
+        self._steps = []
+        self._position = -1
+        self._frame = None
+        # (position, frame) of the state left by the last push or move, until the current state gets its frame
+        self._previous = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._steps)
+
+    @property
+    def position(self):
+        return self._position
+
+    def can_undo(self):
+        return self._position > 0
+
+    def can_redo(self):
+        return self._position < len(self._steps) - 1
+
+    def current(self):
+        with self._lock:
+            return self._steps[self._position] if self._steps else None
+
+    ##
+    # @brief Forget every state
+    #
+    # @param[in] recipe Optional first state
+    #
+
+    def clear(self, recipe=None):
+        with self._lock:
+            for step in self._steps:
+                self._forget(step)
+            self._steps = []
+            self._position = -1
+            self._frame = self._previous = None
+            if recipe is not None:
+                self.push(recipe)
+
+    ##
+    # @brief Add a state
+    #
+    # @details
+    # The state goes after the current one, the states which could be redone are dropped.
+    #
+    # @param[in] recipe Recipe of the state, copied by the caller
+    # @return step The new step, to pass to attach with its frame
+    #
+
+    def push(self, recipe):
+        with self._lock:
+            for step in self._steps[self._position + 1:]:
+                self._forget(step)
+            del self._steps[self._position + 1:]
+
+            step = Step(recipe)
+            self._steps.append(step)
+            previous = self._position
+
+            while len(self._steps) > max(1, self.limit):
+                self._forget(self._steps.pop(0))
+                # the first step is never undone
+                self._forget(self._steps[0])
+                previous -= 1
+
+            # positions moved down with the steps dropped
+            self._previous = (previous, self._frame) if self._frame is not None and previous >= 0 else None
+            self._frame = None
+            self._position = len(self._steps) - 1
+            return step
+
+    ##
+    # @brief Give the frame of a state
+    #
+    # @details
+    # Frames of states other than the current one are ignored.
+    #
+    # @param[in] step Step the frame was rendered for
+    # @param[in] img PIL image or uint8 array
+    #
+
+    def attach(self, step, img):
+        frame = np.array(img)
+        with self._lock:
+            if step is not self.current():
+                return
+
+            previous, self._previous = self._previous, None
+            if previous is not None and abs(previous[0] - self._position) == 1 and previous[1].shape == frame.shape:
+                # the patch belongs to the later of the two states
+                if previous[0] < self._position:
+                    later, before, after = step, previous[1], frame
+                else:
+                    later, before, after = self._steps[previous[0]], frame, previous[1]
+                if later.patch is None:
+                    patch = Patch.between(before, after, self.tile)
+                    if patch.nbytes <= self.budget:
+                        later.patch = patch
+                        self.size += patch.nbytes
+                        self._trim()
+            self._frame = frame
+
+    def _move(self, offset):
+        with self._lock:
+            # going back undoes the patch of the current step, going forward applies the one of the next step
+            patch = self._steps[self._position].patch if offset < 0 else self._steps[self._position + 1].patch
+            frame, boxes = self._frame, None
+            self._previous = None
+            left = self._position
+            self._position += offset
+
+            # a frame rendered at another size since, e.g. after zooming, can't be patched
+            if (frame is not None and patch is not None and patch.shape == frame.shape
+                    and (patch.tiles is not None or patch.path is not None)):
+                try:
+                    boxes = patch.apply(frame, undo=offset < 0)
+                except (OSError, ValueError) as e:
+                    logger.warning(f"can't read history patch {patch.path}: {e}")
+                    frame = None
+            else:
+                # the render of the new state makes the patch from the frame left
+                self._previous = (left, frame) if frame is not None else None
+                frame = None
+
+            self._frame = frame
+            logger.debug(f"history at {self._position}, {'patched' if frame is not None else 'to render'}")
+            return self._steps[self._position].recipe, frame, boxes
+
+    ##
+    # @brief Step back
+    #
+    # @return recipe, frame, boxes Recipe of the state, its frame and the boxes which changed in it, or None and
+    # None when the frame has to be rendered. The frame is owned by the history and changes on the next move.
+    #
+
+    def undo(self):
+        if not self.can_undo():
+            logger.error("nothing to undo")
+            raise ValueError("nothing to undo")
+        return self._move(-1)
+
+    ##
+    # @brief Step forward
+    #
+    # @return recipe, frame, boxes See undo
+    #
+
+    def redo(self):
+        if not self.can_redo():
+            logger.error("nothing to redo")
+            raise ValueError("nothing to redo")
+        return self._move(1)
+
+    def _forget(self, step):
+        patch = step.patch
+        if patch is None:
+            return
+        if patch.tiles is not None:
+            self.size -= patch.nbytes
+        elif patch.path is not None:
+            self.spilled -= patch.nbytes
+        patch.drop()
+        step.patch = None
+
+    def _spill_path(self):
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix="imageica-history-", dir=self._spill_root)
+        return os.path.join(self._spill_dir, f"{next(self._spill_names)}.npz")
+
+    # spill the patches furthest from the position first, then drop the ones over the spill budget
+    def _trim(self):
+        order = sorted(range(len(self._steps)), key=lambda i: -abs(i - self._position))
+        for i in order:
+            if self.size <= self.budget:
+                break
+            patch = self._steps[i].patch
+            if patch is None or patch.tiles is None:
+                continue
+
+            self.size -= patch.nbytes
+            if self.spilled + patch.nbytes <= self.spill_budget:
+                try:
+                    patch.spill(self._spill_path())
+                    self.spilled += patch.nbytes
+                    continue
+                except OSError as e:
+                    logger.warning(f"can't spill history patch: {e}")
+            patch.drop()
+            self._steps[i].patch = None
+
+        for i in order:
+            if self.spilled <= self.spill_budget:
+                break
+            if self._steps[i].patch is not None and self._steps[i].patch.path is not None:
+                self._forget(self._steps[i])
+
+    ##
+    # @brief Change the budgets
+    #
+    # @param[in] budget Memory budget in bytes
+    # @param[in] spill_budget Disk budget in bytes, unchanged if not given
+    #
+
+    def set_budget(self, budget, spill_budget=None):
+        with self._lock:
+            self.budget = budget
+            if spill_budget is not None:
+                self.spill_budget = spill_budget
+            self._trim()
+
+    ##
+    # @brief Remove the spill directory
+    #
+
+    def close(self):
+        with self._lock:
+            self.clear()
+            if self._spill_dir is not None:
+                shutil.rmtree(self._spill_dir, ignore_errors=True)
+                self._spill_dir = None
+
+    ##
+    # @brief History statistics
+    #
+    # @return stats Dictionary with steps, position, patches, size, budget, spilled and spill_budget
+    #
+
+    def stats(self):
+        with self._lock:
+            patches = sum(step.patch is not None for step in self._steps)
+            return {"steps": len(self._steps), "position": self._position, "patches": patches, "size": self.size,
+                    "budget": self.budget, "spilled": self.spilled, "spill_budget": self.spill_budget}
@@ -0,0 +1,553 @@
+"""
+Encrypted .ima files
+"""
+
+##
+# @brief Encrypt and decrypt images to the .ima format.
+#
+# @details This program streams files through AES in fixed-size chunks, so memory use does not depend on the file
+# size. Files are written in the version 2 container:
+#  - a header with the magic bytes, the version, the scrypt parameters and salt, a random nonce prefix, the chunk
+#    size, the original dimensions and the original extension,
+#  - the file in chunks of chunk_size bytes, each encrypted with AES-256-GCM under the nonce prefix followed by the
+#    chunk index, and followed by its 16 byte tag.
+#
+# Every chunk authenticates the header, its index and whether it is the last one, so chunks can be decrypted and
+# verified on their own, in any order, and a truncated or reordered file is detected.
+#
+# Version 1 files, the AES-128-CBC encryption of an 8 byte extension header followed by the file with key and IV
+# taken from the SHA256 of the password, are still decrypted.
+#
+
+from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import scrypt
+from Crypto.Random import get_random_bytes
+from Crypto.Util.Padding import unpad
+
+from PIL import Image
+
+import logging
+import os
+import re
+import struct
+import threading
+
+logger = logging.getLogger()
+
+##
+# @var CHUNK_SIZE
+# Bytes read and encrypted at a time, a multiple of the AES block size
+# @hideinitializer
+#
+
+CHUNK_SIZE = 1 << 20
+
+##
+# @var EXT_HEADER_SIZE
+# Size of the extension header of version 1 files
+# @hideinitializer
+#
+
+EXT_HEADER_SIZE = 8
+
+##
+# @var EXTENSION
+# Extension of encrypted files
+# @hideinitializer
+#
+
+EXTENSION = ".ima"
+
+##
+# @var MAGIC
+# First bytes of a version 2 file
+# @hideinitializer
+#
+
+MAGIC = b"\x89IMA"
+
+##
+# @var VERSION
+# Version of the container written by this module
+# @hideinitializer
+#
+
+VERSION = 2
+
+##
+# @var KDF_SCRYPT
+# Identifier of the scrypt key derivation in the header
+# @hideinitializer
+#
+
+KDF_SCRYPT = 1
+
+##
+# @var SCRYPT_PARAMS
+# Default scrypt cost as (log2 of N, r, p)
+# @hideinitializer
+#
+
+SCRYPT_PARAMS = (15, 8, 1)
+
+##
+# @var MAX_SCRYPT_LOG_N
+# Highest scrypt cost accepted from a header
+# @hideinitializer
+#
+
+MAX_SCRYPT_LOG_N = 22
+
+##
+# @var MAX_SCRYPT_MEMORY
+# Most memory scrypt may use for parameters from a header, 128 * r * N bytes, so a crafted file can't exhaust the
+# memory
+# @hideinitializer
+#
+
+MAX_SCRYPT_MEMORY = 1 << 30
+
+##
+# @var MAX_SCRYPT_P
+# Highest scrypt parallelism accepted from a header, the derivation time grows with it
+# @hideinitializer
+#
+
+MAX_SCRYPT_P = 16
+
+##
+# @var MAX_CHUNK_SIZE
+# Largest chunk size accepted from a header
+# @hideinitializer
+#
+
+MAX_CHUNK_SIZE = 1 << 26
+
+##
+# @var EXT_PATTERN
+# Extensions stored in a file, short and without separators, so a crafted file can't choose where it is decrypted
+# @hideinitializer
+#
+
+EXT_PATTERN = re.compile(r"[A-Za-z0-9_-]{0,16}")
+
+# sizes in bytes of the salt, the nonce prefix, the AES key and the GCM tag
+SALT_SIZE = 16
+NONCE_PREFIX_SIZE = 8
+KEY_SIZE = 32
+TAG_SIZE = 16
+
+##
+# @var _HEADER
+# Fixed part of the version 2 header, the extension follows it
+# @hideinitializer
+#
+
+_HEADER = struct.Struct("<4sBBBBB16s8sIIIB")
+
+##
+# @brief Raise a decryption error
+#
+# @param[in] msg Message
+#
+
+def _fail(msg):
+    logger.error(msg)
+    raise ValueError(msg)
+
+def _check_ext(ext):
+    if not EXT_PATTERN.fullmatch(ext):
+        _fail(f"unsupported extension {ext!r}")
+    return ext
+
+##
+# @brief Derived key
+#
+# @details
+# This class runs scrypt once for a password and a salt. A key can be reused for every file sharing its salt and
+# parameters, so the costly derivation is not repeated.
+#
+
+class Key:
+
+    def __init__(self, password, salt=None, params=SCRYPT_PARAMS):
+        log_n, r, p = params
+        if not 1 <= log_n <= MAX_SCRYPT_LOG_N or r < 1 or 128 * r << log_n > MAX_SCRYPT_MEMORY:
+            _fail(f"unsupported scrypt cost 2**{log_n} with r={r}")
+        if not 1 <= p <= MAX_SCRYPT_P:
+            _fail(f"unsupported scrypt parallelism {p}")
+
+        self.password = password
+        self.salt = salt if salt is not None else get_random_bytes(SALT_SIZE)
+        self.params = tuple(params)
+        self.key = scrypt(password, self.salt, KEY_SIZE, N=1 << log_n, r=r, p=p)
+
+    def matches(self, header):
+        return self.salt == header.salt and self.params == header.params
+
+##
+# @brief Get a key for a header
+#
+# @param[in] password Password or Key
+# @param[in] header Optional Header the key must match
+# @return key Key
+#
+
+def _as_key(password, header=None):
+    if isinstance(password, Key):
+        if header is None or password.matches(header):
+            return password
+        password = password.password
+    if header is None:
+        return Key(password)
+    return Key(password, header.salt, header.params)
+
+##
+# @brief Version 2 header
+#
+# @details
+# This class holds the header of a version 2 file. Its packed bytes are authenticated by every chunk.
+#
+
+class Header:
+
+    def __init__(self, salt, params=SCRYPT_PARAMS, nonce=None, ext="", size=(0, 0), chunk_size=CHUNK_SIZE):
+        self.salt = salt
+        self.params = tuple(params)
+        self.nonce = nonce if nonce is not None else get_random_bytes(NONCE_PREFIX_SIZE)
+        self.ext = ext
+        self.size = tuple(size)
+        self.chunk_size = chunk_size
+        self.packed = self.pack()
+
+    def pack(self):
+        ext = _check_ext(self.ext).encode()
+        return _HEADER.pack(MAGIC, VERSION, KDF_SCRYPT, *self.params, self.salt, self.nonce, self.chunk_size,
+                            *self.size, len(ext)) + ext
+
+    ##
+    # @brief Parse a header
+    #
+    # @param[in] fixed The first _HEADER.size bytes of the file
+    # @param[in] src Readable binary file object positioned after them
+    # @return header Header
+    #
+
+    @classmethod
+    def parse(cls, fixed, src):
+        if len(fixed) < _HEADER.size:
+            _fail("can't decrypt, the header is truncated")
+        magic, version, kdf, log_n, r, p, salt, nonce, chunk_size, width, height, ext_len = _HEADER.unpack(fixed)
+        if magic != MAGIC:
+            _fail("not a version 2 .ima file")
+        if version != VERSION or kdf != KDF_SCRYPT:
+            _fail(f"unsupported .ima version {version}")
+        if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+            _fail("can't decrypt, the header is damaged")
+
+        ext = src.read(ext_len)
+        if len(ext) < ext_len:
+            _fail("can't decrypt, the header is truncated")
+        return cls(salt, (log_n, r, p), nonce, ext.decode(errors="replace"), (width, height), chunk_size)
+
+    @property
+    def chunk_stride(self):
+        return self.chunk_size + TAG_SIZE
+
+##
+# @brief Read the header of a file
+#
+# @param[in] src Readable binary file object at the start of the file
+# @return header Header, or None for a version 1 file, whose header is encrypted
+#
+
+def read_header(src):
+    fixed = src.read(_HEADER.size)
+    if fixed[:len(MAGIC)] != MAGIC:
+        return None
+    return Header.parse(fixed, src)
+
+##
+# @brief Cipher of one chunk
+#
+# @param[in] key Key
+# @param[in] header Header
+# @param[in] index Chunk index
+# @param[in] last True for the last chunk
+# @return cipher AES-GCM cipher
+#
+
+def _chunk_cipher(key, header, index, last):
+    aes = AES.new(key.key, AES.MODE_GCM, nonce=header.nonce + struct.pack(">I", index))
+    aes.update(header.packed + struct.pack("<IB", index, last))
+    return aes
+
+##
+# @brief Encrypt a stream
+#
+# @details
+# This function reads src in chunks and writes a version 2 file to dst, keeping at most two chunks in memory.
+#
+# @param[in] src Readable binary file object
+# @param[in] dst Writable binary file object
+# @param[in] password Password, or a Key to reuse
+# @param[in] ext Original extension, without the dot
+# @param[in] size Original dimensions, (0, 0) if unknown
+# @param[in] chunk_size Bytes encrypted at a time
+# @param[in] progress Optional function called with the bytes read so far
+# @return header Header written
+#
+
+def encrypt_stream(src, dst, password, ext, size=(0, 0), chunk_size=CHUNK_SIZE, progress=None):
+    key = _as_key(password)
+    header = Header(key.salt, key.params, ext=ext, size=size, chunk_size=chunk_size)
+    dst.write(header.packed)
+
+    # read one chunk ahead to know which chunk is the last
+    data = src.read(chunk_size)
+    done = len(data)
+    index = 0
+    while True:
+        following = src.read(chunk_size) if data else b""
+        last = not following
+        ciphertext, tag = _chunk_cipher(key, header, index, last).encrypt_and_digest(data)
+        dst.write(ciphertext)
+        dst.write(tag)
+        if progress:
+            progress(done)
+        if last:
+            return header
+        data = following
+        done += len(data)
+        index += 1
+
+##
+# @brief Decrypt one chunk
+#
+# @details
+# This function seeks to a chunk and verifies it on its own, without reading the chunks before it.
+#
+# @param[in] src Seekable binary file object
+# @param[in] header Header of the file, see read_header
+# @param[in] password Password, or a Key to reuse
+# @param[in] index Chunk index
+# @return data Plaintext of the chunk
+#
+
+def decrypt_chunk(src, header, password, index):
+    key = _as_key(password, header)
+    offset = len(header.packed) + index * header.chunk_stride
+    src.seek(0, os.SEEK_END)
+    end = src.tell()
+    if offset >= end:
+        _fail(f"chunk {index} is past the end of the file")
+
+    src.seek(offset)
+    return _open_chunk(key, header, index, src.read(header.chunk_stride), offset + header.chunk_stride >= end)
+
+##
+# @brief Verify and decrypt a chunk
+#
+# @param[in] key Key
+# @param[in] header Header
+# @param[in] index Chunk index
+# @param[in] data Encrypted chunk followed by its tag
+# @param[in] last True for the last chunk
+# @return data Plaintext of the chunk
+#
+
+def _open_chunk(key, header, index, data, last):
+    if len(data) < TAG_SIZE:
+        _fail("can't decrypt, the file is truncated")
+    try:
+        return _chunk_cipher(key, header, index, last).decrypt_and_verify(data[:-TAG_SIZE], data[-TAG_SIZE:])
+    except ValueError:
+        _fail("can't decrypt, wrong password or damaged file")
+
+##
+# @brief Decrypt a stream
+#
+# @details
+# This function reads a version 2 or version 1 file from src in chunks and writes the original file to dst. Every
+# chunk of a version 2 file is verified before it is written.
+#
+# @param[in] src Readable binary file object
+# @param[in] dst Writable binary file object
+# @param[in] password Password, or a Key to reuse
+# @param[in] chunk_size Bytes read at a time from version 1 files, a multiple of the AES block size
+# @param[in] progress Optional function called with the bytes read so far
+# @return ext Original extension, without the dot
+#
+
+def decrypt_stream(src, dst, password, chunk_size=CHUNK_SIZE, progress=None):
+    fixed = src.read(_HEADER.size)
+    if fixed[:len(MAGIC)] != MAGIC:
+        if isinstance(password, Key):
+            password = password.password
+        return _decrypt_v1(src, dst, password, chunk_size, progress, fixed)
+
+    header = Header.parse(fixed, src)
+    key = _as_key(password, header)
+
+    data = src.read(header.chunk_stride)
+    done = len(header.packed) + len(data)
+    index = 0
+    while True:
+        following = src.read(header.chunk_stride)
+        last = not following
+        dst.write(_open_chunk(key, header, index, data, last))
+        if progress:
+            progress(done)
+        if last:
+            return header.ext
+        data = following
+        done += len(data)
+        index += 1
+
+##
+# @brief Derive the version 1 key and IV
+#
+# @param[in] password Password
+# @return key_iv Tuple of the 16 byte key and IV
+#
+
+def derive_key_v1(password):
+    digest = SHA256.new(password.encode()).digest()
+    return digest[:16], digest[16:]
+
+##
+# @brief Decrypt a version 1 stream
+#
+# @details
+# The last block is held back until the end of the stream to remove the padding.
+#
+# @param[in] head Bytes already read from src
+#
+
+def _decrypt_v1(src, dst, password, chunk_size, progress, head=b""):
+    key, iv = derive_key_v1(password)
+    aes = AES.new(key, AES.MODE_CBC, iv)
+    header = None
+    held = b""
+    done = 0
+
+    while True:
+        # the bytes read looking for a version 2 header are not a whole number of blocks, complete them
+        data = head + src.read(max(chunk_size - len(head), -len(head) % AES.block_size))
+        head = b""
+        if not data:
+            break
+        done += len(data)
+        if len(data) % AES.block_size:
+            _fail("can't decrypt, the file is not a multiple of the block size")
+
+        plain = held + aes.decrypt(data)
+        plain, held = plain[:-AES.block_size], plain[-AES.block_size:]
+
+        if header is None and len(plain) >= EXT_HEADER_SIZE:
+            header, plain = plain[:EXT_HEADER_SIZE], plain[EXT_HEADER_SIZE:]
+        elif header is None:
+            held = plain + held
+            continue
+        dst.write(plain)
+
+        if progress:
+            progress(done)
+
+    try:
+        plain = unpad(held, AES.block_size)
+    except ValueError:
+        _fail("can't decrypt, wrong password or damaged file")
+
+    if header is None:
+        header, plain = plain[:EXT_HEADER_SIZE], plain[EXT_HEADER_SIZE:]
+    dst.write(plain)
+
+    return header[:EXT_HEADER_SIZE - header[EXT_HEADER_SIZE - 1]].decode()
+
+##
+# @brief Read the dimensions of an image
+#
+# @details
+# Only the image header is read, the pixels are not decoded.
+#
+# @param[in] path Image path
+# @return size (width, height), (0, 0) if the file is not an image PIL knows
+#
+
+def image_size(path):
+    try:
+        with Image.open(path) as img:
+            return img.size
+    except (OSError, ValueError):
+        return 0, 0
+
+##
+# @brief Encrypt a file
+#
+# @details
+# This function writes to a temporary file first, so out_path is either the complete .ima file or left as it was.
+#
+# @param[in] path Image path
+# @param[in] out_path Path of the .ima file
+# @param[in] password Password, or a Key to reuse
+# @param[in] progress Optional function called with the bytes read so far and the file size
+# @return out_path Path of the .ima file
+#
+
+def encrypt_file(path, out_path, password, progress=None):
+    total = os.path.getsize(path)
+    ext = os.path.splitext(path)[1].lstrip(".")
+
+    tmp_path = _part_path(out_path)
+
+    try:
+        with open(path, "rb") as src, open(tmp_path, "wb") as dst:
+            encrypt_stream(src, dst, password, ext, image_size(path),
+                           progress=progress and (lambda done: progress(done, total)))
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    os.replace(tmp_path, out_path)
+    return out_path
+
+# temporary file of a job, unique to the process and thread writing it
+def _part_path(path):
+    return f"{path}.{os.getpid()}-{threading.get_ident()}.part"
+
+##
+# @brief Decrypt a file
+#
+# @details
+# This function writes the original file next to out_base, with its original extension.
+#
+# @param[in] path Path of the .ima file
+# @param[in] out_base Output path without extension
+# @param[in] password Password, or a Key to reuse
+# @param[in] progress Optional function called with the bytes read so far and the file size
+# @return out_path Path of the decrypted file
+#
+
+def decrypt_file(path, out_base, password, progress=None):
+    total = os.path.getsize(path)
+    tmp_path = _part_path(out_base)
+
+    try:
+        with open(path, "rb") as src, open(tmp_path, "wb") as dst:
+            ext = decrypt_stream(src, dst, password, progress=progress and (lambda done: progress(done, total)))
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    try:
+        _check_ext(ext)
+    except ValueError:
+        os.remove(tmp_path)
+        raise
+    out_path = f"{out_base}.{ext}" if ext else out_base
+    os.replace(tmp_path, out_path)
+    return out_path
@@ -9,10 +9,12 @@ Image operations
 #
 
 
-from PIL import Image, ImageEnhance
+from PIL import ExifTags, Image, ImageEnhance
+import io
 import logging
 
 import img_modifier.color_filter as cf
+from img_modifier import lut
 
 ##
 # @brief Logger Function
@@ -88,28 +90,124 @@ HIST_FACTOR_MAX = 2
 
 HIST_FACTOR_MIN = 0.01
 
+##
+# @var IMAGE_EXTENSIONS
+# Extensions of the image files opened from a directory
+# @hideinitializer
+#
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp")
+
 ##
 # @brief Retreive image
 #
 # @details
-# This function opens the image
+# This function opens the image. When a size is given, the image is decoded at a reduced size which still covers
+# it, see load_reduced, otherwise the pixels are decoded when first used.
 #
 # @param[in] path Image path
+# @param[in] size Optional (width, height) box the image will be shown in
 # @return Image Image
 #
 
-def get_img(path):
+def get_img(path, size=None):
 
     if path == "":
         logger.error("path is empty of has bad format")
         raise ValueError("path is empty of has bad format")
 
     try:
-        return Image.open(path)
+        img = Image.open(path)
+        return load_reduced(img, size) if size else img
     except Exception:
         logger.error(f"can't open the file {path}")
         raise ValueError(f"can't open the file {path}")
 
+##
+# @var FULL_SIZE_KEY
+# Key of img.info holding the size of the image before it was decoded at a reduced size
+# @hideinitializer
+#
+
+FULL_SIZE_KEY = "full_size"
+
+##
+# @brief Reduction factor
+#
+# @param[in] img_size (width, height) of the image
+# @param[in] size (width, height) box the image will be shown in
+# @return factor Largest integer factor the image can be divided by and still cover its fit in the box
+#
+
+def reduction_factor(img_size, size):
+    return max(1, int(max(img_size[0] / size[0], img_size[1] / size[1])))
+
+##
+# @brief Decode the EXIF thumbnail
+#
+# @param[in] img Opened JPEG image
+# @param[in] min_size (width, height) the thumbnail must reach
+# @return thumb Thumbnail, None when there is none, it is too small or its aspect ratio differs
+#
+
+def _exif_thumbnail(img, min_size):
+    raw = img.info.get("exif")
+    if not raw or not hasattr(ExifTags, "IFD"):
+        return None
+
+    try:
+        ifd1 = img.getexif().get_ifd(ExifTags.IFD.IFD1)
+        offset, length = ifd1.get(0x0201), ifd1.get(0x0202)
+        if not offset or not length:
+            return None
+        # offsets are counted from the TIFF header, after the "Exif\0\0" marker
+        thumb = Image.open(io.BytesIO(raw[6 + offset:6 + offset + length]))
+        thumb.load()
+    except Exception:
+        return None
+
+    ratio = img.width / img.height
+    if abs(thumb.width / thumb.height - ratio) > ratio / 100 or thumb.width < min_size[0] or thumb.height < min_size[1]:
+        return None
+    return thumb
+
+##
+# @brief Decode an image at a reduced size
+#
+# @details
+# This function decodes an opened image at the smallest size which still covers its fit in the box, which saves
+# most of the decoding time and memory when a preview or a thumbnail is enough:
+#  - the EXIF thumbnail is used when it is big enough and has the same aspect ratio,
+#  - JPEG images are decoded at 1/2, 1/4 or 1/8 scale with draft,
+#  - other images are decoded, then reduced by an integer factor.
+#
+# The size of the image before reduction is kept in img.info[FULL_SIZE_KEY].
+#
+# @param[in] img Opened image, not loaded yet
+# @param[in] size (width, height) box the image will be shown in
+# @return img Loaded image
+#
+
+def load_reduced(img, size):
+    full_size = img.size
+    factor = reduction_factor(full_size, size)
+
+    if factor > 1 and img.format == "JPEG":
+        fit = full_size[0] / factor, full_size[1] / factor
+        thumb = _exif_thumbnail(img, fit)
+        if thumb is not None:
+            img = thumb
+        else:
+            img.draft(img.mode, (-(-full_size[0] // factor), -(-full_size[1] // factor)))
+
+    img.load()
+    factor = reduction_factor(img.size, size)
+    if factor > 1:
+        img = img.reduce(factor)
+
+    img.info[FULL_SIZE_KEY] = full_size
+    return img
+
 ##
 # @brief Resize image
 #
@@ -126,6 +224,27 @@ def resize(img, width, height):
     """Resize image"""
     return img.resize((width, height))
 
+##
+# @brief Downscale image for preview
+#
+# @details
+# This function returns a copy of the image which fits in width x height, keeping the aspect ratio. The image
+# itself is returned when it already fits.
+#
+# @param[in] img Image file
+# @param[in] width Maximum width
+# @param[in] height Maximum height
+# @return img Downscaled image
+#
+
+def proxy(img, width, height):
+    if img.width <= width and img.height <= height:
+        return img
+
+    ratio = min(width / img.width, height / img.height)
+    size = max(1, round(img.width * ratio)), max(1, round(img.height * ratio))
+    return img.resize(size, Image.BILINEAR, reducing_gap=3.0)
+
 ##
 # @brief Rotate image
 #
@@ -160,7 +279,8 @@ def color_filter(img, filter_name):
 # @brief Adjust brightness of image
 #
 # @details
-# This function adjusts the brightness of the supplied image.
+# This function adjusts the brightness of the supplied image, as a single lookup table pass for L, RGB and RGBA
+# images.
 #
 # @param[in] img Image file
 # @param[in] factor Brightness factor
@@ -172,6 +292,9 @@ def brightness(img, factor):
     if factor > BRIGHTNESS_FACTOR_MAX or factor < BRIGHTNESS_FACTOR_MIN:
         raise ValueError("factor should be [0-2]")
 
+    if img.mode in lut.MODES:
+        return lut.PointLUT().brightness(factor).apply(img)
+
     enhancer = ImageEnhance.Brightness(img)
     return enhancer.enhance(factor)
 
@@ -179,7 +302,8 @@ def brightness(img, factor):
 # @brief Adjust contrast of image
 #
 # @details
-# This function adjusts the contrast of the supplied image.
+# This function adjusts the contrast of the supplied image, as a single lookup table pass for L, RGB and RGBA
+# images.
 #
 # @param[in] img Image file
 # @param[in] factor Contrast factor
@@ -191,6 +315,9 @@ def contrast(img, factor):
     if factor > CONTRAST_FACTOR_MAX or factor < CONTRAST_FACTOR_MIN:
         raise ValueError("factor should be [0.5-1.5]")
 
+    if img.mode in lut.MODES:
+        return lut.PointLUT().contrast(factor, lut.mean_gray(img)).apply(img)
+
     enhancer = ImageEnhance.Contrast(img)
     return enhancer.enhance(factor)
 
@@ -264,6 +391,26 @@ def save(img, path):
 def open_img(img):
     img.open()
 
+##
+# @brief Adjust red, green and blue gains of image
+#
+# @details
+# This function scales any subset of the R, G and B channels in a single lookup table pass, values are truncated
+# and clamped to 255. The alpha channel, if any, is kept as is. Images in other modes are converted to RGB first.
+#
+# @param[in] img Image file
+# @param[in] red Red gain
+# @param[in] green Green gain
+# @param[in] blue Blue gain
+# @return img Copy of the image with the adjusted channels
+#
+
+def channel_gains(img, red=1, green=1, blue=1):
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGB")
+
+    return lut.PointLUT().gains(red, green, blue).apply(img)
+
 ##
 # @brief Adjust red histogram of image
 #
@@ -277,12 +424,7 @@ def open_img(img):
 #
 
 def hist_red(img, ratio, ratio_prev):
-    pix = img.load()
-    temp = ratio/ratio_prev
-    for i in range(img.width):
-        for j in range(img.height):
-            pix[i, j] = (int(pix[i, j][0] * temp), pix[i, j][1], pix[i, j][2])
-    return img
+    return channel_gains(img, red=ratio / ratio_prev)
 
 ##
 # @brief Adjust green histogram of image
@@ -297,12 +439,7 @@ def hist_red(img, ratio, ratio_prev):
 #
 
 def hist_green(img, ratio, ratio_prev):
-    pix = img.load()
-    temp = ratio / ratio_prev
-    for i in range(img.width):
-        for j in range(img.height):
-            pix[i, j] = (pix[i, j][0], int(pix[i, j][1] * temp), pix[i, j][2])
-    return img
+    return channel_gains(img, green=ratio / ratio_prev)
 
 ##
 # @brief Adjust blue histogram of image
@@ -317,9 +454,4 @@ def hist_green(img, ratio, ratio_prev):
 #
 
 def hist_blue(img, ratio, ratio_prev):
-    pix = img.load()
-    temp = ratio / ratio_prev
-    for i in range(img.width):
-        for j in range(img.height):
-            pix[i, j] = (pix[i, j][0], pix[i, j][1], int(pix[i, j][2] * temp))
-    return img
+    return channel_gains(img, blue=ratio / ratio_prev)
@@ -0,0 +1,252 @@
+"""
+Image loader
+"""
+
+##
+# @brief Open plain and encrypted images for display.
+#
+# @details This program opens images by path. .ima files are decrypted in memory and decoded from there, so no
+# plaintext is written to disk. The password is given once per folder and the derived key is kept, so the files of
+# a folder encrypted together don't run the key derivation again. Decoded images of both kinds share one
+# ImageCache. Images shown in a smaller box can be decoded at a reduced size, the previews of plain images are
+# also kept in an optional DiskCache across sessions. A Prefetcher decodes the images around the current one ahead
+# of time on background threads.
+#
+
+from PIL import Image
+
+from concurrent.futures import ThreadPoolExecutor
+import io
+import logging
+import os
+import threading
+
+from img_modifier import cache
+from img_modifier import ima
+from img_modifier import img_helper
+
+logger = logging.getLogger()
+
+##
+# @brief Check for an encrypted image
+#
+# @param[in] path Image path
+# @return encrypted True for .ima files
+#
+
+def is_encrypted(path):
+    return os.path.splitext(path)[1].lower() == ima.EXTENSION
+
+##
+# @brief Decrypt a .ima file in memory
+#
+# @param[in] path Path of the .ima file
+# @param[in] password Password or ima.Key
+# @return data BytesIO holding the original file, at position 0
+#
+
+def decrypt_to_memory(path, password):
+    data = io.BytesIO()
+    with open(path, "rb") as src:
+        ima.decrypt_stream(src, data, password)
+    data.seek(0)
+    return data
+
+##
+# @brief Image loader
+#
+# @details
+# This class loads and caches images by path. Cache entries are keyed by path, modification time and size, so an
+# image changed on disk is decoded again. Previews of encrypted images never go to the disk cache.
+#
+
+class ImageLoader:
+
+    def __init__(self, image_cache=None, disk_cache=None):
+        self.cache = image_cache if image_cache is not None else cache.ImageCache()
+        self.disk_cache = disk_cache
+        self._keys = {}
+
+    @staticmethod
+    def _folder(path):
+        return os.path.dirname(os.path.abspath(path))
+
+    ##
+    # @brief Check if a password must be set before loading
+    #
+    # @param[in] path Image path
+    # @return needed True for a .ima file of a folder without password
+    #
+
+    def needs_password(self, path):
+        return is_encrypted(path) and self._folder(path) not in self._keys
+
+    ##
+    # @brief Set the password of the folder of a file
+    #
+    # @param[in] path Path of a file in the folder
+    # @param[in] password Password
+    #
+
+    def set_password(self, path, password):
+        self._keys[self._folder(path)] = password
+
+    def forget_password(self, path):
+        self._keys.pop(self._folder(path), None)
+
+    ##
+    # @brief Get the key of a file
+    #
+    # @details
+    # The key of the folder is derived again only when the file has another salt, and the new key replaces it.
+    #
+    # @param[in] path Path of the .ima file
+    # @return key ima.Key, or the password for version 1 files
+    #
+
+    def _key(self, path):
+        folder = self._folder(path)
+        if folder not in self._keys:
+            logger.error(f"no password set for {folder}")
+            raise ValueError(f"no password set for {folder}")
+
+        with open(path, "rb") as src:
+            header = ima.read_header(src)
+        key = self._keys[folder]
+        if header is None:
+            return key.password if isinstance(key, ima.Key) else key
+
+        if not (isinstance(key, ima.Key) and key.matches(header)):
+            password = key.password if isinstance(key, ima.Key) else key
+            key = ima.Key(password, header.salt, header.params)
+            self._keys[folder] = key
+        return key
+
+    ##
+    # @brief Load an image
+    #
+    # @details
+    # When a size is given the image may be decoded at a reduced size, see img_helper.load_reduced, and cached
+    # under that size. The full resolution image is returned instead when it is cached already. A preview fitting
+    # the size is read from, or written to, the disk cache.
+    #
+    # @param[in] path Image path
+    # @param[in] size Optional (width, height) box the image will be shown in
+    # @return img Decoded PIL image, shared with the cache so it must not be changed
+    #
+
+    def load(self, path, size=None):
+        stat = os.stat(path)
+        cache_key = ("image", os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        img = self.cache.get(cache_key)
+        if img is not None:
+            return img
+        if size is not None:
+            size = tuple(size)
+            cache_key += (size,)
+            img = self.cache.get(cache_key)
+            if img is not None:
+                return img
+
+        use_disk = size is not None and self.disk_cache is not None and not is_encrypted(path)
+        if use_disk:
+            img, meta = self.disk_cache.get(path, ("preview", size))
+            if img is not None:
+                img.info[img_helper.FULL_SIZE_KEY] = tuple(meta["full_size"])
+                self.cache.put(cache_key, img)
+                return img
+
+        if is_encrypted(path):
+            data = decrypt_to_memory(path, self._key(path))
+            try:
+                img = Image.open(data)
+                img = img_helper.load_reduced(img, size) if size is not None else img
+            except Exception:
+                logger.error(f"can't open the decrypted file {path}")
+                raise ValueError(f"can't open the decrypted file {path}")
+        else:
+            img = img_helper.get_img(path, size)
+        img.load()
+
+        if use_disk:
+            full_size = img.info.get(img_helper.FULL_SIZE_KEY, img.size)
+            self.disk_cache.put(path, ("preview", size), img_helper.proxy(img, *size), {"full_size": full_size})
+        self.cache.put(cache_key, img)
+        return img
+
+##
+# @brief Background image prefetcher
+#
+# @details
+# This class warms the cache with the images the user is likely to open next. A new prefetch request cancels the
+# queued ones it doesn't list, so jumping elsewhere doesn't wait for stale work. Loading an image which is being
+# prefetched waits for that decode instead of starting another one.
+#
+
+class Prefetcher:
+
+    def __init__(self, image_loader, workers=2):
+        self.loader = image_loader
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+        self._pending = {}
+        # reentrant, cancelling a future runs _done on the same thread
+        self._lock = threading.RLock()
+
+    ##
+    # @brief Prefetch images
+    #
+    # @details
+    # Encrypted images of a folder without password are skipped. Errors are ignored here, they show up when the
+    # image is opened.
+    #
+    # @param[in] paths Paths, the most likely first
+    # @param[in] warm Function of a path run on the workers, loader.load by default
+    #
+
+    def prefetch(self, paths, warm=None):
+        warm = warm or self.loader.load
+        with self._lock:
+            for path, future in list(self._pending.items()):
+                if path not in paths:
+                    future.cancel()
+
+            for path in paths:
+                if path in self._pending or self.loader.needs_password(path):
+                    continue
+                future = self._executor.submit(self._warm, warm, path)
+                self._pending[path] = future
+                future.add_done_callback(lambda f, path=path: self._done(path, f))
+
+    @staticmethod
+    def _warm(warm, path):
+        try:
+            warm(path)
+        except Exception as e:
+            logger.debug(f"can't prefetch {path}: {e}")
+
+    def _done(self, path, future):
+        with self._lock:
+            if self._pending.get(path) is future:
+                del self._pending[path]
+
+    ##
+    # @brief Cancel the queued prefetches
+    #
+
+    def cancel(self):
+        self.prefetch(())
+
+    ##
+    # @brief Load an image
+    #
+    # @param[in] path Image path
+    # @param[in] size Optional (width, height) box the image will be shown in
+    # @return img Decoded PIL image, see ImageLoader.load
+    #
+
+    def load(self, path, size=None):
+        with self._lock:
+            future = self._pending.get(path)
+        if future is not None and not future.cancel():
+            future.result()
+        return self.loader.load(path, size)
@@ -0,0 +1,251 @@
+"""
+Lookup table composer
+"""
+
+##
+# @brief Combine point operations into one lookup table.
+#
+# @details This program composes any chain of per-channel point operations (brightness, contrast, channel gains,
+# negative, or curves registered by other stages) into one table of 256 entries per band, applied in a single
+# Image.point or NumPy take call.
+#
+
+from PIL import Image, ImageStat
+import logging
+import numpy as np
+
+logger = logging.getLogger()
+
+##
+# @var MEAN_SAMPLE_SIZE
+# Longest side of the reduced image a mean is measured on when other operations come first
+# @hideinitializer
+#
+
+MEAN_SAMPLE_SIZE = 256
+
+##
+# @var MODES
+# Image modes a table can be applied to
+# @hideinitializer
+#
+
+MODES = ("L", "RGB", "RGBA")
+
+##
+# @brief Per-channel lookup table
+#
+# @details
+# This class holds one table of 256 entries for each of the R, G and B bands. Curves are added after the ones
+# already in the table, so building a table follows the order of the operations. Alpha is never changed and "L"
+# images use the red table.
+#
+
+class PointLUT:
+
+    def __init__(self, table=None):
+        if table is None:
+            table = np.tile(np.arange(256, dtype=np.uint8), (3, 1))
+        self.table = np.asarray(table, dtype=np.uint8)
+
+    def copy(self):
+        return PointLUT(self.table.copy())
+
+    def is_identity(self):
+        return bool((self.table == np.arange(256)).all())
+
+    ##
+    # @brief Add a curve
+    #
+    # @details
+    # The curve gets the current values of a band as a uint8 array and returns the new ones, which are clamped to
+    # [0, 255] and truncated.
+    #
+    # @param[in] curve Function of a uint8 array
+    # @param[in] bands Bands the curve applies to, all by default
+    # @return self The table
+    #
+
+    def add_curve(self, curve, bands=(0, 1, 2)):
+        for b in bands:
+            self.table[b] = np.clip(np.asarray(curve(self.table[b]), dtype=np.float64), 0, 255).astype(np.uint8)
+        return self
+
+    ##
+    # @brief Add a PIL point operation
+    #
+    # @details
+    # The operation is run on a 256x1 RGB image holding the table, so the result matches it value for value.
+    #
+    # @param[in] op Function of an RGB image, which must only change pixels by their own values
+    # @return self The table
+    #
+
+    def add_image_op(self, op):
+        ramp = Image.frombytes("RGB", (256, 1), self.table.T.tobytes())
+        out = np.frombuffer(op(ramp).convert("RGB").tobytes(), dtype=np.uint8).reshape(256, 3)
+        self.table = out.T.copy()
+        return self
+
+    ##
+    # @brief Add a brightness change, same as ImageEnhance.Brightness
+    #
+    # @param[in] factor Brightness factor
+    # @return self The table
+    #
+
+    def brightness(self, factor):
+        return self.add_image_op(lambda ramp: Image.blend(Image.new("RGB", ramp.size, 0), ramp, factor))
+
+    ##
+    # @brief Add a contrast change, same as ImageEnhance.Contrast
+    #
+    # @param[in] factor Contrast factor
+    # @param[in] mean Mean gray level of the image, see mean_gray
+    # @return self The table
+    #
+
+    def contrast(self, factor, mean):
+        return self.add_image_op(lambda ramp: Image.blend(Image.new("RGB", ramp.size, (mean,) * 3), ramp, factor))
+
+    ##
+    # @brief Add channel gains, same as img_helper.channel_gains
+    #
+    # @return self The table
+    #
+
+    def gains(self, red=1, green=1, blue=1):
+        for b, gain in enumerate((red, green, blue)):
+            if gain != 1:
+                self.add_curve(lambda v, g=gain: np.minimum(255, (v * g).astype(np.int64)), bands=(b,))
+        return self
+
+    def negative(self):
+        return self.add_curve(lambda v: 255 - v.astype(np.int16))
+
+    ##
+    # @brief Compose with another table
+    #
+    # @param[in] other Table applied after this one
+    # @return lut New table
+    #
+
+    def then(self, other):
+        return PointLUT(np.stack([other.table[b][self.table[b]] for b in range(3)]))
+
+    ##
+    # @brief Table in the layout of Image.point
+    #
+    # @param[in] mode Image mode
+    # @return table Flat list of 256 entries per band
+    #
+
+    def flat(self, mode):
+        if mode == "L":
+            return self.table[0].tolist()
+        table = self.table.reshape(-1).tolist()
+        if mode == "RGBA":
+            table += list(range(256))
+        return table
+
+    ##
+    # @brief Apply the table to an image
+    #
+    # @param[in] img Image in one of MODES
+    # @return img New image
+    #
+
+    def apply(self, img):
+        if img.mode not in MODES:
+            logger.error(f"lookup tables don't support mode {img.mode}")
+            raise ValueError(f"lookup tables don't support mode {img.mode}")
+        return img.point(self.flat(img.mode))
+
+    ##
+    # @brief Apply the table to a pixel array
+    #
+    # @param[in] arr uint8 array of shape (height, width, bands)
+    # @param[in] out Optional output array of the same shape
+    # @return out New array
+    #
+
+    def apply_array(self, arr, out=None):
+        if out is None:
+            out = np.empty_like(arr)
+        for b in range(min(3, arr.shape[2])):
+            np.take(self.table[b], arr[:, :, b], out=out[:, :, b])
+        if arr.shape[2] > 3:
+            out[:, :, 3:] = arr[:, :, 3:]
+        return out
+
+##
+# @brief Mean gray level
+#
+# @details
+# This function measures the mean the way ImageEnhance.Contrast does. When a table comes first, the mean is
+# measured on a reduced copy of the image with the table applied, instead of running the table on the whole image.
+#
+# @param[in] img Image file
+# @param[in] lut Optional table applied before
+# @return mean Mean gray level, rounded
+#
+
+def mean_gray(img, lut=None):
+    if lut is not None and not lut.is_identity():
+        img = lut.apply(img.reduce(max(1, max(img.size) // MEAN_SAMPLE_SIZE)))
+    return int(ImageStat.Stat(img.convert("L")).mean[0] + 0.5)
+
+##
+# @var _curves
+# Registered curves by stage name
+# @hideinitializer
+#
+
+_curves = {}
+
+##
+# @brief Register a curve
+#
+# @details
+# This function lets a stage take part in build. The factory is called with the table built so far, the stage
+# parameter and the image the chain starts from, and adds its curve to the table.
+#
+# @param[in] name Stage name
+# @param[in] factory Function (lut, param, img)
+#
+
+def register_curve(name, factory):
+    _curves[name] = factory
+
+##
+# @brief Check for a registered curve
+#
+# @param[in] name Stage name
+# @return registered True if the stage can be folded in a table
+#
+
+def has_curve(name):
+    return name in _curves
+
+##
+# @brief Build the table of a chain of point operations
+#
+# @param[in] ops List of (name, param) in the order they are applied
+# @param[in] img Image the chain starts from
+# @return lut Table
+#
+
+def build(ops, img):
+    lut = PointLUT()
+    for name, param in ops:
+        if name not in _curves:
+            logger.error(f"no curve registered for {name}")
+            raise ValueError(f"no curve registered for {name}")
+        _curves[name](lut, param, img)
+    return lut
+
+
+register_curve("brightness", lambda lut, factor, img: lut.brightness(factor))
+register_curve("contrast", lambda lut, factor, img: lut.contrast(factor, mean_gray(img, lut)))
+register_curve("gains", lambda lut, gains, img: lut.gains(*gains))
+register_curve("negative", lambda lut, _, img: lut.negative())
@@ -0,0 +1,382 @@
+"""
+Operation pipeline
+"""
+
+##
+# @brief Run the editing operations in order.
+#
+# @details This program applies a set of operations (filter, color pop, brightness, contrast, sharpness, rotation,
+# flip, resize and channel gains) to an image, independently of the GUI.
+#
+
+from functools import partial
+import json
+import logging
+import math
+
+from img_modifier import img_helper
+from img_modifier import color_filter as cf
+from img_modifier import color_pop as cp
+
+logger = logging.getLogger()
+
+##
+# @var DEFAULTS
+# Recipe fields and their default (no change) values
+# @hideinitializer
+#
+
+DEFAULTS = {
+    "color_filter": None,
+    "color_pop": None,
+    "brightness": 0,
+    "contrast": 0,
+    "sharpness": 0,
+    "rotation_angle": 0,
+    "flip_left": False,
+    "flip_top": False,
+    "size": None,
+    "red": 1,
+    "green": 1,
+    "blue": 1,
+}
+
+##
+# @var STAGES
+# Stages in the order they are applied, with the recipe fields each one reads
+# @hideinitializer
+#
+
+STAGES = (
+    ("color_filter", ("color_filter",)),
+    ("color_pop", ("color_pop",)),
+    ("brightness", ("brightness",)),
+    ("contrast", ("contrast",)),
+    ("sharpness", ("sharpness",)),
+    ("rotate", ("rotation_angle",)),
+    ("flip_left", ("flip_left",)),
+    ("flip_top", ("flip_top",)),
+    ("resize", ("size",)),
+    ("gains", ("red", "green", "blue")),
+)
+
+##
+# @brief Edit recipe
+#
+# @details
+# This class holds the operations to apply to an image, one attribute per field of DEFAULTS. color_pop is None,
+# (r, g, b, tolerance, feather) or (r, g, b, tolerance, feather, x, y) with a seed point as fractions of the width
+# and height, see color_pop.color_pop. It round-trips
+# through dictionaries and JSON, validates its parameters against the limits of img_helper and runs without the
+# GUI, so the same recipe can be cached, batched and replayed.
+#
+
+class Recipe:
+
+    def __init__(self, **fields):
+        self.__dict__.update(DEFAULTS)
+        self.update(**fields)
+
+    def __eq__(self, other):
+        return isinstance(other, Recipe) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        changed = {k: v for k, v in self.to_dict().items() if v != DEFAULTS[k]}
+        return f"Recipe({changed})"
+
+    ##
+    # @brief Set fields
+    #
+    # @param[in] fields Operations to change
+    #
+
+    def update(self, **fields):
+        unknown = set(fields) - set(DEFAULTS)
+        if unknown:
+            logger.error(f"unknown operations {sorted(unknown)}")
+            raise ValueError(f"unknown operations {sorted(unknown)}")
+
+        for name in ("size", "color_pop"):
+            if fields.get(name) is not None:
+                if not isinstance(fields[name], (list, tuple)):
+                    _invalid(f"{name} should be a list, got {fields[name]!r}")
+                fields[name] = tuple(fields[name])
+        self.__dict__.update(fields)
+
+    ##
+    # @brief Set every field back to its default
+    #
+
+    def reset(self):
+        self.__dict__.update(DEFAULTS)
+
+    ##
+    # @brief Check for changes
+    #
+    # @return changed True if any field differs from its default
+    #
+
+    def has_changes(self):
+        return any(getattr(self, k) != v for k, v in DEFAULTS.items())
+
+    def copy(self):
+        return type(self)(**self.to_dict())
+
+    ##
+    # @brief Hashable form of the recipe
+    #
+    # @return key Tuple of the field values
+    #
+
+    def key(self):
+        return tuple(getattr(self, k) for k in DEFAULTS)
+
+    ##
+    # @brief Check the parameters
+    #
+    # @details
+    # This function raises ValueError when a field has the wrong type, when a factor is out of the img_helper
+    # limits, 0 meaning "not set" for brightness, contrast and sharpness, or when the filter or the size are
+    # invalid.
+    #
+    # @return self The recipe
+    #
+
+    def validate(self):
+        for name in ("brightness", "contrast", "sharpness", "rotation_angle", "red", "green", "blue"):
+            if not _is_number(getattr(self, name)):
+                _invalid(f"{name} should be a number, got {getattr(self, name)!r}")
+        for name in ("flip_left", "flip_top"):
+            if not isinstance(getattr(self, name), bool):
+                _invalid(f"{name} should be true or false, got {getattr(self, name)!r}")
+        if self.color_filter is not None and not isinstance(self.color_filter, str):
+            _invalid(f"color_filter should be a filter name, got {self.color_filter!r}")
+
+        limits = (("brightness", img_helper.BRIGHTNESS_FACTOR_MIN, img_helper.BRIGHTNESS_FACTOR_MAX),
+                  ("contrast", img_helper.CONTRAST_FACTOR_MIN, img_helper.CONTRAST_FACTOR_MAX),
+                  ("sharpness", img_helper.SHARPNESS_FACTOR_MIN, img_helper.SHARPNESS_FACTOR_MAX))
+        for name, low, high in limits:
+            value = getattr(self, name)
+            if value != 0 and not low <= value <= high:
+                _invalid(f"{name} should be 0 or [{low}-{high}], got {value}")
+
+        for name in ("red", "green", "blue"):
+            value = getattr(self, name)
+            if not img_helper.HIST_FACTOR_MIN <= value <= img_helper.HIST_FACTOR_MAX:
+                _invalid(f"{name} should be [{img_helper.HIST_FACTOR_MIN}-{img_helper.HIST_FACTOR_MAX}], got {value}")
+
+        if self.color_filter not in (None, "none") and self.color_filter not in cf.ColorFilters.filters:
+            _invalid(f"can't find filter {self.color_filter}")
+
+        if self.size is not None and (len(self.size) != 2 or not all(_is_int(v) and v > 0 for v in self.size)):
+            _invalid(f"size should be two positive integers, got {self.size}")
+
+        if self.color_pop is not None and (len(self.color_pop) not in (5, 7)
+                                           or not all(_is_int(v) and 0 <= v <= 255 for v in self.color_pop[:3])
+                                           or not all(_is_number(v) and v >= 0 for v in self.color_pop[3:])
+                                           or not all(v <= 1 for v in self.color_pop[5:])):
+            _invalid(f"color_pop should be (r, g, b, tolerance, feather) or (r, g, b, tolerance, feather, x, y), "
+                     f"got {self.color_pop}")
+
+        return self
+
+    def to_dict(self):
+        data = {k: getattr(self, k) for k in DEFAULTS}
+        for name in ("size", "color_pop"):
+            if data[name] is not None:
+                data[name] = list(data[name])
+        return data
+
+    ##
+    # @brief Build a validated recipe from a dictionary
+    #
+    # @details
+    # Missing fields keep their defaults. Anything but a dictionary of operation names raises ValueError, like
+    # invalid fields, see validate.
+    #
+    # @param[in] data Dictionary of operations
+    # @return recipe Recipe
+    #
+
+    @classmethod
+    def from_dict(cls, data):
+        if not isinstance(data, dict) or not all(isinstance(k, str) for k in data):
+            _invalid(f"recipe should be a dictionary of operations, got {type(data).__name__}")
+        return cls(**data).validate()
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    @classmethod
+    def from_json(cls, text):
+        return cls.from_dict(json.loads(text))
+
+    def stages(self, scale=1.0, skip=()):
+        return get_stages(self, scale, skip)
+
+    def apply(self, img, cache=None, scale=1.0, skip=()):
+        return apply(img, self, cache, scale, skip)
+
+##
+# @brief Report an invalid parameter
+#
+# @param[in] message Error message
+#
+
+def _invalid(message):
+    logger.error(message)
+    raise ValueError(message)
+
+# bool is an int, but true is not a factor
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+##
+# @brief Give the enabled stages of the pipeline
+#
+# @details
+# This function lists the operations in the order they are applied, skipping the ones left at their default.
+#
+# @param[in] ops Operations to apply
+# @param[in] scale Factor applied to the resize target, for running on a proxy of the image
+# @param[in] skip Names of stages to leave out
+# @return stages List of (name, parameter, function) tuples
+#
+
+def get_stages(ops, scale=1.0, skip=()):
+    stages = []
+    if ops.color_filter and ops.color_filter != "none":
+        stages.append(("color_filter", ops.color_filter, partial(img_helper.color_filter,
+                                                                 filter_name=ops.color_filter)))
+
+    if ops.color_pop:
+        r, g, b, tolerance, feather = ops.color_pop[:5]
+        seed = tuple(ops.color_pop[5:]) or None
+        stages.append(("color_pop", ops.color_pop, partial(cp.color_pop, color=(r, g, b), tolerance=tolerance,
+                                                           feather=feather, seed=seed)))
+
+    if ops.brightness != 0:
+        stages.append(("brightness", ops.brightness, partial(img_helper.brightness, factor=ops.brightness)))
+
+    if ops.contrast != 0:
+        stages.append(("contrast", ops.contrast, partial(img_helper.contrast, factor=ops.contrast)))
+
+    if ops.sharpness != 0:
+        stages.append(("sharpness", ops.sharpness, partial(img_helper.sharpness, factor=ops.sharpness)))
+
+    if ops.rotation_angle:
+        stages.append(("rotate", ops.rotation_angle, partial(img_helper.rotate, angle=ops.rotation_angle)))
+
+    if ops.flip_left:
+        stages.append(("flip_left", True, img_helper.flip_left))
+
+    if ops.flip_top:
+        stages.append(("flip_top", True, img_helper.flip_top))
+
+    if ops.size:
+        w, h = ops.size
+        size = max(1, round(w * scale)), max(1, round(h * scale))
+        stages.append(("resize", ops.size, partial(img_helper.resize, width=size[0], height=size[1])))
+
+    gains = ops.red, ops.green, ops.blue
+    if gains != (1, 1, 1):
+        stages.append(("gains", gains, partial(img_helper.channel_gains, red=gains[0], green=gains[1],
+                                               blue=gains[2])))
+
+    return [stage for stage in stages if stage[0] not in skip]
+
+##
+# @brief Map a point of the output back to the input
+#
+# @details
+# This function undoes the geometric stages, resize, flips then rotation, for a point given as fractions of the
+# output width and height. The resize keeps fractions, so the point maps the same on a proxy of the image.
+#
+# @param[in] ops Operations applied
+# @param[in] size (width, height) of the input image
+# @param[in] fx Horizontal position, fraction of the output width
+# @param[in] fy Vertical position, fraction of the output height
+# @return point (x, y) in pixels of the input, None if the point is in a corner added by a rotation
+#
+
+def source_point(ops, size, fx, fy):
+    if ops.flip_top:
+        fy = 1 - fy
+    if ops.flip_left:
+        fx = 1 - fx
+
+    width, height = size
+    angle = math.radians(ops.rotation_angle or 0)
+    cos, sin = math.cos(angle), math.sin(angle)
+    # Image.rotate turns counterclockwise around the center and expands to fit the corners
+    out_width, out_height = abs(width * cos) + abs(height * sin), abs(width * sin) + abs(height * cos)
+    dx, dy = (fx - 0.5) * out_width, (fy - 0.5) * out_height
+    x, y = width / 2 + dx * cos - dy * sin, height / 2 + dx * sin + dy * cos
+
+    if not (0 <= x <= width and 0 <= y <= height):
+        return None
+    return min(int(x), width - 1), min(int(y), height - 1)
+
+##
+# @brief Apply operations to an image
+#
+# @details
+# This function runs the enabled stages in order, see run.
+#
+# @param[in] img PIL image
+# @param[in] ops Operations to apply
+# @param[in] cache Optional ImageCache for intermediate results
+# @param[in] scale Factor applied to the resize target, see get_stages
+# @param[in] skip Names of stages to leave out
+# @return img New image
+#
+
+def apply(img, ops, cache=None, scale=1.0, skip=()):
+    return run(img, get_stages(ops, scale, skip), cache)
+
+##
+# @brief Run stages on an image
+#
+# @details
+# This function runs the stages in order. When a cache is given, the output of every stage is kept in it under a
+# key made of the input image and the parameters of that stage and all the stages before it, and only the stages
+# after the deepest cached one are run.
+#
+# @param[in] img PIL image
+# @param[in] stages List of (name, parameter, function) tuples
+# @param[in] cache Optional ImageCache for intermediate results
+# @return img New image
+#
+
+def run(img, stages, cache=None):
+    if cache is None:
+        for _, _, fn in stages:
+            img = fn(img)
+        return img
+
+    keys = []
+    key = (id(img),)
+    for name, param, _ in stages:
+        key += ((name, param),)
+        keys.append(key)
+
+    # find the deepest stage already computed
+    base = img
+    start = 0
+    for i in range(len(stages) - 1, -1, -1):
+        cached = cache.get(keys[i])
+        if cached is not None:
+            img = cached
+            start = i + 1
+            break
+
+    for i in range(start, len(stages)):
+        img = stages[i][2](img)
+        # the entry keeps base alive so that id(base) can't be reused by another image
+        cache.put(keys[i], img, keep=base)
+
+    logger.debug(f"stage cache: {cache.stats()}")
+    return img
@@ -0,0 +1,226 @@
+"""
+Pipeline planner
+"""
+
+##
+# @brief Reorder and fuse the stages of a recipe.
+#
+# @details This program plans a cheaper equivalent of the stage list of pipeline.get_stages:
+#  - a downscale runs as early as possible, so the other stages work on fewer pixels,
+#  - rotations by multiples of 90 degrees and flips become a single Image.transpose,
+#  - the point operations (negative filter, brightness, contrast, channel gains) become a single lookup table.
+#
+# Geometric stages commute exactly with point operations, so the point operations before sharpness (negative filter,
+# brightness, contrast) are fused in one table, and the channel gains join it when nothing but geometry comes
+# between them. Sharpness and a resize don't commute with point operations: gains which come after either of them
+# stay after them, in their own table.
+#
+# A downscale only moves ahead of the filter and point operations when they are affine and never clip: a filter
+# matrix which keeps every value in range, brightness and contrast factors of at most 1. Averaging pixels then only
+# commutes with them up to the truncation of the values and the contrast mean, measured on a reduced image, so the
+# planned output stays within PLAN_TOLERANCE of the naive order (mean absolute difference, in 8-bit levels).
+# Clipping curves, sharpness, a color pop, the black & white threshold and free rotations keep the resize in its
+# naive place.
+#
+
+from PIL import Image
+
+import logging
+
+from img_modifier import color_filter as cf
+from img_modifier import img_helper
+from img_modifier import lut
+from img_modifier import pipeline
+
+logger = logging.getLogger()
+
+##
+# @var PLAN_TOLERANCE
+# Mean absolute difference with the naive order the planner is designed to stay under, in 8-bit levels
+# @hideinitializer
+#
+
+PLAN_TOLERANCE = 3
+
+##
+# @var TRANSPOSES
+# Image.transpose methods a chain of 90 degree rotations and flips can be fused into
+# @hideinitializer
+#
+
+TRANSPOSES = (Image.FLIP_LEFT_RIGHT, Image.FLIP_TOP_BOTTOM, Image.ROTATE_90, Image.ROTATE_180, Image.ROTATE_270,
+              Image.TRANSPOSE, Image.TRANSVERSE)
+
+##
+# @brief Fuse rotation and flips
+#
+# @details
+# This function finds the single transpose equivalent to rotating by a multiple of 90 degrees then flipping, by
+# running both on a small image with distinct pixels.
+#
+# @param[in] angle Rotation angle
+# @param[in] flip_left Flip left-right
+# @param[in] flip_top Flip top-bottom
+# @return method Image.transpose method, None for no change, False if the angle is not a multiple of 90
+#
+
+def fuse_geometry(angle, flip_left, flip_top):
+    if angle % 90:
+        return False
+
+    probe = Image.frombytes("L", (3, 2), bytes(range(6)))
+    expected = probe
+    if angle:
+        expected = img_helper.rotate(expected, angle)
+    if flip_left:
+        expected = img_helper.flip_left(expected)
+    if flip_top:
+        expected = img_helper.flip_top(expected)
+
+    if expected.tobytes() == probe.tobytes() and expected.size == probe.size:
+        return None
+    for method in TRANSPOSES:
+        candidate = probe.transpose(method)
+        if candidate.size == expected.size and candidate.tobytes() == expected.tobytes():
+            return method
+
+##
+# @brief Fused point operations stage
+#
+# @details
+# This class applies a chain of point operations as one lookup table, see lut.build.
+#
+
+class PointStage:
+
+    def __init__(self, ops):
+        self.ops = list(ops)
+
+    def __call__(self, img):
+        return lut.build(self.ops, img).apply(img)
+
+##
+# @brief Check a filter commutes with a downscale
+#
+# @details
+# A filter does when it is a color matrix without a threshold whose outputs stay in [0, 255] for any input, so
+# it is affine and never clips.
+#
+# @param[in] filter_name Name of filter
+# @return affine True if a downscale can run before the filter
+#
+
+def _is_affine_filter(filter_name):
+    matrix = cf.ColorFilters.matrices.get(filter_name)
+    if matrix is None or filter_name in cf.ColorFilters.thresholds:
+        return False
+    for row in matrix:
+        offset = row[3] if len(row) > 3 else 0
+        low = offset + 255 * sum(min(0, w) for w in row[:3])
+        high = offset + 255 * sum(max(0, w) for w in row[:3])
+        if low < 0 or high > 255 + 1e-6:
+            return False
+    return True
+
+##
+# @brief Plan the stages of a recipe
+#
+# @details
+# This function returns a list of stages, in the format of pipeline.get_stages, which gives the same result as
+# the naive order within PLAN_TOLERANCE.
+#
+# @param[in] ops Operations to apply
+# @param[in] size Size of the input image
+# @param[in] scale Factor applied to the resize target, see pipeline.get_stages
+# @param[in] skip Names of stages to leave out
+# @return stages List of (name, parameter, function) tuples
+#
+
+def plan(ops, size, scale=1.0, skip=()):
+    naive = {name: (param, fn) for name, param, fn in pipeline.get_stages(ops, scale, skip)}
+
+    geometry = fuse_geometry(ops.rotation_angle if "rotate" in naive else 0,
+                             "flip_left" in naive, "flip_top" in naive)
+
+    # fold the point operations, in their naive order
+    points = []
+    matrix = None
+    if "color_filter" in naive:
+        # the color is picked after the filter, so the filter can't move past the color pop
+        if naive["color_filter"][0] == cf.ColorFilters.NEGATIVE and "color_pop" not in naive:
+            points.append(("negative", None))
+        else:
+            matrix = ("color_filter",) + naive["color_filter"]
+    for name in ("brightness", "contrast"):
+        if name in naive and lut.has_curve(name):
+            points.append((name, naive[name][0]))
+
+    # decide where the resize goes
+    resize_first = resize_last = None
+    if "resize" in naive:
+        target = naive["resize"][1].keywords["width"], naive["resize"][1].keywords["height"]
+        swap = geometry in (Image.ROTATE_90, Image.ROTATE_270, Image.TRANSPOSE, Image.TRANSVERSE)
+        pre_size = (target[1], target[0]) if swap else target
+
+        downscale = pre_size[0] * pre_size[1] < size[0] * size[1]
+        barrier = "sharpness" in naive or "color_pop" in naive or geometry is False \
+            or (matrix is not None and not _is_affine_filter(matrix[1])) \
+            or any(name in ("brightness", "contrast") and param > 1 for name, param in points)
+        if downscale and not barrier:
+            resize_first = ("resize", naive["resize"][0],
+                            lambda img: img_helper.resize(img, *pre_size))
+        else:
+            resize_last = ("resize",) + naive["resize"]
+
+    # gains come after sharpness and the resize in the naive order
+    late_points = []
+    if "gains" in naive:
+        if "sharpness" in naive or resize_last:
+            late_points.append(("gains", naive["gains"][0]))
+        else:
+            points.append(("gains", naive["gains"][0]))
+
+    stages = []
+    if resize_first:
+        stages.append(resize_first)
+    if matrix:
+        stages.append(matrix)
+    if "color_pop" in naive:
+        stages.append(("color_pop",) + naive["color_pop"])
+    if points:
+        stages.append(("points", tuple(points), PointStage(points)))
+    if "sharpness" in naive:
+        stages.append(("sharpness",) + naive["sharpness"])
+
+    if geometry is False:
+        stages.extend((name,) + naive[name] for name in ("rotate", "flip_left", "flip_top") if name in naive)
+    elif geometry is not None:
+        stages.append(("transpose", geometry, lambda img: img.transpose(geometry)))
+
+    if resize_last:
+        stages.append(resize_last)
+    if late_points:
+        stages.append(("points", tuple(late_points), PointStage(late_points)))
+
+    logger.debug(f"planned stages: {[stage[0] for stage in stages]}")
+    return stages
+
+##
+# @brief Apply operations with the planned stages
+#
+# @details
+# This function falls back to the naive order for images which are not RGB or RGBA.
+#
+# @param[in] img PIL image
+# @param[in] ops Operations to apply
+# @param[in] cache Optional ImageCache for intermediate results
+# @param[in] scale Factor applied to the resize target, see pipeline.get_stages
+# @param[in] skip Names of stages to leave out
+# @return img New image
+#
+
+def apply(img, ops, cache=None, scale=1.0, skip=()):
+    if img.mode not in ("RGB", "RGBA"):
+        return pipeline.apply(img, ops, cache, scale, skip)
+
+    return pipeline.run(img, plan(ops, img.size, scale, skip), cache)
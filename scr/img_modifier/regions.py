@@ -0,0 +1,156 @@
+"""
+Connected regions
+"""
+
+##
+# @brief Label the connected regions of a mask.
+#
+# @details This program finds the 4-connected regions of a boolean mask without a per-pixel loop. Every row is
+# split into runs of set pixels, runs of adjacent rows which overlap are linked, and the links are merged with a
+# vectorized union-find: every round hooks the larger root of each linked pair under the smaller one, then
+# compresses the paths by pointer jumping. Finding the runs and the links takes a few passes over the pixels, the
+# union-find depends on the number of runs. Color pop masks of photos have few runs and take about 0.2 s at 20 MP,
+# mostly in the passes over the pixels. The worst masks, noise or one pixel wide stripes with millions of runs,
+# take one to two seconds, see tools/bench_regions.py.
+#
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger()
+
+##
+# @brief Runs of a mask
+#
+# @details
+# This class holds the runs of set pixels of a mask, sorted by row then column, and their region labels once
+# labelled. Positions are keys in the mask with a blank column appended, row * (width + 1) + column, so a run
+# covers the keys [start, end) and never reaches the next row.
+#
+
+class Runs:
+
+    def __init__(self, mask):
+        mask = np.asarray(mask, dtype=bool)
+        if mask.ndim != 2:
+            logger.error(f"mask should be 2D, got shape {mask.shape}")
+            raise ValueError(f"mask should be 2D, got shape {mask.shape}")
+
+        self.shape = mask.shape
+        self.stride = mask.shape[1] + 1
+
+        # one blank pixel before the first row and one after every row, so changes alternate between starts and ends
+        flat = np.zeros(mask.shape[0] * self.stride + 1, dtype=bool)
+        flat[1:].reshape(mask.shape[0], self.stride)[:, :-1] = mask
+        changes = np.flatnonzero(flat[1:] != flat[:-1]).astype(np.int32)
+        self.starts = changes[0::2]
+        self.ends = changes[1::2]
+        self.labels = None
+        self._keys = flat[1:]
+
+    def __len__(self):
+        return len(self.starts)
+
+    ##
+    # @brief Links between runs
+    #
+    # @return u, v Indices of the runs of every pair of overlapping runs in adjacent rows
+    #
+
+    def links(self):
+        height = self.shape[0]
+        keys = self._keys
+
+        # two overlapping runs share exactly one segment of set pixels in both rows, keyed in the lower row
+        both = np.zeros(len(keys) + 1, dtype=bool)
+        np.logical_and(keys[self.stride:], keys[:-self.stride], out=both[1 + self.stride:])
+        segments = np.flatnonzero(both[1:] & ~both[:-1])
+
+        # run of every key, valid where the mask is set
+        run_of = np.zeros(height * self.stride, dtype=np.int32)
+        run_of[self.starts] = 1
+        np.cumsum(run_of, out=run_of)
+        run_of -= 1
+        return run_of[segments], run_of[segments - self.stride]
+
+    ##
+    # @brief Label the runs
+    #
+    # @details
+    # The label of a region is the index of its first run.
+    #
+    # @return labels Label of every run
+    #
+
+    def label(self):
+        if self.labels is not None:
+            return self.labels
+
+        parent = np.arange(len(self), dtype=np.int32)
+        u, v = self.links()
+        while len(u):
+            pu, pv = parent[u], parent[v]
+            split = pu != pv
+            if not split.any():
+                break
+            u, v, pu, pv = u[split], v[split], pu[split], pv[split]
+            # a root linked to several others goes under the smallest, so stars merge in one round
+            np.minimum.at(parent, np.maximum(pu, pv), np.minimum(pu, pv))
+
+            while True:
+                grand = parent[parent]
+                if np.array_equal(grand, parent):
+                    break
+                parent = grand
+
+        self.labels = parent
+        return parent
+
+    ##
+    # @brief Run at a point
+    #
+    # @param[in] x Column
+    # @param[in] y Row
+    # @return index Index of the run covering the point, None if the pixel is not set
+    #
+
+    def find(self, x, y):
+        key = y * self.stride + x
+        i = np.searchsorted(self.starts, key, side="right") - 1
+        if i < 0 or self.ends[i] <= key:
+            return None
+        return int(i)
+
+    ##
+    # @brief Paint runs
+    #
+    # @param[in] selected Boolean array, True for the runs to paint
+    # @return mask Boolean array of the mask shape
+    #
+
+    def paint(self, selected):
+        height, width = self.shape
+        steps = np.zeros(height * self.stride + 1, dtype=np.int8)
+        steps[self.starts[selected]] = 1
+        steps[self.ends[selected]] = -1
+        painted = np.cumsum(steps[:-1], dtype=np.int8).view(bool)
+        return painted.reshape(height, self.stride)[:, :width]
+
+##
+# @brief Region of a point
+#
+# @param[in] mask 2D boolean array
+# @param[in] x Column of the point
+# @param[in] y Row of the point
+# @return region Boolean array, True for the pixels 4-connected to the point, all False if the point is not set
+#
+
+def connected_region(mask, x, y):
+    runs = Runs(mask)
+    seed = runs.find(x, y)
+    if seed is None:
+        return np.zeros(runs.shape, dtype=bool)
+
+    labels = runs.label()
+    return runs.paint(labels == labels[seed])
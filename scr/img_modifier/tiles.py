@@ -0,0 +1,304 @@
+"""
+Tiled rendering
+"""
+
+##
+# @brief Run the stages of a recipe tile by tile on large images.
+#
+# @details This program splits an image into fixed-size tiles and runs the pixel-wise stages (color filters,
+# brightness, contrast, channel gains, fused lookup tables) and the neighbourhood ones (sharpness) on one tile at
+# a time, pasting every result into the output image. Consecutive tileable stages run back to back on a tile, so
+# they never make a full-size intermediate image, and the NumPy temporaries, like the float32 accumulators of the
+# color matrices, only ever cover a tile. Memory is then the input and the output images plus a constant, instead
+# of several bytes per pixel and per stage.
+#
+# A neighbourhood stage reads pixels around the ones it writes. Its tiles are cut with a halo of that many pixels,
+# which is cropped away after the stage, so tile seams never show. Stages which depend on the whole image, like
+# the mean gray level of contrast, get their parameters measured on their input before the tiles run. When that
+# input only exists tile by tile, the stages before run over the tiles once more to measure it, without keeping
+# the tiles, so the output is the same as the whole-image render. The other stages (rotation, flips, resize, color
+# pop) run on the whole image as usual.
+#
+# Tiles are rendered by a pool of threads. The heavy work of every stage happens in PIL or NumPy C code which
+# releases the GIL, so the threads use all the cores on one image. The results are pasted by the calling thread,
+# in order, and only a few tiles per thread are in flight at once, which keeps the memory bounded.
+#
+
+from PIL import Image, ImageStat
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+
+from img_modifier import lut
+from img_modifier import pipeline
+
+logger = logging.getLogger()
+
+##
+# @var TILE_SIZE
+# Width and height of the tiles in pixels
+# @hideinitializer
+#
+
+TILE_SIZE = 512
+
+##
+# @var TILED_PIXELS
+# Image size from which the editor and the batch jobs render tile by tile
+# @hideinitializer
+#
+
+TILED_PIXELS = 24 * 10 ** 6
+
+##
+# @var DEFAULT_WORKERS
+# Threads rendering the tiles, one per core
+# @hideinitializer
+#
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+##
+# @var TILES_PER_WORKER
+# Tiles queued per thread, rendered but not pasted yet
+# @hideinitializer
+#
+
+TILES_PER_WORKER = 2
+
+##
+# @var _stages
+# Tileable stages by name, as (halo, prepare, measure)
+# @hideinitializer
+#
+
+_stages = {}
+
+##
+# @brief Register a tileable stage
+#
+# @details
+# This function lets a stage of pipeline.get_stages run tile by tile. When the stage depends on
+# the whole image, measure is called on every tile of its input, and prepare with the stage function, its
+# parameter and the list of measures. prepare returns the function to run on every tile, or None if this input
+# can't be tiled.
+#
+# @param[in] name Stage name
+# @param[in] halo Pixels around a tile the stage reads, 0 for a point operation
+# @param[in] prepare Optional function (fn, param, measures)
+# @param[in] measure Function of an image, required with prepare
+#
+
+def register_stage(name, halo=0, prepare=None, measure=None):
+    if (prepare is None) != (measure is None):
+        logger.error(f"stage {name} needs both prepare and measure, or neither")
+        raise ValueError(f"stage {name} needs both prepare and measure, or neither")
+    _stages[name] = (halo, prepare, measure)
+
+##
+# @brief Check for a tileable stage
+#
+# @param[in] name Stage name
+# @return registered True if the stage can run tile by tile
+#
+
+def is_tileable(name):
+    return name in _stages
+
+##
+# @brief Split an image into tiles
+#
+# @param[in] size (width, height) of the image
+# @param[in] tile Tile size
+# @return boxes List of (left, top, right, bottom) tiles, row by row
+#
+
+def boxes(size, tile=TILE_SIZE):
+    width, height = size
+    return [(left, top, min(left + tile, width), min(top + tile, height))
+            for top in range(0, height, tile) for left in range(0, width, tile)]
+
+##
+# @brief Run a function tile by tile
+#
+# @details
+# The function must keep the size of the tiles and be safe to call from several threads. Every tile is cut with
+# halo more pixels on each side, where the image has them, and the halo is cropped from the result.
+#
+# @param[in] img PIL image
+# @param[in] fn Function from image to image
+# @param[in] halo Pixels around a tile fn reads
+# @param[in] tile Tile size
+# @param[in] workers Number of threads, DEFAULT_WORKERS by default, 1 renders on the calling thread
+# @return img New image
+#
+
+def map_tiles(img, fn, halo=0, tile=TILE_SIZE, workers=None):
+    out = None
+    for box, result in _render(img, fn, halo, tile, workers):
+        if out is None:
+            out = Image.new(result.mode, img.size)
+        out.paste(result, box[:2])
+    return out if out is not None else fn(img)
+
+##
+# @brief Measure the output of a function tile by tile
+#
+# @details
+# This function runs fn like map_tiles, but only keeps measure of every tile instead of the tiles.
+#
+# @param[in] img PIL image
+# @param[in] fn Function from image to image
+# @param[in] measure Function of an image
+# @param[in] halo Pixels around a tile fn reads
+# @param[in] tile Tile size
+# @param[in] workers Number of threads, see map_tiles
+# @return measures List of the measures, row by row
+#
+
+def measure_tiles(img, fn, measure, halo=0, tile=TILE_SIZE, workers=None):
+    return [measure(result) for _, result in _render(img, fn, halo, tile, workers)]
+
+# yield (box, result) for every tile, in order
+def _render(img, fn, halo, tile, workers):
+    workers = DEFAULT_WORKERS if workers is None else workers
+    if tile <= 0 or workers < 1:
+        logger.error(f"tile size and workers should be positive, got {tile} and {workers}")
+        raise ValueError(f"tile size and workers should be positive, got {tile} and {workers}")
+
+    # crops from several threads must not race to load the image
+    img.load()
+    todo = boxes(img.size, tile)
+
+    def render(box):
+        outer = (max(0, box[0] - halo), max(0, box[1] - halo),
+                 min(img.width, box[2] + halo), min(img.height, box[3] + halo))
+        result = fn(img.crop(outer))
+        if result.size != (outer[2] - outer[0], outer[3] - outer[1]):
+            logger.error(f"tiled functions must keep the size, got {result.size} for a tile of {outer}")
+            raise ValueError(f"tiled functions must keep the size, got {result.size} for a tile of {outer}")
+
+        inner = (box[0] - outer[0], box[1] - outer[1], box[2] - outer[0], box[3] - outer[1])
+        return result.crop(inner) if inner != (0, 0) + result.size else result
+
+    if workers == 1 or len(todo) <= 1:
+        for box in todo:
+            yield box, render(box)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tile") as pool:
+        pending = deque()
+        for box in todo:
+            pending.append((box, pool.submit(render, box)))
+            if len(pending) >= workers * TILES_PER_WORKER:
+                done, future = pending.popleft()
+                yield done, future.result()
+        while pending:
+            done, future = pending.popleft()
+            yield done, future.result()
+
+def _chain(fns):
+    def run(img):
+        for fn in fns:
+            img = fn(img)
+        return img
+    return run
+
+##
+# @brief Run stages tile by tile where possible
+#
+# @details
+# Consecutive tileable stages are grouped and run on every tile in one go, with the sum of their halos. A stage
+# with a prepare function in the middle of a group is measured on the tiles of the stages before it, see
+# measure_tiles, instead of making its whole input.
+#
+# @param[in] img PIL image
+# @param[in] stages List of (name, parameter, function) tuples
+# @param[in] tile Tile size
+# @param[in] workers Number of threads, see map_tiles
+# @return img New image
+#
+
+def run(img, stages, tile=TILE_SIZE, workers=None):
+    group, halo = [], 0
+    for name, param, fn in stages:
+        halo_of, prepare, measure = _stages.get(name, (None, None, None))
+        tile_fn = fn
+        if prepare is not None:
+            measures = measure_tiles(img, _chain(group), measure, halo, tile, workers) if group else [measure(img)]
+            tile_fn = prepare(fn, param, measures)
+
+        if halo_of is None or tile_fn is None:
+            if group:
+                img = map_tiles(img, _chain(group), halo, tile, workers)
+                group, halo = [], 0
+            img = fn(img)
+        else:
+            group.append(tile_fn)
+            halo += halo_of
+
+    if group:
+        img = map_tiles(img, _chain(group), halo, tile, workers)
+    return img
+
+##
+# @brief Apply operations tile by tile
+#
+# @details
+# This function runs the stages of pipeline.get_stages, in their naive order, so the output is the same as the
+# one of pipeline.apply, see run.
+#
+# @param[in] img PIL image
+# @param[in] ops Operations to apply
+# @param[in] scale Factor applied to the resize target, see pipeline.get_stages
+# @param[in] skip Names of stages to leave out
+# @param[in] tile Tile size
+# @param[in] workers Number of threads, see map_tiles
+# @return img New image
+#
+
+def apply(img, ops, scale=1.0, skip=(), tile=TILE_SIZE, workers=None):
+    return run(img, pipeline.get_stages(ops, scale, skip), tile, workers)
+
+##
+# @brief Check if an image is worth tiling
+#
+# @param[in] img PIL image
+# @return tiled True if the image has at least TILED_PIXELS pixels
+#
+
+def should_tile(img):
+    return img.width * img.height >= TILED_PIXELS
+
+##
+# @brief Prepare a contrast stage
+#
+# @details
+# The mean gray level is summed over the measures of the tiles, so it is the one ImageEnhance.Contrast measures on
+# the whole image.
+#
+# @param[in] fn Stage function
+# @param[in] factor Contrast factor
+# @param[in] measures List of (mode, sum, count) of the tiles
+# @return fn Function to run on every tile, None if the mode has no lookup table
+#
+
+def _prepare_contrast(fn, factor, measures):
+    if any(mode not in lut.MODES for mode, _, _ in measures):
+        return None
+    total = sum(s for _, s, _ in measures)
+    count = sum(c for _, _, c in measures)
+    return lut.PointLUT().contrast(factor, int(total / max(1, count) + 0.5)).apply
+
+def _measure_gray(img):
+    return img.mode, ImageStat.Stat(img.convert("L")).sum[0], img.width * img.height
+
+
+register_stage("color_filter")
+register_stage("brightness")
+register_stage("gains")
+# ImageEnhance.Sharpness blends with a 3x3 smoothing of the image
+register_stage("sharpness", halo=1)
+register_stage("contrast", prepare=_prepare_contrast, measure=_measure_gray)
@@ -3,27 +3,32 @@ Base program
 '''
 import sys
 
-from Crypto.Hash import SHA256
-from Crypto.Cipher import AES
-from Crypto.Util.Padding import pad, unpad
-
 from PyQt5 import QtWidgets, QtCore, QtGui
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import *
 from PyQt5.QtCore import QFileInfo
 
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
 from img_modifier import img_helper
 from img_modifier import color_filter
-
-from PIL import ImageQt
-from PIL import Image
+from img_modifier import color_pop
+from img_modifier import batch
+from img_modifier import cache
+from img_modifier import disk_cache
+from img_modifier import folder_index
+from img_modifier import history
+from img_modifier import pipeline
+from img_modifier import ima
+from img_modifier import loader
+from img_modifier import tiles
+import qt_bridge
 
 from logging.config import fileConfig
 import logging
-import numpy as np
+import copy
 import os, os.path
 
 logger = logging.getLogger()
@@ -32,6 +37,8 @@ logger = logging.getLogger()
 _img_original = None
 _img_preview = None
 _img_path = None
+# size of the original img, which may be decoded smaller until full resolution is needed
+_full_size = None
 
 # constants
 THUMB_BORDER_COLOR_ACTIVE = "#3893F4"
@@ -44,85 +51,51 @@ SLIDER_MIN_VAL = -99
 SLIDER_MAX_VAL = 100
 SLIDER_DEF_VAL = 0
 
-##
-# @brief Class for image ooperations
-#
-# @details
-# This class defines operations on images
-#
-class Operations:
+# tolerance and feather of the color pop, in delta E
+COLOR_POP_SLIDER_MAX = 100
 
-##
-# @brief Initalization of Class Operations.
-#
-# @details
-# This function applies initialises default values to Class Operations.
-#
-# @param[in] class of _main_.(ClassName)
-# @return Void
-    def __init__(self):
-        self.color_filter = None
+# holds the stage outputs, the current image and the prefetched ones, a 20 MP image takes 60 MB
+STAGE_CACHE_BUDGET = 512 * 2 ** 20
 
-        self.flip_left = False
-        self.flip_top = False
-        self.rotation_angle = 0
+# previews and filter thumbnails kept on disk across sessions
+DISK_CACHE_BUDGET = 256 * 2 ** 20
 
-        self.size = None
+# tiles of the previews changed by the edits, kept to undo and redo without rendering, spilled to disk past it
+HISTORY_BUDGET = 64 * 2 ** 20
 
-        self.brightness = 0
-        self.sharpness = 0
-        self.contrast = 0
+# delay between a change in the folder and reading it again, copying many files changes it many times
+FOLDER_REFRESH_MS = 300
 
-        self.red = 1
-        self.green = 1
-        self.blue = 1
+# images decoded ahead in the browsing direction and behind it
+PREFETCH_AHEAD = 2
+PREFETCH_BEHIND = 1
 
-        self.red_prev = 1
-        self.green_prev = 1
-        self.blue_prev = 1
+# output of every stage, keyed by its parameters and the parameters of the stages before it
+_stage_cache = cache.ImageCache(STAGE_CACHE_BUDGET)
 
-##
-# @brief Resetting of Class Operations.
-#
-# @details
-# This function initialise back default values to Class Operations.
-#
-# @param[in] class of _main_.(ClassName)
-# @return Void
-    def reset(self):
-        self.color_filter = None
+_disk_cache = disk_cache.DiskCache(budget=DISK_CACHE_BUDGET)
 
-        self.brightness = 0
-        self.sharpness = 0
-        self.contrast = 0
+# decoded images share the budget of the stage cache
+_loader = loader.ImageLoader(_stage_cache, _disk_cache)
 
-        self.size = None
+# buffers of the rendered previews
+_frames = qt_bridge.FramePool()
 
-        self.flip_left = False
-        self.flip_top = False
-        self.rotation_angle = 0
+# decodes the neighbours of the current image
+_prefetcher = loader.Prefetcher(_loader)
 
-        self.red = 1
-        self.green = 1
-        self.blue = 1
-
-        self.red_prev = 1
-        self.green_prev = 1
-        self.blue_prev = 1
+# states of the operations on the current image and the preview tiles each one changed
+_history = history.History(HISTORY_BUDGET)
 
 ##
-# @brief Check changes in Image.
+# @brief Class for image ooperations
 #
 # @details
-# This function check if there is any change made in the image
+# This class defines operations on images. It is the pipeline.Recipe the widgets edit, reset() and has_changes()
+# come from there.
 #
-# @param[in] class of _main_.(ClassName)
-# @return Any int value if there is change in image otherwise default value.
-    def has_changes(self):
-        return self.color_filter or self.flip_left \
-               or self.flip_top or self.rotation_angle \
-               or self.contrast or self.brightness \
-               or self.sharpness or self.size
+class Operations(pipeline.Recipe):
+    pass
 
 
 operations = Operations()
@@ -183,49 +156,171 @@ def _get_converted_point(user_p1, user_p2, p1, p2, x):
 # @brief Performing operation on image.
 #
 # @details
-# This function perform operations like brightness, contrast and sharpness.
-#        
+# This function perform operations like brightness, contrast and sharpness, see pipeline.apply. The color filter
+# is already applied to _img_preview.
+# The output of every stage is kept in _stage_cache, so moving a slider re-runs that stage and the ones after it.
+# The channel gains are absolute and never modify _img_preview.
+# Renders on the worker thread pass snapshots of the operations and the source so the GUI can keep editing.
+#
+# @param[in] base Image to start from, source or a proxy of it, source by default
+# @param[in] ops Operations to apply, the global operations by default
+# @param[in] source Decoded image, _img_preview by default
+# @param[in] full_width Width of the image at full resolution, _full_size[0] by default
 # @return New Image.
-def _get_img_with_all_operations():
-    b = operations.brightness
-    c = operations.contrast
-    s = operations.sharpness
-
-    img = _img_preview
-    if b != 0:
-        img = img_helper.brightness(img, b)
+def _get_img_with_all_operations(base=None, ops=None, source=None, full_width=None):
+    if source is None:
+        source = _img_preview
+    if base is None:
+        base = source
+    if ops is None:
+        ops = operations
+    if full_width is None:
+        full_width = _full_size[0]
+
+    return pipeline.apply(base, ops, _stage_cache, base.width / full_width, skip=("color_filter",))
 
-    if c != 0:
-        img = img_helper.contrast(img, c)
-
-    if s != 0:
-        img = img_helper.sharpness(img, s)
-
-    if operations.rotation_angle:
-        img = img_helper.rotate(img, operations.rotation_angle)
+##
+# @brief Give the preview proxy.
+#
+# @details
+# This function downscales the source so it fits in a bound x bound square. Proxies are kept in _stage_cache.
+#
+# @param[in] source Full resolution image
+# @param[in] bound Maximum proxy width and height
+# @return Proxy image, source itself when it is small enough.
+def _get_preview_base(source, bound):
+    key = ("proxy", id(source), bound)
+    img = _stage_cache.get(key)
+    if img is None:
+        img = img_helper.proxy(source, bound, bound)
+        if img is not source:
+            _stage_cache.put(key, img, keep=source)
 
-    if operations.flip_left:
-        img = img_helper.flip_left(img)
+    return img
 
-    if operations.flip_top:
-        img = img_helper.flip_top(img)
+##
+# @brief Give the filter thumbnails.
+#
+# @details
+# This function makes the thumbnail of every filter from the preview proxy. They are kept in _disk_cache, except
+# the ones of encrypted images, so reopening an image only reads them back.
+#
+# @param[in] path Image path
+# @param[in] base Preview proxy of the image
+# @param[in] names Filter names, "none" for the unfiltered thumbnail
+# @param[in] width Thumbnail width
+# @param[in] height Thumbnail height
+# @return Dictionary of thumbnails by filter name.
+def _get_filter_thumbs(path, base, names, width, height):
+    use_disk = not loader.is_encrypted(path)
+    thumbs = {}
+    for name in names:
+        if use_disk:
+            thumbs[name], _ = _disk_cache.get(path, ("thumb", name, width, height))
+
+    missing = [name for name in names if thumbs.get(name) is None]
+    if missing:
+        img = img_helper.resize(base, width, height)
+        for name in missing:
+            thumbs[name] = img_helper.color_filter(img, name) if name != "none" else img
+            if use_disk:
+                _disk_cache.put(path, ("thumb", name, width, height), thumbs[name])
+
+    return thumbs
 
-    if operations.size:
-        img = img_helper.resize(img, *operations.size)
+##
+# @brief Prefetch an image.
+#
+# @details
+# This function runs on the prefetch workers. It decodes the image at the size of the preview and computes its
+# preview proxy, so opening it only has to render.
+#
+# @param[in] path Image path
+# @param[in] bound Maximum proxy width and height
+def _warm_image(path, bound):
+    _get_preview_base(qt_bridge.to_display_mode(_loader.load(path, (bound, bound))), bound)
 
-    if operations.red != operations.red_prev:
-        img = img_helper.hist_red(img, operations.red, operations.red_prev)
-        operations.red_prev = operations.red
+##
+# @brief Decode an image again at a larger size.
+#
+# @details
+# This function runs on the render worker, so zooming in or growing the window never decodes on the GUI thread.
+#
+# @param[in] path Image path
+# @param[in] bound Maximum width and height to decode at
+# @param[in] filter_name Color filter of the operations
+# @return Tuple of the decoded image, the image with the filter and the filter name.
+def _decode_image(path, bound, filter_name):
+    img = qt_bridge.to_display_mode(_prefetcher.load(path, (bound, bound)))
+    filtered = img_helper.color_filter(img, filter_name) if filter_name not in (None, "none") else img
+    return img, filtered, filter_name
 
-    if operations.green != operations.green_prev:
-        img = img_helper.hist_green(img, operations.green, operations.green_prev)
-        operations.green_prev = operations.green
+##
+# @brief Render the preview.
+#
+# @details
+# This function runs on the render worker, it only touches the snapshots it is given. The result is copied there
+# into a pooled frame buffer wrapped by a QImage, which is reused once the GUI thread made its pixmap.
+#
+# @param[in] source Decoded image
+# @param[in] ops Snapshot of the operations
+# @param[in] bound Maximum preview width and height
+# @param[in] full_width Width of the image at full resolution
+# @param[in] step Optional _history step the operations are the state of, it is given the preview
+# @return QImage of the new image.
+def _render_preview(source, ops, bound, full_width, step=None):
+    img = _get_img_with_all_operations(_get_preview_base(source, bound), ops, source, full_width)
+    if step is not None:
+        _history.attach(step, img)
+    return _frames.to_qimage(img)
 
-    if operations.blue != operations.blue_prev:
-        img = img_helper.hist_blue(img, operations.blue, operations.blue_prev)
-        operations.blue_prev = operations.blue
+##
+# @brief Class for background rendering
+#
+# @details
+# This class runs renders on a worker thread so the event loop never blocks. Requests are grouped by kind, a new
+# request supersedes the older ones of the same kind: they are dropped if they have not started yet and their
+# result is discarded otherwise. The newest result is posted back to the GUI thread through a Qt signal.
+#
 
-    return img
+class RenderScheduler(QtCore.QObject):
+    rendered = QtCore.pyqtSignal(str, int, object, object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="render")
+        self._latest = {}
+        self._pending = {}
+        self.rendered.connect(self._on_rendered)
+
+    def submit(self, kind, fn, callback):
+        """Run fn() on the worker and pass its result to callback on the GUI thread"""
+        generation = self.cancel(kind)
+        self._pending[kind] = self._executor.submit(self._run, kind, generation, fn, callback)
+
+    def cancel(self, kind):
+        """Supersede every request of this kind, return the new generation"""
+        generation = self._latest.get(kind, 0) + 1
+        self._latest[kind] = generation
+
+        pending = self._pending.pop(kind, None)
+        if pending is not None:
+            pending.cancel()
+        return generation
+
+    def _run(self, kind, generation, fn, callback):
+        if generation != self._latest[kind]:
+            return
+        try:
+            result = fn()
+        except Exception:
+            logger.exception(f"{kind} render failed")
+            return
+        self.rendered.emit(kind, generation, result, callback)
+
+    def _on_rendered(self, kind, generation, result, callback):
+        if generation == self._latest.get(kind):
+            callback(result)
 
 ##
 # @brief Create various buttons needed for GUI. 
@@ -446,21 +541,22 @@ class ModificationTab(QWidget):
         self.setLayout(main_layout)
 
     def set_boxes(self):
-        self.width_box.setText(str(_img_original.width))
-        self.height_box.setText(str(_img_original.height))
+        width, height = operations.size or _full_size
+        self.width_box.setText(str(width))
+        self.height_box.setText(str(height))
 
     def on_width_change(self, e):
         logger.debug(f"type width {self.width_box.text()}")
 
         if self.ratio_check.isChecked():
-            r_height = _get_ratio_height(_img_original.width, _img_original.height, int(self.width_box.text()))
+            r_height = _get_ratio_height(_full_size[0], _full_size[1], int(self.width_box.text()))
             self.height_box.setText(str(r_height))
 
     def on_height_change(self, e):
         logger.debug(f"type height {self.height_box.text()}")
 
         if self.ratio_check.isChecked():
-            r_width = _get_ratio_width(_img_original.width, _img_original.height, int(self.height_box.text()))
+            r_width = _get_ratio_width(_full_size[0], _full_size[1], int(self.height_box.text()))
             self.width_box.setText(str(r_width))
 
     def on_ratio_change(self, e):
@@ -520,6 +616,20 @@ class AdjustingTab(QWidget):
         self.sharpness_slider.setValue(SLIDER_DEF_VAL)
         self.contrast_slider.setValue(SLIDER_DEF_VAL)
 
+    def set_sliders(self):
+        """Move the sliders to the operations, after an undo or redo"""
+        for slider, factor, low, high in ((self.contrast_slider, operations.contrast, img_helper.CONTRAST_FACTOR_MIN,
+                                           img_helper.CONTRAST_FACTOR_MAX),
+                                          (self.brightness_slider, operations.brightness,
+                                           img_helper.BRIGHTNESS_FACTOR_MIN, img_helper.BRIGHTNESS_FACTOR_MAX),
+                                          (self.sharpness_slider, operations.sharpness,
+                                           img_helper.SHARPNESS_FACTOR_MIN, img_helper.SHARPNESS_FACTOR_MAX)):
+            # 0 is the factor of an untouched slider
+            value = round(_get_converted_point(low, high, SLIDER_MIN_VAL, SLIDER_MAX_VAL, factor)) if factor else \
+                SLIDER_DEF_VAL
+            slider.setValue(value)
+            slider.setToolTip(str(value))
+
     def on_contrast_slider_released(self):
         logger.debug(self.contrast_slider.value())
         self.contrast_slider.setToolTip(str(self.contrast_slider.value()))
@@ -594,6 +704,14 @@ class HistogramTab(QWidget):
         self.green_slider.setValue(SLIDER_DEF_VAL)
         self.blue_slider.setValue(SLIDER_DEF_VAL)
 
+    def set_sliders(self):
+        """Move the sliders to the operations, after an undo or redo"""
+        for slider, factor in ((self.red_slider, operations.red), (self.green_slider, operations.green),
+                               (self.blue_slider, operations.blue)):
+            value = round(factor * SLIDER_MAX_VAL - SLIDER_MAX_VAL)
+            slider.setValue(value)
+            slider.setToolTip(str(value))
+
     def on_red_slider_released(self):
         logger.debug(f"red selected value: {self.red_slider.value()}")
         self.red_slider.setToolTip(str(self.red_slider.value()))
@@ -656,15 +774,24 @@ class FiltersTab(QWidget):
     def on_filter_select(self, filter_name, e):
         logger.debug(f"apply color filter: {filter_name}")
 
-        global _img_preview
-        if filter_name != "none":
-            _img_preview = img_helper.color_filter(_img_original, filter_name)
-        else:
-            _img_preview = _img_original.copy()
         operations.color_filter = filter_name
         self.toggle_thumbs()
+        self.apply_filter()
 
-        self.parent.parent.place_preview_img()
+    def apply_filter(self, render=True):
+        """Filter the original image with the filter of the operations, and render the preview if render is set"""
+        if operations.color_filter not in (None, "none"):
+            job = partial(img_helper.color_filter, _img_original, operations.color_filter)
+        else:
+            job = _img_original.copy
+        self.parent.parent.renderer.submit("filter", job, partial(self.on_filter_rendered, render=render))
+
+    def on_filter_rendered(self, img, render=True):
+        global _img_preview
+        _img_preview = img
+
+        if render:
+            self.parent.parent.place_preview_img()
 
     def toggle_thumbs(self):
         for thumb in self.findChildren(QLabel):
@@ -679,6 +806,7 @@ class FiltersTab(QWidget):
 #
 
 class SecurityTab(QWidget):
+    progressed = QtCore.pyqtSignal(int)
 
     def __init__(self, parent):
         super().__init__()
@@ -688,6 +816,10 @@ class SecurityTab(QWidget):
                                             "font-weight:bold;")
         self.decryption_btn = create_button("One Click Decryption", BTN_MIN_WIDTH + 10, self.decrypt, True,
                                             "font-weight:bold;")
+        self.encrypt_folder_btn = create_button("Encrypt Folder", BTN_MIN_WIDTH + 10, self.encrypt_folder, True,
+                                                "font-weight:bold;")
+        self.decrypt_folder_btn = create_button("Decrypt Folder", BTN_MIN_WIDTH + 10, self.decrypt_folder, True,
+                                                "font-weight:bold;")
 
         # Create textbox
         self.textbox1 = QLineEdit(self)
@@ -705,55 +837,98 @@ class SecurityTab(QWidget):
         btn_layout.setAlignment(Qt.AlignCenter)
         btn_layout.addWidget(self.encryption_btn)
         btn_layout.addWidget(self.decryption_btn)
+        btn_layout.addWidget(self.encrypt_folder_btn)
+        btn_layout.addWidget(self.decrypt_folder_btn)
+
+        # files are streamed on their own worker so a large file doesn't hold up previews
+        self.worker = RenderScheduler(self)
+        self.progress_bar = QProgressBar(self)
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.hide()
+        self.progressed.connect(self.progress_bar.setValue)
+        self.status = QLabel(self)
 
         main_layout = QVBoxLayout()
         main_layout.setAlignment(Qt.AlignCenter)
         main_layout.addLayout(btn_layout)
+        main_layout.addWidget(self.progress_bar)
+        main_layout.addWidget(self.status)
 
         self.setLayout(main_layout)
 
-    def encrypt(self):
-        textboxValue1 = self.textbox1.text()
-        textboxValue2 = self.textbox2.text()
-        h = SHA256.new()
-        password = textboxValue1.encode()
-        h.update(password)
-        hash = h.digest()
-        key = hash[:16]
-        iv = hash[16:]
+    def _out_base(self):
+        return os.path.join(os.path.dirname(_img_path), self.textbox2.text())
+
+    def _set_busy(self, busy):
+        for btn in (self.encryption_btn, self.decryption_btn, self.encrypt_folder_btn, self.decrypt_folder_btn):
+            btn.setEnabled(not busy)
+        self.progress_bar.setVisible(busy)
+
+    def _start(self, kind, fn):
+        """Run an encryption job on the worker, the progress bar follows it. fn returns the status message"""
         logger.debug(_img_path)
-        ext = _img_path.split(os.path.sep)[-1].split('.')[-1]
-        padding = 8 - len(ext)
-        message = ext.encode() + (chr(padding) * padding).encode()
-        with open(_img_path, "rb") as f:
-            message += f.read()
-        aes = AES.new(key, AES.MODE_CBC, iv)
-        cipher = aes.encrypt(pad(message, AES.block_size))
-        with open((os.path.sep).join(_img_path.split(os.path.sep)[:-1]) + os.path.sep + textboxValue2 + ".ima",
-                  "wb") as f:
-            f.write(cipher)
+        self.progress_bar.setValue(0)
+        self._set_busy(True)
+
+        path, password = _img_path, self.textbox1.text()
+
+        def job():
+            try:
+                return fn(path, password, self._report), None
+            except (OSError, ValueError) as e:
+                return None, e
+
+        self.worker.submit(kind, job, self.on_done)
+
+    def _report(self, done, total):
+        # called on the worker, the signal queues the update to the GUI thread
+        self.progressed.emit(int(100 * done / total) if total else 100)
+
+    def encrypt(self):
+        out_path = self._out_base() + ima.EXTENSION
+        self._start("encrypt", lambda path, password, progress:
+                    "wrote " + ima.encrypt_file(path, out_path, password, progress))
 
     def decrypt(self):
-        textboxValue1 = self.textbox1.text()
-        textboxValue2 = self.textbox2.text()
-        h = SHA256.new()
-        password = textboxValue1.encode()
-        h.update(password)
-        hash = h.digest()
-        key = hash[:16]
-        iv = hash[16:]
-        logger.debug(_img_path)
-        with open(_img_path, "rb") as f:
-            cipher = f.read()
-        aes = AES.new(key, AES.MODE_CBC, iv)
-        message = aes.decrypt(cipher)
-        message = unpad(message, AES.block_size)
-        ext = message[:8 - message[7]]
-        message = message[8:]
-        with open(
-                os.path.sep.join(_img_path.split(os.path.sep)[:-1]) + os.path.sep + textboxValue2 + "." + ext.decode(),
-                "wb") as f:
-            f.write(message)
+        out_base = self._out_base()
+        self._start("decrypt", lambda path, password, progress:
+                    "wrote " + ima.decrypt_file(path, out_base, password, progress))
+
+    def _start_folder(self, job):
+        """Encrypt or decrypt every file of a folder in place, on all cores"""
+        folder = QFileDialog.getExistingDirectory(self, "Select folder", os.path.dirname(_img_path or ""))
+        if not folder:
+            return
+
+        paths = batch.collect_inputs([folder], img_helper.IMAGE_EXTENSIONS if job == "encrypt" else (ima.EXTENSION,))
+        if not paths:
+            self.status.setText(f"nothing to {job} in {folder}")
+            return
+
+        lines = []
+
+        def run(path, password, progress):
+            batch.run_crypto(job, paths, folder, password, report=lines.append, progress=progress)
+            return lines[-1]
+
+        self._start(job + " folder", run)
+
+    def encrypt_folder(self):
+        self._start_folder("encrypt")
+
+    def decrypt_folder(self):
+        self._start_folder("decrypt")
+
+    def on_done(self, result):
+        message, error = result
+        self._set_busy(False)
+
+        if error is not None:
+            self.status.clear()
+            QMessageBox.warning(self, "Imageica", str(error))
+        else:
+            logger.info(message)
+            self.status.setText(message)
 
 ##
 # @brief Class for miscellaneous purposes
@@ -769,19 +944,86 @@ class MiscellaneousTab(QWidget):
         self.parent = parent
         self.colorpop_btn = create_button("Color Pop", BTN_MIN_WIDTH, self.on_colorpop, True, "font-weight:bold;")
 
+        tolerance_lbl = QLabel("Tolerance")
+        tolerance_lbl.setAlignment(Qt.AlignCenter)
+
+        feather_lbl = QLabel("Feather")
+        feather_lbl.setAlignment(Qt.AlignCenter)
+
+        self.tolerance_slider = create_slider(self, self.on_colorpop_slider_released)
+        self.tolerance_slider.setRange(0, COLOR_POP_SLIDER_MAX)
+        self.feather_slider = create_slider(self, self.on_colorpop_slider_released)
+        self.feather_slider.setRange(0, COLOR_POP_SLIDER_MAX)
+
+        # keep only the area of the color connected to the clicked point
+        self.connected_check = QCheckBox("connected", self)
+        self.connected_check.stateChanged.connect(self.update_colorpop)
+
         btn_layout = QHBoxLayout()
         btn_layout.setAlignment(Qt.AlignCenter)
         btn_layout.addWidget(self.colorpop_btn)
+        btn_layout.addWidget(self.connected_check)
+
+        slider_layout = QGridLayout()
+        slider_layout.addWidget(tolerance_lbl, 0, 0)
+        slider_layout.addWidget(self.tolerance_slider, 1, 0)
+        slider_layout.addWidget(feather_lbl, 0, 1)
+        slider_layout.addWidget(self.feather_slider, 1, 1)
 
         main_layout = QVBoxLayout()
         main_layout.setAlignment(Qt.AlignCenter)
         main_layout.addLayout(btn_layout)
+        main_layout.addLayout(slider_layout)
 
+        self.reset_sliders()
         self.setLayout(main_layout)
 
+    def reset_sliders(self):
+        self.color = None
+        self.seed = None
+        self.tolerance_slider.setValue(color_pop.DEFAULT_TOLERANCE)
+        self.feather_slider.setValue(color_pop.DEFAULT_FEATHER)
+
+    def set_controls(self):
+        """Set the picked color, the point and the controls from the operations, after an undo or redo"""
+        pop = operations.color_pop
+        self.color = tuple(pop[:3]) if pop else None
+        if pop and len(pop) == 7:
+            self.seed = tuple(pop[5:])
+        self.tolerance_slider.setValue(pop[3] if pop else color_pop.DEFAULT_TOLERANCE)
+        self.feather_slider.setValue(pop[4] if pop else color_pop.DEFAULT_FEATHER)
+
+        self.connected_check.blockSignals(True)
+        self.connected_check.setChecked(bool(pop) and len(pop) == 7)
+        self.connected_check.blockSignals(False)
+
     def on_colorpop(self):
         self.parent.parent.captureMouseClick = True
-        pass
+
+    def on_colorpop_slider_released(self):
+        self.tolerance_slider.setToolTip(str(self.tolerance_slider.value()))
+        self.feather_slider.setToolTip(str(self.feather_slider.value()))
+        self.update_colorpop()
+
+    def pick(self, color, seed):
+        """Set the color picked and the point, as fractions of the image size, it was picked at"""
+        self.color = color
+        self.seed = seed
+        self.update_colorpop()
+
+    def update_colorpop(self):
+        """Set the color pop operation from the picked color and the controls, and render it"""
+        if self.color is None:
+            return
+        operations.color_pop = self.color + self.colorpop_params()
+        if self.connected_check.isChecked():
+            operations.color_pop += self.seed
+        logger.debug(f"color pop: {operations.color_pop}")
+        self.parent.parent.place_preview_img()
+
+    def colorpop_params(self):
+        """Tolerance and feather set on the sliders"""
+        return self.tolerance_slider.value(), self.feather_slider.value()
 
 ##
 # @brief Photo display class
@@ -813,6 +1055,12 @@ class PhotoViewer(QtWidgets.QGraphicsView):
     def hasPhoto(self):
         return not self._empty
 
+    def previewBound(self, zoom=None):
+        """Pixel size a preview needs to look sharp at the current zoom, or at the given one"""
+        viewport = self.viewport().rect()
+        zoom = self._zoom if zoom is None else zoom
+        return max(1, int(max(viewport.width(), viewport.height()) * 1.25 ** zoom))
+
     def fitInView(self, scale=True):
         rect = QtCore.QRectF(self._photo.pixmap().rect())
         if not rect.isNull():
@@ -839,6 +1087,18 @@ class PhotoViewer(QtWidgets.QGraphicsView):
             self._photo.setPixmap(QtGui.QPixmap())
         self.fitInView()
 
+    def swapPhoto(self, pixmap):
+        """Replace the photo by a render at another resolution, keeping zoom and position"""
+        old_width = self._photo.pixmap().width()
+        center = self.mapToScene(self.viewport().rect().center())
+
+        self._photo.setPixmap(pixmap)
+        self.setSceneRect(QtCore.QRectF(pixmap.rect()))
+
+        ratio = pixmap.width() / old_width
+        self.scale(1 / ratio, 1 / ratio)
+        self.centerOn(center * ratio)
+
     def wheelEvent(self, event):
         if self.hasPhoto():
             if event.angleDelta().y() > 0:
@@ -849,6 +1109,7 @@ class PhotoViewer(QtWidgets.QGraphicsView):
                 self._zoom -= 1
             if self._zoom > 0:
                 self.scale(factor, factor)
+                self.parent.refine_preview_img()
             elif self._zoom == 0:
                 self.fitInView()
             else:
@@ -863,20 +1124,21 @@ class PhotoViewer(QtWidgets.QGraphicsView):
     def mousePressEvent(self, event):
         if self._photo.isUnderMouse() and self.parent.captureMouseClick:
             print(self.mapToScene(event.pos()).toPoint())
-            x = self.mapToScene(event.pos()).toPoint().x()
-            y = self.mapToScene(event.pos()).toPoint().y()
-
-            global _img_preview
-            im = np.array(_img_preview)
-            im2 = im[:, :, :]
-            arr = im[y, x, :]
 
-            _img_preview = img_helper.color_filter(_img_preview, "gray")
-            im = np.array(_img_preview)
-            im[:, :] = np.where(im2[:, :] == arr, arr, im[:, :])
-            _img_preview = Image.fromarray(im)
-            preview_pix = ImageQt.toqpixmap(_img_preview)
-            self.setPhoto(preview_pix)
+            # the preview may be a proxy, rotated, flipped and resized: go back to _img_preview coordinates
+            pos = self.mapToScene(event.pos())
+            point = pipeline.source_point(operations, _img_preview.size, pos.x() / self._photo.pixmap().width(),
+                                          pos.y() / self._photo.pixmap().height())
+            if point is None:
+                logger.debug("click outside the rotated image, nothing to pick")
+                super(PhotoViewer, self).mousePressEvent(event)
+                return
+            x, y = point
+
+            # the color pop is an operation, the preview renders it on the proxy and saving at full resolution
+            color = color_pop.pick(_img_preview, x, y)
+            seed = ((x + 0.5) / _img_preview.width, (y + 0.5) / _img_preview.height)
+            self.parent.action_tabs.miscellaneous_tab.pick(color, seed)
 
             self.photoClicked.emit(self.mapToScene(event.pos()).toPoint())
             self.parent.captureMouseClick = False
@@ -896,8 +1158,20 @@ class ImageicaUI(QtWidgets.QWidget):
         super(ImageicaUI, self).__init__()
         self.captureMouseClick = False
         self._empty = False
-        self.image_list = []
+        self.image_list = folder_index.FolderIndex()
         self.name = None
+        self._position = 0
+        self._direction = 1
+        self.renderer = RenderScheduler(self)
+        self._preview_bound = None
+
+        # images added to or removed from the folder show up while browsing
+        self._watcher = QtCore.QFileSystemWatcher(self)
+        self._refresh_timer = QtCore.QTimer(self)
+        self._refresh_timer.setSingleShot(True)
+        self._refresh_timer.setInterval(FOLDER_REFRESH_MS)
+        self._refresh_timer.timeout.connect(self.on_folder_changed)
+        self._watcher.directoryChanged.connect(lambda path: self._refresh_timer.start())
 
         self.viewer = PhotoViewer(self)
         VBlayout = QtWidgets.QVBoxLayout(self)
@@ -914,11 +1188,17 @@ class ImageicaUI(QtWidgets.QWidget):
         self.Next_btn = create_button("Next", BTN_MIN_WIDTH, self.next_image, False, "font-weight:bold;")
         self.Previous_btn = create_button("Previous", BTN_MIN_WIDTH, self.previous_image, False, "font-weight:bold;")
         self.reset_btn = create_button("Reset", BTN_MIN_WIDTH, self.on_reset, False, "font-weight:bold;")
+        self.undo_btn = create_button("Undo", BTN_MIN_WIDTH, self.on_undo, False, "font-weight:bold;")
+        self.redo_btn = create_button("Redo", BTN_MIN_WIDTH, self.on_redo, False, "font-weight:bold;")
+        QShortcut(QKeySequence.Undo, self, self.on_undo)
+        QShortcut(QKeySequence.Redo, self, self.on_redo)
         self.save_btn = create_button("Save", BTN_MIN_WIDTH, self.on_save, False, "font-weight:bold;")
 
         HBlayout = QtWidgets.QHBoxLayout()
         HBlayout.addWidget(self.load_btn)
         HBlayout.addWidget(self.reset_btn)
+        HBlayout.addWidget(self.undo_btn)
+        HBlayout.addWidget(self.redo_btn)
         HBlayout.addWidget(self.Previous_btn)
         HBlayout.addWidget(self.Next_btn)
         HBlayout.addWidget(self.save_btn)
@@ -954,14 +1234,82 @@ class ImageicaUI(QtWidgets.QWidget):
             else:
                 event.ignore()
 
+        if event.isAccepted():
+            _history.close()
+
     def resizeEvent(self, e):
-        pass
+        # a bigger viewer needs a bigger proxy to stay sharp
+        if self._preview_bound is not None and self.viewer.previewBound() > self._preview_bound:
+            self.decode_in_background(self.viewer.previewBound(), self.place_preview_img)
 
     def place_preview_img(self):
-        img = _get_img_with_all_operations()
+        """Render the operations on a proxy sized for the viewer, full resolution is only used for saving"""
+        self._render_preview(self.viewer.setPhoto)
+
+    def refine_preview_img(self):
+        """Re-render at a higher resolution once zoomed in past the proxy"""
+        if self._preview_bound is None or self.viewer.previewBound() <= self._preview_bound:
+            return
+
+        self.decode_in_background(self.viewer.previewBound(), self._refine_decoded)
+
+    def _refine_decoded(self):
+        if self._preview_bound < max(_img_preview.size):
+            self._render_preview(self.viewer.swapPhoto)
+
+    def _render_preview(self, show):
+        self._preview_bound = self.viewer.previewBound()
+        job = partial(_render_preview, _img_preview, copy.copy(operations), self._preview_bound, _full_size[0],
+                      self._record())
+        self.renderer.submit("preview", job, lambda qimage: show(QPixmap.fromImage(qimage)))
+
+    def _record(self):
+        """Add the operations to the history if they changed, return the current step"""
+        step = _history.current()
+        if step is None or step.recipe != operations:
+            step = _history.push(operations.copy())
+        self._update_history_btns()
+        return step
+
+    def _update_history_btns(self):
+        self.undo_btn.setEnabled(_history.can_undo())
+        self.redo_btn.setEnabled(_history.can_redo())
+
+    def on_undo(self):
+        if _history.can_undo():
+            logger.debug("undo")
+            self._restore(*_history.undo())
+
+    def on_redo(self):
+        if _history.can_redo():
+            logger.debug("redo")
+            self._restore(*_history.redo())
+
+    def _restore(self, recipe, frame, boxes):
+        """Set the operations and the controls to a state of the history
+
+        The preview shows frame, the previous one with the tiles in boxes patched, or is rendered when it is None.
+        """
+        self.renderer.cancel("preview")
+        filter_changed = recipe.color_filter != operations.color_filter
+        operations.update(**recipe.to_dict())
 
-        preview_pix = ImageQt.toqpixmap(img)
-        self.viewer.setPhoto(preview_pix)
+        self.action_tabs.filters_tab.toggle_thumbs()
+        self.action_tabs.adjustment_tab.set_sliders()
+        self.action_tabs.histogram_tab.set_sliders()
+        self.action_tabs.miscellaneous_tab.set_controls()
+        self.action_tabs.modification_tab.set_boxes()
+        self._update_history_btns()
+
+        if frame is not None:
+            logger.debug(f"undo/redo patched {len(boxes)} tiles")
+            self.viewer.swapPhoto(QPixmap.fromImage(qt_bridge.from_array(frame)))
+
+        if filter_changed:
+            # the filtered image is the source of the next renders, only render it now if the frame is missing
+            self.action_tabs.filters_tab.apply_filter(render=frame is None)
+        elif frame is None:
+            self.place_preview_img()
 
     def on_save(self):
         logger.debug("open save dialog")
@@ -972,74 +1320,172 @@ class ImageicaUI(QtWidgets.QWidget):
 
         if new_img_path:
             logger.debug(f"save output image to {new_img_path}")
-            img = _get_img_with_all_operations()
+            self.decode_image()
+            if tiles.should_tile(_img_preview):
+                # large images are rendered tile by tile, without keeping every stage in the cache
+                img = tiles.apply(_img_preview, operations, skip=("color_filter",))
+            else:
+                img = _get_img_with_all_operations()
             img.save(new_img_path)
 
     def on_nothing(self):
         pass
 
+    def _go_to(self, index):
+        """Open the image at index in image_list, the neighbours are prefetched"""
+        if operations.has_changes():
+            reply = QMessageBox.question(win, "",
+                                         "You have unsaved changes<br>Do you want to save?",
+                                         QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes)
+
+            if reply == QMessageBox.Yes:
+                self.on_save()
+        operations.reset()
+        self._direction = 1 if index >= self._position else -1
+        self.path = self.image_list[index]
+        if self.load_image(self.path):
+            self._position = index
+        self._prefetch_neighbours()
+
+    def _prefetch_neighbours(self):
+        ahead = [self._position + self._direction * d for d in range(1, PREFETCH_AHEAD + 1)]
+        behind = [self._position - self._direction * d for d in range(1, PREFETCH_BEHIND + 1)]
+        paths = [self.image_list[i] for i in ahead + behind if 0 <= i < len(self.image_list)]
+        _prefetcher.prefetch(paths, partial(_warm_image, bound=self.viewer.previewBound(0)))
+
     def next_image(self):
         logger.debug("Next")
-        ind = self.image_list.index(self.name)
+        ind = self._position
         if ind + 1 != len(self.image_list):
-            if operations.has_changes():
-                reply = QMessageBox.question(win, "",
-                                             "You have unsaved changes<br>Do you want to save?",
-                                             QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes)
-
-                if reply == QMessageBox.Yes:
-                    self.on_save()
-            operations.reset()
-            self.path = self.image_list[ind + 1]
-            self.load_image(self.path)
+            self._go_to(ind + 1)
         else:
             self.Next_btn.setEnabled(False)
         self.Previous_btn.setEnabled(True)
 
     def previous_image(self):
         logger.debug("Previous")
-        ind = self.image_list.index(self.name)
+        ind = self._position
         if ind - 1 >= 0:
-            if operations.has_changes():
-                reply = QMessageBox.question(win, "",
-                                             "You have unsaved changes<br>Do you want to save?",
-                                             QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes)
-
-                if reply == QMessageBox.Yes:
-                    self.on_save()
-            operations.reset()
-            self.path = self.image_list[ind - 1]
-            self.load_image(self.path)
+            self._go_to(ind - 1)
         else:
             self.Previous_btn.setEnabled(False)
         self.Next_btn.setEnabled(True)
 
     def on_load(self):
         logger.debug("load")
+        extensions = " ".join(f"*{ext}" for ext in folder_index.EXTENSIONS)
         img_path, _ = QtWidgets.QFileDialog.getOpenFileName(None, "Open image",
-                                                            self.path, "Images (*.png *.jpg *.ima)")
+                                                            self.path, f"Images ({extensions})")
 
         if img_path:
             logger.debug(f"open file {img_path}")
             self.path = QFileInfo(img_path).path()
             logger.debug(self.path)
 
-            valid_images = [".jpg", ".png", ".ima"]
-            for f in os.listdir(self.path):
-                ext = os.path.splitext(f)[1]
-                if ext.lower() not in valid_images:
-                    continue
-                self.image_list.append(os.path.join(self.path, f).replace("\\", "/"))
+            if self._watcher.directories():
+                self._watcher.removePaths(self._watcher.directories())
+            self.image_list.open(self.path)
+            self._watcher.addPath(self.path)
 
             self.reset_btn.setEnabled(True)
             self.save_btn.setEnabled(True)
             self.Next_btn.setEnabled(True)
             self.Previous_btn.setEnabled(True)
 
-            self.load_image(img_path)
+            _prefetcher.cancel()
+            position = self.image_list.position(img_path)
+            self._position = position if position is not None else 0
+            if self.load_image(img_path):
+                self._prefetch_neighbours()
+
+    def on_folder_changed(self):
+        """Apply the images added to or removed from the folder, keeping the current one"""
+        if not self.image_list.refresh():
+            return
+
+        position = self.image_list.position(self.name) if self.name else None
+        if position is not None:
+            self._position = position
+        else:
+            self._position = min(self._position, max(0, len(self.image_list) - 1))
+        self._prefetch_neighbours()
+
+    def _open_image(self, img_path, size=None):
+        """Decode an image once, .ima files in memory after asking for the password of their folder
+
+        Returns the image and its full resolution size, it is decoded at a reduced size fitting size if given.
+        """
+        while True:
+            if _loader.needs_password(img_path):
+                password, ok = QInputDialog.getText(self, "Imageica",
+                                                    f"Password for {os.path.dirname(img_path)}", QLineEdit.Password)
+                if not ok:
+                    return None, None
+                _loader.set_password(img_path, password)
+
+            try:
+                img = _prefetcher.load(img_path, size)
+                return qt_bridge.to_display_mode(img), img.info.get(img_helper.FULL_SIZE_KEY, img.size)
+            except (OSError, ValueError) as e:
+                QMessageBox.warning(self, "Imageica", str(e))
+                if not loader.is_encrypted(img_path):
+                    return None, None
+                _loader.forget_password(img_path)
+
+    def decode_image(self, bound=None):
+        """Decode the current image again if it was decoded smaller than bound, at full resolution by default"""
+        global _img_original, _img_preview
+        if _img_original.size == _full_size or (bound is not None and max(_img_original.size) >= bound):
+            return
+
+        img, _ = self._open_image(self.name, None if bound is None else (bound, bound))
+        if img is None:
+            return
+        _img_original = img
+
+        self.renderer.cancel("filter")
+        if operations.color_filter not in (None, "none"):
+            _img_preview = img_helper.color_filter(_img_original, operations.color_filter)
+        else:
+            _img_preview = _img_original
+
+    def decode_in_background(self, bound, then):
+        """Like decode_image on the render worker, then() runs on the GUI thread once the image is ready"""
+        if _img_original.size == _full_size or max(_img_original.size) >= bound or _loader.needs_password(self.name):
+            self.decode_image(bound)
+            then()
+            return
+
+        job = partial(_decode_image, self.name, bound, operations.color_filter)
+        self.renderer.submit("decode", job, partial(self._on_decoded, self.name, then))
+
+    def _on_decoded(self, name, then, result):
+        global _img_original, _img_preview
+        img, filtered, filter_name = result
+        # another image was opened, or a larger decode landed first
+        if name != self.name or max(img.size) <= max(_img_original.size):
+            return
+
+        _img_original = img
+        self.renderer.cancel("filter")
+        if filter_name == operations.color_filter:
+            _img_preview = filtered
+            then()
+        else:
+            # the filter changed during the decode
+            self.action_tabs.filters_tab.apply_filter()
 
     def load_image(self, img_path):
-        self.viewer.setPhoto(QtGui.QPixmap(img_path))
+        """Open an image, return False if it could not be opened"""
+        # the viewer starts on the preview proxy, which the prefetcher may have computed already, the image is only
+        # decoded at the size the proxy needs until more is asked for
+        bound = self.viewer.previewBound(0)
+        img, full_size = self._open_image(img_path, (bound, bound))
+        if img is None:
+            return False
+
+        base = _get_preview_base(img, bound)
+        self.viewer.setPhoto(qt_bridge.to_qpixmap(base))
         self._empty = False
         logger.debug(f"open file {img_path}")
         self.name = img_path
@@ -1047,42 +1493,51 @@ class ImageicaUI(QtWidgets.QWidget):
         print(self.name)
         global _img_path
         _img_path = self.name
-        pix = QPixmap(img_path)
         self.action_tabs.setVisible(True)
         self.action_tabs.adjustment_tab.reset_sliders()
         self.action_tabs.histogram_tab.reset_sliders()
+        self.action_tabs.miscellaneous_tab.reset_sliders()
 
-        global _img_original
-        _img_original = ImageQt.fromqpixmap(pix)
+        global _img_original, _full_size
+        _img_original = img
+        _full_size = full_size
 
-        if _img_original.width < _img_original.height:
+        if _full_size[0] < _full_size[1]:
             w = THUMB_SIZE
-            h = _get_ratio_height(_img_original.width, _img_original.height, w)
+            h = _get_ratio_height(_full_size[0], _full_size[1], w)
         else:
             h = THUMB_SIZE
-            w = _get_ratio_width(_img_original.width, _img_original.height, h)
+            w = _get_ratio_width(_full_size[0], _full_size[1], h)
 
-        img_filter_thumb = img_helper.resize(_img_original, w, h)
+        self.renderer.cancel("filter")
+        self.renderer.cancel("preview")
+        self._preview_bound = bound if base is not img or img.size != full_size else None
 
-        global _img_preview
-        _img_preview = _img_original.copy()
+        # the shown proxy is the render of the untouched image, the first state of the history
+        _history.clear(operations.copy())
+        if not operations.has_changes():
+            _history.attach(_history.current(), base)
+        self._update_history_btns()
 
-        for thumb in self.action_tabs.filters_tab.findChildren(QLabel):
-            if thumb.name != "none":
-                img_filter_preview = img_helper.color_filter(img_filter_thumb, thumb.name)
-            else:
-                img_filter_preview = img_filter_thumb
+        # images are never changed in place, sharing the decoded one keeps its cached proxy valid
+        global _img_preview
+        _img_preview = _img_original
 
-            preview_pix = ImageQt.toqpixmap(img_filter_preview)
-            thumb.setPixmap(preview_pix)
+        labels = self.action_tabs.filters_tab.findChildren(QLabel)
+        thumbs = _get_filter_thumbs(img_path, base, [thumb.name for thumb in labels], w, h)
+        for thumb in labels:
+            thumb.setPixmap(qt_bridge.to_qpixmap(thumbs[thumb.name]))
 
         self.action_tabs.modification_tab.set_boxes()
+        return True
 
     def on_reset(self):
         logger.debug("reset all")
 
+        self.renderer.cancel("filter")
+
         global _img_preview
-        _img_preview = _img_original.copy()
+        _img_preview = _img_original
 
         operations.reset()
 
@@ -1090,6 +1545,7 @@ class ImageicaUI(QtWidgets.QWidget):
         self.place_preview_img()
         self.action_tabs.adjustment_tab.reset_sliders()
         self.action_tabs.histogram_tab.reset_sliders()
+        self.action_tabs.miscellaneous_tab.reset_sliders()
         self.action_tabs.modification_tab.set_boxes()
 
     def pixInfo(self):
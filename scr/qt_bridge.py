@@ -0,0 +1,201 @@
+"""
+Qt display bridge
+"""
+
+##
+# @brief Hand PIL images to Qt without re-encoding them.
+#
+# @details This program builds QImages from PIL images and NumPy arrays in a format Qt reads as it is, instead of
+# going through ImageQt, which converts to another channel order, or ImageQt.fromqpixmap, which encodes to PNG.
+# A NumPy array is wrapped without a copy. A PIL image is copied once: PIL keeps its rows in separately allocated
+# blocks, not in one buffer a QImage could point at, so the pixels are packed first. The pixel buffer is attached
+# to the QImage so it lives as long as the QImage does.
+#
+# Frames rendered over and over, like previews, can go through a FramePool, which copies them into preallocated
+# buffers. None of the formats used here is the native pixmap format, so QPixmap.fromImage always copies the pixels
+# and a buffer can be reused as soon as its QImage is gone.
+#
+
+from PIL import Image
+from PyQt5.QtGui import QImage, QPixmap
+
+import logging
+import threading
+import weakref
+
+import numpy as np
+
+logger = logging.getLogger()
+
+##
+# @var FORMATS
+# QImage format of each PIL mode which can be wrapped as it is
+# @hideinitializer
+#
+
+FORMATS = {"RGB": QImage.Format_RGB888, "RGBA": QImage.Format_RGBA8888, "L": QImage.Format_Grayscale8,
+           "RGBX": QImage.Format_RGBX8888}
+
+##
+# @var ARRAY_MODES
+# PIL mode of a uint8 array by number of bands
+# @hideinitializer
+#
+
+ARRAY_MODES = {1: "L", 3: "RGB", 4: "RGBA"}
+
+##
+# @var FRAME_MODES
+# Mode of the FramePool buffer for each image mode, RGB is kept 4 bytes per pixel like PIL stores it
+# @hideinitializer
+#
+
+FRAME_MODES = {"RGB": "RGBX", "RGBA": "RGBA", "L": "L"}
+
+##
+# @brief Convert an image to a mode the editor works in
+#
+# @param[in] img PIL image
+# @return img The image itself if it is RGB or RGBA, a converted copy otherwise
+#
+
+def to_display_mode(img):
+    if img.mode in ("RGB", "RGBA"):
+        return img
+    return img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+
+##
+# @brief Wrap a pixel buffer into a QImage
+#
+# @param[in] data Buffer of packed rows, kept alive by the QImage
+# @param[in] width Width in pixels
+# @param[in] height Height in pixels
+# @param[in] bytes_per_line Stride of the rows
+# @param[in] mode PIL mode of the pixels, one of FORMATS
+# @return qimg QImage sharing data
+#
+
+def wrap(data, width, height, bytes_per_line, mode):
+    qimg = QImage(data, width, height, bytes_per_line, FORMATS[mode])
+    qimg._buffer = data
+    return qimg
+
+##
+# @brief Convert a PIL image to a QImage
+#
+# @details
+# The pixels are copied once, packed by tobytes, and the QImage points at the copy. Frames converted over and over
+# should go through a FramePool, which copies into a reused buffer instead.
+#
+# @param[in] img PIL image
+# @return qimg QImage
+#
+
+def to_qimage(img):
+    if img.mode not in FORMATS:
+        img = to_display_mode(img)
+    return wrap(img.tobytes(), img.width, img.height, img.width * len(img.getbands()), img.mode)
+
+##
+# @brief Convert a PIL image to a QPixmap
+#
+# @param[in] img PIL image
+# @return pixmap QPixmap
+#
+
+def to_qpixmap(img):
+    return QPixmap.fromImage(to_qimage(img))
+
+##
+# @brief Wrap a NumPy array into a QImage
+#
+# @details
+# The QImage points at the array when its pixels are contiguous within rows, any row stride is fine. Other arrays
+# are copied once.
+#
+# @param[in] arr uint8 array of shape (height, width) or (height, width, bands) with 1, 3 or 4 bands
+# @param[in] mode Optional PIL mode of the pixels, to tell RGBX from RGBA
+# @return qimg QImage sharing the array
+#
+
+def from_array(arr, mode=None):
+    bands = 1 if arr.ndim == 2 else arr.shape[2] if arr.ndim == 3 else 0
+    if arr.dtype != np.uint8 or bands not in ARRAY_MODES:
+        logger.error(f"can't display an array of {arr.dtype} with shape {arr.shape}")
+        raise ValueError(f"can't display an array of {arr.dtype} with shape {arr.shape}")
+
+    if arr.strides[1] != bands or (arr.ndim == 3 and arr.strides[2] != 1) or arr.strides[0] < 0:
+        arr = np.ascontiguousarray(arr)
+    if not arr.flags.writeable:
+        arr = arr.copy()
+    return wrap(arr.data, arr.shape[1], arr.shape[0], arr.strides[0], mode or ARRAY_MODES[bands])
+
+##
+# @brief Pool of frame buffers
+#
+# @details
+# This class copies images into preallocated arrays and wraps them into QImages, so a render does not allocate a
+# new frame. A buffer is in use as long as the QImage made from it is alive. The pool keeps at most size buffers,
+# more are only allocated while all of them are in use. All methods are thread safe.
+#
+
+class FramePool:
+
+    def __init__(self, size=3):
+        self.size = size
+        self.allocations = 0
+        self._frames = []
+        self._lock = threading.Lock()
+
+    ##
+    # @brief Get a free buffer
+    #
+    # @param[in] shape Shape of the buffer
+    # @return frame [array, owner] entry, marked as in use
+    #
+
+    def _acquire(self, shape):
+        with self._lock:
+            for i, frame in enumerate(self._frames):
+                if frame[0].shape == shape and frame[1]() is None:
+                    del self._frames[i]
+                    self._frames.append(frame)
+                    frame[1] = lambda: True
+                    return frame
+
+            frame = [np.empty(shape, dtype=np.uint8), lambda: True]
+            self.allocations += 1
+            self._frames.append(frame)
+
+            # drop the least recently used free buffers over the size
+            free = [i for i, f in enumerate(self._frames) if f[1]() is None]
+            for i in reversed(free[:max(0, len(self._frames) - self.size)]):
+                del self._frames[i]
+            return frame
+
+    ##
+    # @brief Convert a PIL image to a QImage in a pooled buffer
+    #
+    # @param[in] img PIL image
+    # @return qimg QImage, its buffer is reused once it is deleted
+    #
+
+    def to_qimage(self, img):
+        if img.mode not in FRAME_MODES:
+            img = to_display_mode(img)
+        mode = FRAME_MODES[img.mode]
+        shape = (img.height, img.width) if mode == "L" else (img.height, img.width, 4)
+
+        img.load()
+        frame = self._acquire(shape)
+        try:
+            # a PIL image mapped on the buffer, pasted into without going through a temporary copy
+            target = Image.frombuffer(mode, img.size, frame[0], "raw", mode, 0, 1)
+            target.im.paste(img.im, (0, 0) + img.size)
+        except (ValueError, AttributeError):
+            frame[1] = lambda: None
+            return to_qimage(img)
+
+        qimg = from_array(frame[0], mode)
+        frame[1] = weakref.ref(qimg)
+        return qimg
@@ -0,0 +1,68 @@
+"""
+Shared helpers for the benchmark scripts
+"""
+
+import glob
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TOOLS_DIR)
+SCR_DIR = os.path.join(ROOT_DIR, "scr")
+TEST_DIR = os.path.join(ROOT_DIR, "test")
+
+# the scripts import img_modifier and qt_bridge from scr/
+sys.path.insert(0, SCR_DIR)
+
+##
+# @brief List benchmark images
+#
+# @return paths Sorted paths of the images in test/
+#
+
+def test_images():
+    paths = glob.glob(os.path.join(TEST_DIR, "*.jpg")) + glob.glob(os.path.join(TEST_DIR, "*.png"))
+    return sorted(paths)
+
+##
+# @brief Silence the debug logger
+#
+# @details
+# img_modifier configures the root logger at DEBUG level, which floods the benchmark output.
+#
+
+def quiet():
+    logging.getLogger().setLevel(logging.WARNING)
+
+##
+# @brief Time a callable
+#
+# @param[in] fn Callable without arguments
+# @param[in] repeat Number of runs
+# @return best Best wall time in seconds
+#
+
+def best_of(fn, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+##
+# @brief Peak traced memory of a callable
+#
+# @param[in] fn Callable without arguments
+# @return peak Peak allocation in MB
+#
+
+def peak_mb(fn):
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 2 ** 20
@@ -0,0 +1,65 @@
+"""
+Benchmark color pop, the exact per-channel match it replaced against the Lab mask, on a preview and a 20 MP image,
+and the connected region of the mask around the clicked point
+
+usage: python tools/bench_color_pop.py
+"""
+
+import numpy as np
+
+import _bench
+
+from img_modifier import color_filter
+from img_modifier import color_pop
+from img_modifier import img_helper
+
+##
+# @var SIZES
+# Image sizes measured, a preview and a 20 MP image
+# @hideinitializer
+#
+
+SIZES = {"preview": (1280, 853), "20 MP": (5472, 3648)}
+
+##
+# @brief Color pop as the viewer did it before
+#
+# @param[in] img RGB image
+# @param[in] x Clicked column
+# @param[in] y Clicked row
+# @return img New image
+#
+
+def exact_pop(img, x, y):
+    im = np.array(img)
+    arr = im[y, x, :]
+    gray = np.array(color_filter.gray(img))
+    return np.where(im == arr, arr, gray)
+
+
+def main():
+    _bench.quiet()
+    source = img_helper.get_img(_bench.test_images()[-1]).convert("RGB")
+
+    print(f"{'image':<10}{'method':<16}{'ms':>10}{'kept %':>10}")
+    for label, size in SIZES.items():
+        img = source.resize(size)
+        x, y = img.width // 2, img.height // 2
+        color = color_pop.pick(img, x, y)
+
+        kept = (np.asarray(img) == np.asarray(img)[y, x]).all(axis=2).mean()
+        t = _bench.best_of(lambda: exact_pop(img, x, y))
+        print(f"{label:<10}{'exact':<16}{t * 1000:>10.1f}{kept * 100:>10.2f}")
+
+        mask = np.asarray(color_pop.color_mask(img, color))
+        # first click computes the Lab conversion and the gray base, the next ones reuse them
+        t = _bench.best_of(lambda: color_pop.color_pop(img, color), repeat=1)
+        print(f"{label:<10}{'lab first':<16}{t * 1000:>10.1f}{(mask > 127).mean() * 100:>10.2f}")
+        t = _bench.best_of(lambda: color_pop.color_pop(img, color, tolerance=30))
+        print(f"{label:<10}{'lab tolerance':<16}{t * 1000:>10.1f}")
+        t = _bench.best_of(lambda: color_pop.color_pop(img, color, tolerance=30, seed=(0.5, 0.5)))
+        print(f"{label:<10}{'lab connected':<16}{t * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Benchmark converting rendered frames to pixmaps, through ImageQt and through qt_bridge
+
+usage: python tools/bench_display.py
+"""
+
+import os
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PIL import Image, ImageQt
+from PyQt5.QtGui import QPixmap
+from PyQt5.QtWidgets import QApplication
+
+import _bench
+
+from img_modifier import img_helper
+import qt_bridge
+
+##
+# @var SIZES
+# Frame sizes measured, a preview and a 20 MP image
+# @hideinitializer
+#
+
+SIZES = {"preview": (1280, 853), "20 MP": (5472, 3648)}
+
+
+def main():
+    _bench.quiet()
+    app = QApplication([])
+    pool = qt_bridge.FramePool()
+
+    paths = {
+        "bridge": lambda img: qt_bridge.to_qpixmap(img),
+        "pool": lambda img: QPixmap.fromImage(pool.to_qimage(img)),
+    }
+    # the ImageQt functions only exist with a Pillow which still supports PyQt5
+    if hasattr(ImageQt, "toqpixmap"):
+        paths = dict({
+            "toqpixmap": lambda img: ImageQt.toqpixmap(img),
+            "ImageQt copy": lambda img: QPixmap.fromImage(ImageQt.ImageQt(img).copy()),
+        }, **paths)
+
+    source = img_helper.get_img(_bench.test_images()[0]).convert("RGB")
+    print(f"{'frame':<10}{'path':<14}{'ms':>10}{'py MB':>10}")
+    for label, size in SIZES.items():
+        img = source.resize(size)
+        for name, fn in paths.items():
+            fn(img)
+            ms = _bench.best_of(lambda: fn(img), repeat=5) * 1000
+            print(f"{label:<10}{name:<14}{ms:>10.1f}{_bench.peak_mb(lambda: fn(img)):>10.1f}")
+    print(f"pool allocations: {pool.allocations}")
+    app.quit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Benchmark the color-matrix filter kernel against the old float64 implementation
+
+usage: python tools/bench_filters.py
+"""
+
+import os
+
+import numpy as np
+from PIL import Image
+
+import _bench
+
+from img_modifier import color_filter
+
+##
+# @brief Reference implementation of the old sepia filter
+#
+
+def legacy_sepia(img):
+    im = np.array(img)
+    im2 = np.zeros(im.shape)
+    im2[:, :, 0] = 0.393 * im[:, :, 0] + 0.769 * im[:, :, 1] + 0.189 * im[:, :, 2]
+    im2[:, :, 1] = 0.349 * im[:, :, 0] + 0.686 * im[:, :, 1] + 0.168 * im[:, :, 2]
+    im2[:, :, 2] = 0.272 * im[:, :, 0] + 0.534 * im[:, :, 1] + 0.131 * im[:, :, 2]
+    im2 = np.where(im2 > 255, 255, im2).astype(np.uint8)
+    if im.shape[2] > 3:
+        im2[:, :, 3:] = im[:, :, 3:]
+    return Image.fromarray(im2)
+
+
+def main():
+    _bench.quiet()
+    print(f"{'image':<28}{'old (s)':>10}{'new (s)':>10}{'old MB':>10}{'new MB':>10}{'max diff':>10}")
+    for path in _bench.test_images():
+        img = Image.open(path)
+        img.load()
+        old_t = _bench.best_of(lambda: legacy_sepia(img))
+        new_t = _bench.best_of(lambda: color_filter.sepia(img))
+        old_mb = _bench.peak_mb(lambda: legacy_sepia(img))
+        new_mb = _bench.peak_mb(lambda: color_filter.sepia(img))
+
+        diff = np.abs(np.asarray(legacy_sepia(img), dtype=np.int16) -
+                      np.asarray(color_filter.sepia(img), dtype=np.int16)).max()
+        print(f"{os.path.basename(path):<28}{old_t:>10.4f}{new_t:>10.4f}{old_mb:>10.1f}{new_mb:>10.1f}{diff:>10}")
+
+
+if __name__ == "__main__":
+    main()
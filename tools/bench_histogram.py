@@ -0,0 +1,42 @@
+"""
+Benchmark the histogram (channel gain) operations against the old per-pixel loops
+
+usage: python tools/bench_histogram.py
+"""
+
+import os
+
+import _bench
+
+from img_modifier import img_helper
+
+##
+# @brief Reference implementation of the old hist_red loop
+#
+
+def legacy_hist_red(img, ratio, ratio_prev):
+    pix = img.load()
+    temp = ratio / ratio_prev
+    for i in range(img.width):
+        for j in range(img.height):
+            pix[i, j] = (int(pix[i, j][0] * temp), pix[i, j][1], pix[i, j][2])
+    return img
+
+
+def main():
+    _bench.quiet()
+    print(f"{'image':<28}{'size':>12}{'loop (s)':>12}{'lut (s)':>12}{'speedup':>10}")
+    for path in _bench.test_images():
+        img = img_helper.get_img(path).convert("RGB")
+        legacy = _bench.best_of(lambda: legacy_hist_red(img.copy(), 1.5, 1), repeat=1)
+        lut = _bench.best_of(lambda: img_helper.hist_red(img, 1.5, 1))
+
+        expected = legacy_hist_red(img.copy(), 1.5, 1)
+        assert expected.tobytes() == img_helper.hist_red(img, 1.5, 1).tobytes(), path
+
+        size = f"{img.width}x{img.height}"
+        print(f"{os.path.basename(path):<28}{size:>12}{legacy:>12.3f}{lut:>12.4f}{legacy / lut:>9.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Benchmark undo and redo of a history past its step limit, patched against rendered, on a preview sized frame
+
+usage: python tools/bench_history.py
+"""
+
+import time
+
+import numpy as np
+
+import _bench
+
+from img_modifier import history
+from img_modifier import img_helper
+from img_modifier import pipeline
+
+##
+# @var LIMIT
+# Steps kept by the history, the edits push three times as many
+# @hideinitializer
+#
+
+LIMIT = 5
+
+##
+# @var BOUND
+# Preview size the frames are rendered at
+# @hideinitializer
+#
+
+BOUND = 1280
+
+
+def main():
+    _bench.quiet()
+    img = img_helper.proxy(img_helper.get_img(_bench.test_images()[-1]).convert("RGB"), BOUND, BOUND)
+    hist = history.History(limit=LIMIT)
+
+    for i in range(3 * LIMIT):
+        recipe = pipeline.Recipe(brightness=1 + 0.02 * (i + 1), red=1 + 0.01 * i)
+        hist.attach(hist.push(recipe), recipe.apply(img))
+
+    # every step but the first, which is never undone, must be patched however many were dropped
+    stats = hist.stats()
+    assert stats["steps"] == LIMIT and stats["patches"] == LIMIT - 1, stats
+
+    undone = []
+    while hist.can_undo():
+        start = time.perf_counter()
+        recipe, frame, _ = hist.undo()
+        undone.append(time.perf_counter() - start)
+        assert frame is not None and np.array_equal(frame, np.asarray(recipe.apply(img))), hist.position
+
+    render = _bench.best_of(lambda: hist.current().recipe.apply(img))
+    print(f"{'steps':>6}{'patches':>9}{'undo ms':>9}{'render ms':>11}")
+    print(f"{stats['steps']:>6}{stats['patches']:>9}{max(undone) * 1000:>9.1f}{render * 1000:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
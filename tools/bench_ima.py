@@ -0,0 +1,79 @@
+"""
+Benchmark streaming .ima encryption against the old one-shot implementation of version 1
+
+usage: python tools/bench_ima.py [size in MB]
+"""
+
+import os
+import sys
+import tempfile
+
+from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+from Crypto.Util.Padding import pad, unpad
+
+import _bench
+
+from img_modifier import ima
+
+##
+# @brief Reference implementation of the old SecurityTab.encrypt
+#
+
+def legacy_encrypt(path, out_path, password):
+    key_iv = SHA256.new(password.encode()).digest()
+    ext = path.split(".")[-1]
+    padding = 8 - len(ext)
+    message = ext.encode() + (chr(padding) * padding).encode()
+    with open(path, "rb") as f:
+        message += f.read()
+    cipher = AES.new(key_iv[:16], AES.MODE_CBC, key_iv[16:]).encrypt(pad(message, AES.block_size))
+    with open(out_path, "wb") as f:
+        f.write(cipher)
+
+##
+# @brief Reference implementation of the old SecurityTab.decrypt
+#
+
+def legacy_decrypt(path, out_base, password):
+    key_iv = SHA256.new(password.encode()).digest()
+    with open(path, "rb") as f:
+        cipher = f.read()
+    message = unpad(AES.new(key_iv[:16], AES.MODE_CBC, key_iv[16:]).decrypt(cipher), AES.block_size)
+    with open(f"{out_base}.{message[:8 - message[7]].decode()}", "wb") as f:
+        f.write(message[8:])
+
+
+def main():
+    _bench.quiet()
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "image.tif")
+        with open(src, "wb") as f:
+            f.write(os.urandom(size_mb * 2 ** 20))
+        enc_v1 = os.path.join(tmp, "v1.ima")
+        enc_v2 = os.path.join(tmp, "v2.ima")
+        out = os.path.join(tmp, "out")
+        key = ima.Key("bench")
+
+        # the key is derived once so the rows compare the ciphers, not scrypt
+        runs = [
+            ("encrypt v1 old", lambda: legacy_encrypt(src, enc_v1, "bench")),
+            ("encrypt v2", lambda: ima.encrypt_file(src, enc_v2, key)),
+            ("decrypt v1 old", lambda: legacy_decrypt(enc_v1, out, "bench")),
+            ("decrypt v1", lambda: ima.decrypt_file(enc_v1, out, key)),
+            ("decrypt v2", lambda: ima.decrypt_file(enc_v2, out, key)),
+        ]
+        print(f"{size_mb} MB file")
+        print(f"{'':<16}{'MB/s':>10}{'peak MB':>10}")
+        for name, fn in runs:
+            seconds = _bench.best_of(fn)
+            print(f"{name:<16}{size_mb / seconds:>10.1f}{_bench.peak_mb(fn):>10.1f}")
+
+        with open(src, "rb") as a, open(out + ".tif", "rb") as b:
+            assert a.read() == b.read(), "round trip changed the file"
+
+
+if __name__ == "__main__":
+    main()
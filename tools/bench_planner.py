@@ -0,0 +1,57 @@
+"""
+Benchmark the planned pipeline against the naive stage order
+
+usage: python tools/bench_planner.py
+"""
+
+import os
+
+import numpy as np
+
+import _bench
+
+from img_modifier import img_helper
+from img_modifier import pipeline
+from img_modifier import planner
+
+##
+# @var RECIPES
+# Recipes covering thumbnails, fused geometry and point operations, and the orders the planner must not change:
+# gains after sharpness, clipping curves before a downscale down to a few pixels
+# @hideinitializer
+#
+
+RECIPES = {
+    "thumbnail": pipeline.Recipe(color_filter="sepia", brightness=1.2, contrast=1.3, red=1.2, size=(160, 120)),
+    "rotate+flip": pipeline.Recipe(rotation_angle=90, flip_left=True, flip_top=True, brightness=0.8,
+                                   size=(192, 256)),
+    "points only": pipeline.Recipe(color_filter="negative", brightness=1.4, contrast=0.7, green=1.5),
+    "sharpen+resize": pipeline.Recipe(sharpness=2, contrast=1.2, size=(320, 240)),
+    "sharpen+gains": pipeline.Recipe(sharpness=3, brightness=1.5, red=2, green=2, blue=2),
+    "clip 8x6": pipeline.Recipe(brightness=1.5, contrast=1.5, red=1.5, size=(8, 6)),
+    "sepia 16x12": pipeline.Recipe(color_filter="sepia", contrast=1.5, brightness=1.4, red=1.3, blue=0.7,
+                                   size=(16, 12)),
+    "gray 16x12": pipeline.Recipe(color_filter="gray", contrast=0.8, brightness=0.9, green=1.4, size=(16, 12)),
+}
+
+
+def main():
+    _bench.quiet()
+    print(f"{'image':<28}{'recipe':<16}{'naive (s)':>10}{'plan (s)':>10}{'mean diff':>10}{'max diff':>10}")
+    for path in _bench.test_images():
+        img = img_helper.get_img(path)
+        img.load()
+        for name, recipe in RECIPES.items():
+            naive = pipeline.apply(img, recipe)
+            planned = planner.apply(img, recipe)
+            diff = np.abs(np.asarray(naive, dtype=np.int16) - np.asarray(planned, dtype=np.int16))
+            assert diff.mean() < planner.PLAN_TOLERANCE, (path, name, diff.mean())
+
+            naive_t = _bench.best_of(lambda: pipeline.apply(img, recipe))
+            plan_t = _bench.best_of(lambda: planner.apply(img, recipe))
+            print(f"{os.path.basename(path):<28}{name:<16}{naive_t:>10.4f}{plan_t:>10.4f}"
+                  f"{diff.mean():>10.3f}{diff.max():>10}")
+
+
+if __name__ == "__main__":
+    main()
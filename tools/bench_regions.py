@@ -0,0 +1,75 @@
+"""
+Benchmark the connected region of a mask at 20 MP, on color pop masks of the test images and on the worst masks:
+noise around the percolation threshold, which has the most runs and links, and a comb of one pixel wide teeth,
+which has the longest chains of runs
+
+usage: python tools/bench_regions.py
+"""
+
+import os
+
+import numpy as np
+
+import _bench
+
+from img_modifier import color_pop
+from img_modifier import img_helper
+from img_modifier import regions
+
+##
+# @var SIZE
+# Mask size, a 20 MP image
+# @hideinitializer
+#
+
+SIZE = (5472, 3648)
+
+##
+# @var TOLERANCES
+# Color pop tolerances the masks of the test images are made with
+# @hideinitializer
+#
+
+TOLERANCES = (20, 40)
+
+##
+# @brief Worst case masks
+#
+# @return masks Dictionary of boolean arrays by name
+#
+
+def worst_masks():
+    width, height = SIZE
+    rng = np.random.default_rng(0)
+    comb = np.zeros((height, width), dtype=bool)
+    comb[:, ::2] = True
+    comb[-1] = True
+    return {"noise 55%": rng.random((height, width)) < 0.55, "noise 60%": rng.random((height, width)) < 0.6,
+            "comb": comb}
+
+
+def measure(name, mask, x, y):
+    runs = regions.Runs(mask)
+    t = _bench.best_of(lambda: regions.connected_region(mask, x, y), repeat=2)
+    region = regions.connected_region(mask, x, y)
+    print(f"{name[:31]:<32}{len(runs):>10}{mask.mean() * 100:>8.1f}{region.mean() * 100:>9.1f}{t * 1000:>9.0f}")
+
+
+def main():
+    _bench.quiet()
+    print(f"{'mask':<32}{'runs':>10}{'set %':>8}{'region %':>9}{'ms':>9}")
+    for path in _bench.test_images():
+        img = img_helper.get_img(path).convert("RGB").resize(SIZE)
+        x, y = img.width // 2, img.height // 2
+        color = color_pop.pick(img, x, y)
+        for tolerance in TOLERANCES:
+            mask = np.asarray(color_pop.color_mask(img, color, tolerance)) > 0
+            measure(f"{os.path.basename(path)} {tolerance}", mask, x, y)
+
+    # seeded on the first set pixel of the last row, which the comb teeth all reach
+    for name, mask in worst_masks().items():
+        measure(name, mask, int(np.argmax(mask[-1])), SIZE[1] - 1)
+
+
+if __name__ == "__main__":
+    main()
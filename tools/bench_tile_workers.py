@@ -0,0 +1,68 @@
+"""
+Benchmark the scaling of tiled rendering with the number of threads, on the test images enlarged to 24 MP
+
+usage: python tools/bench_tile_workers.py
+"""
+
+import os
+
+import _bench
+
+from img_modifier import img_helper
+from img_modifier import pipeline
+from img_modifier import tiles
+
+##
+# @var WORKERS
+# Thread counts measured
+# @hideinitializer
+#
+
+WORKERS = (1, 2, 4, 8)
+
+##
+# @var MEGAPIXELS
+# Size the test images are enlarged to, they are too small to split into many tiles
+# @hideinitializer
+#
+
+MEGAPIXELS = 24
+
+##
+# @var RECIPES
+# Recipes measured, each one mostly spent in one kind of stage
+# @hideinitializer
+#
+
+RECIPES = {
+    "sharpness": pipeline.Recipe(sharpness=2),
+    "sepia": pipeline.Recipe(color_filter="sepia"),
+    "gains": pipeline.Recipe(red=1.2, blue=0.8),
+    "all": pipeline.Recipe(color_filter="sepia", contrast=1.2, sharpness=2, red=1.1),
+}
+
+
+def main():
+    _bench.quiet()
+    print(f"{os.cpu_count()} cores")
+    print(f"{'image':<28}{'recipe':<11}" + "".join(f"{f'{n} thr s':>10}" for n in WORKERS) + f"{'speedup':>9}")
+
+    totals = {name: [0.0] * len(WORKERS) for name in RECIPES}
+    for path in _bench.test_images():
+        source = img_helper.get_img(path).convert("RGB")
+        scale = (MEGAPIXELS * 1e6 / (source.width * source.height)) ** 0.5
+        img = source.resize((int(source.width * scale), int(source.height * scale)))
+
+        for name, recipe in RECIPES.items():
+            times = [_bench.best_of(lambda: tiles.apply(img, recipe, workers=n), repeat=2) for n in WORKERS]
+            for i, t in enumerate(times):
+                totals[name][i] += t
+            print(f"{os.path.basename(path)[:27]:<28}{name:<11}" + "".join(f"{t:>10.2f}" for t in times)
+                  + f"{times[0] / times[-1]:>8.1f}x")
+
+    for name, times in totals.items():
+        print(f"{'total':<28}{name:<11}" + "".join(f"{t:>10.2f}" for t in times) + f"{times[0] / times[-1]:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Benchmark tiled rendering against whole-image rendering, time and peak memory on growing images
+
+usage: python tools/bench_tiles.py
+"""
+
+import multiprocessing
+import resource
+import time
+
+import _bench
+
+from img_modifier import img_helper
+from img_modifier import pipeline
+from img_modifier import tiles
+
+##
+# @var MEGAPIXELS
+# Image sizes measured
+# @hideinitializer
+#
+
+MEGAPIXELS = (12, 24, 48, 96)
+
+##
+# @var RECIPE
+# A filter, point operations and sharpness, all tileable
+# @hideinitializer
+#
+
+RECIPE = pipeline.Recipe(color_filter="sepia", contrast=1.2, sharpness=2, red=1.1)
+
+METHODS = {"whole": lambda img: pipeline.apply(img, RECIPE), "tiled": lambda img: tiles.apply(img, RECIPE)}
+
+##
+# @brief Measure one method in a fresh process
+#
+# @details
+# The peak resident size is read after the run and compared to the one before it, with the input image loaded,
+# so it covers the output and every temporary.
+#
+
+def measure(method, megapixels, results):
+    _bench.quiet()
+    source = img_helper.get_img(_bench.test_images()[-1]).convert("RGB")
+    scale = (megapixels * 1e6 / (source.width * source.height)) ** 0.5
+    img = source.resize((int(source.width * scale), int(source.height * scale)))
+    del source
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    METHODS[method](img)
+    seconds = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((seconds, (after - before) / 1024, img.width * img.height))
+
+
+def main():
+    ctx = multiprocessing.get_context("fork")
+    print(f"{'MP':>6}{'method':>8}{'s':>8}{'peak MB':>10}{'B/pixel':>9}")
+    for megapixels in MEGAPIXELS:
+        for method in METHODS:
+            results = ctx.Queue()
+            worker = ctx.Process(target=measure, args=(method, megapixels, results))
+            worker.start()
+            seconds, peak, pixels = results.get()
+            worker.join()
+            print(f"{megapixels:>6}{method:>8}{seconds:>8.2f}{peak:>10.0f}{peak * 2 ** 20 / pixels:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()